@@ -0,0 +1,216 @@
+'''
+Benchmark the ingest, clump, association and reconciliation stages on synthetic fire activity
+  over a sweep of input sizes
+'''
+import os.path
+import sys
+import json
+import time
+import importlib
+import subprocess
+from datetime import datetime
+from multiprocessing import get_context
+from database import get_database
+from instrument import Instrument
+from sources import DataSource
+from reconcile import get_reconciliation
+from .synth import SynthFires
+
+def get_stage(package, method, suffix):
+    '''
+    Get a stage class by method name as load_source.py does, eg. clump and hms gives HmsClump
+    '''
+    stage_module = importlib.import_module('%s.%s' %(package, method.lower()))
+    return getattr(stage_module, '%s%s' %(method.capitalize(), suffix))
+
+def get_commit():
+    '''
+    Get the commit of the working tree for the results
+    '''
+    try:
+        return subprocess.run(['git','rev-parse','--short','HEAD'], capture_output=True, text=True,
+          check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+class Benchmark():
+    '''
+    Run the stages for each size in the sweep. Each size is run in its own process so that the
+      peak memory is for that size alone.
+    '''
+    def __init__(self, config):
+        with open(config) as f:
+            self._config = json.load(f)
+        atts = ['name','sizes','sources']
+        for att in atts:
+            try:
+                setattr(self, att, self._config[att])
+            except KeyError as e:
+                raise ValueError('Missing %s in config file' %att)
+        # Optional attribute key: default pairs
+        atts = {'seed': 0, 'year': 2020, 'work_path': 'benchmarks', 'db_config': 'config/benchmark.json',
+          'reconciliation_method': 'graph', 'ground_fraction': 0.01, 'perimeter_fraction': 0.01,
+          'regression_threshold': 0.1, 'min_time': 0.5}
+        for att, default in atts.items():
+            try:
+                setattr(self, att, self._config[att])
+            except KeyError:
+                setattr(self, att, default)
+        # Source config templates are relative to the benchmark config
+        config_path = os.path.dirname(os.path.abspath(config))
+        self.sources = {kind: os.path.join(config_path, fn) for kind, fn in self.sources.items()}
+
+    def _write_inputs(self, size, path):
+        '''
+        Draw the synthetic fires and write the input files and source configs for a size
+        '''
+        synth = SynthFires(size, self.seed, self.year)
+        inputs = {}
+        for kind, template in self.sources.items():
+            with open(template) as f:
+                config = json.load(f)
+            if kind == 'hms':
+                fn = os.path.join(path, 'hms.csv')
+                synth.hms_points().to_csv(fn, index=False)
+                area_fn = os.path.join(path, 'fire_area.shp')
+                synth.area_grid().to_file(area_fn)
+                config['clumping']['fire_area_shapefile'] = area_fn
+            elif kind == 'ground':
+                fn = os.path.join(path, 'ground.csv')
+                synth.ground_reports(self.ground_fraction).to_csv(fn, index=False)
+            elif kind == 'perimeter':
+                fn = os.path.join(path, 'perimeter.shp')
+                synth.perimeters(self.perimeter_fraction).to_file(fn)
+            else:
+                raise ValueError('Unknown synthetic source %s' %kind)
+            config['input']['filename'] = fn
+            inputs[kind] = os.path.join(path, '%s.json' %kind)
+            with open(inputs[kind], 'w') as f:
+                json.dump(config, f, indent=2)
+        return inputs
+
+    def _write_stream(self, size, path, source_names):
+        fn = os.path.join(path, 'stream.json')
+        stream = {'name': 'Benchmark %s' %size, 'start_date': '%s0101' %self.year,
+          'end_date': '%s1231' %self.year, 'sources': source_names,
+          'export_path': path, 'reconciliation_method': self.reconciliation_method}
+        with open(fn, 'w') as f:
+            json.dump(stream, f, indent=2)
+        return fn
+
+    def run_size(self, size):
+        '''
+        Generate the inputs and run the stages for one size. Returns the scenario results.
+        '''
+        path = os.path.join(self.work_path, str(size))
+        os.makedirs(path, exist_ok=True)
+        start = time.perf_counter()
+        inputs = self._write_inputs(size, path)
+        generate_s = time.perf_counter() - start
+        db = get_database(self.db_config)
+        run = Instrument(db, 'benchmark_%s' %size, {'instrument': {'report_path': path}})
+        records = {}
+        # Input records for the steps of each stage class
+        stage_records = {}
+        source_names = []
+        # The stages share one connection and transaction as in the run scripts
+        with db.session():
+            for kind, fn in inputs.items():
+                a = DataSource(fn)
+                a.write_source_tables(db, clobber=True)
+                source_names.append(a.config['name'])
+                stages = [get_stage('ingest', a.config['input']['ingest_method'], 'Ingest'),
+                  get_stage('clump', a.clump_method, 'Clump'), get_stage('assoc', a.assoc_method, 'Assoc')]
+                b = run.attach(stages[0](a.config))
+                b.load()
+                records[kind] = len(b._src)
+                stage_records.update({stage.__name__: records[kind] for stage in stages})
+                b.insert_raw_data(db, a.source_id)
+                run.attach(stages[1](a.config)).clump(db, a.source_id)
+                run.attach(stages[2](a.config)).assoc(db, a.source_id)
+            stream = self._write_stream(size, path, source_names)
+            # The reconciliation takes the records of all of the sources
+            stage_records[get_reconciliation(self.reconciliation_method).__name__] = \
+              sum(records.values())
+            with run.step(get_reconciliation(self.reconciliation_method).__name__, 'setup'):
+                a = run.attach(get_reconciliation(self.reconciliation_method)(stream, db))
+            a.purge_events(db)
+            a.reconcile(db)
+            # Time the queued writes that finish after the reconcile step
+            with run.step('DataBase', 'wait'):
+                db.wait()
+        run.write()
+        db.close()
+        # Throughput of the top level steps of the stages in input records per second. Other
+        #  steps such as the wait for the queued writes have none.
+        steps = []
+        for rec in run.steps:
+            if rec['depth'] == 0:
+                rec = dict(rec)
+                n = stage_records.get(rec['stage'])
+                rec['records_per_s'] = round(n / max(rec['wall_s'], 1e-6), 1) if n else None
+                steps.append(rec)
+        return {'size': size, 'records': records, 'generate_s': round(generate_s, 4),
+          'wall_s': round(sum([rec['wall_s'] for rec in steps]), 4),
+          'peak_rss_mb': max([rec['peak_rss_mb'] for rec in steps]), 'steps': steps}
+
+    def _run_size(self, size, conn):
+        conn.send(self.run_size(size))
+        conn.close()
+
+    def run(self):
+        '''
+        Run the sweep with each size in a fresh process. The size process is not a pool worker
+          so that the clumping can still start its own pool.
+        '''
+        ctx = get_context('fork')
+        scenarios = []
+        for size in self.sizes:
+            size = int(size)
+            print('Benchmarking %s records' %size, flush=True)
+            recv, send = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=self._run_size, args=(size, send))
+            proc.start()
+            send.close()
+            try:
+                scenarios.append(recv.recv())
+            except EOFError:
+                print('NOTE: Benchmark of %s records failed' %size)
+            proc.join()
+        return {'name': self.name, 'commit': get_commit(), 'date': datetime.now().isoformat(),
+          'python': sys.version.split()[0], 'config': self._config, 'scenarios': scenarios}
+
+def compare_results(base, new, threshold=0.1, min_time=0.5):
+    '''
+    Compare the results of two benchmark runs. A step is flagged as a regression when its wall
+      time or peak memory grows by more than the threshold. Steps that take less than the minimum
+      time in the base run are too noisy to compare on time.
+    Returns the list of regressions.
+    '''
+    regressions = []
+    base_scenarios = {scen['size']: scen for scen in base['scenarios']}
+    print('Comparing %s (%s) to %s (%s)' %(base['commit'], base['date'], new['commit'], new['date']))
+    for scen in new['scenarios']:
+        if scen['size'] not in base_scenarios:
+            continue
+        base_steps = {(rec['stage'], rec['step']): rec for rec in base_scenarios[scen['size']]['steps']}
+        print('%s records:' %scen['size'])
+        for rec in scen['steps']:
+            key = (rec['stage'], rec['step'])
+            if key not in base_steps:
+                continue
+            old = base_steps[key]
+            flags = []
+            if old['wall_s'] >= min_time and rec['wall_s'] > old['wall_s'] * (1 + threshold):
+                flags.append('time')
+            if rec['peak_rss_mb'] > old['peak_rss_mb'] * (1 + threshold):
+                flags.append('memory')
+            # Only the stage steps have a throughput
+            rate = ', %s -> %s records/s' %(old['records_per_s'], rec['records_per_s']) if \
+              old.get('records_per_s') and rec.get('records_per_s') else ''
+            print('\t%s.%s: %ss -> %ss%s, %s MB -> %s MB %s' %(key[0], key[1], old['wall_s'],
+              rec['wall_s'], rate, old['peak_rss_mb'], rec['peak_rss_mb'],
+              'REGRESSION (%s)' %', '.join(flags) if flags else ''))
+            if flags:
+                regressions.append((scen['size'], '%s.%s' %key, flags))
+    return regressions
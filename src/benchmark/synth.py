@@ -0,0 +1,141 @@
+'''
+Synthetic fire activity for the benchmarks. A population of fires is drawn around a set of
+  fire regions and the HMS detections, ground reports and perimeters are drawn from the fires
+  so that the sources overlap in space and time the way the real inputs do.
+'''
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+# Fire regions: center lon, center lat, spread in degrees, relative weight, peak day of year
+#   and the share of wildfires
+REGIONS = [(-84.0, 32.0, 1.5, 0.18, 60, 0.2), (-81.5, 28.5, 1.0, 0.08, 90, 0.3),
+  (-96.5, 38.5, 0.8, 0.12, 100, 0.1), (-91.0, 34.5, 1.2, 0.12, 280, 0.05),
+  (-90.0, 41.0, 2.0, 0.08, 290, 0.05), (-98.0, 31.0, 1.5, 0.06, 45, 0.4),
+  (-81.0, 37.0, 1.0, 0.05, 80, 0.3), (-100.0, 35.0, 1.5, 0.05, 70, 0.6),
+  (-121.0, 39.0, 1.2, 0.07, 230, 0.9), (-121.5, 45.0, 1.0, 0.06, 225, 0.8),
+  (-114.0, 46.0, 1.5, 0.07, 220, 0.9), (-110.0, 34.0, 1.5, 0.06, 160, 0.8)]
+
+class SynthFires():
+    '''
+    Draw a population of fires sized to give about n HMS detections
+    '''
+    # Average HMS detections per fire
+    DETECTS_PER_FIRE = 8
+
+    def __init__(self, n, seed=0, year=2020):
+        self.n = int(n)
+        self.year = year
+        self.rng = np.random.default_rng(seed)
+        self.fires = self._get_fires(max(self.n // self.DETECTS_PER_FIRE, 1))
+
+    def _get_fires(self, n_fires):
+        '''
+        Fire centers are clustered around the regions. Fire size is lognormal and the duration
+          grows with the size so that most fires last one or two days with a tail of long fires.
+        '''
+        rng = self.rng
+        regions = np.array(REGIONS)
+        reg = rng.choice(len(regions), n_fires, p=regions[:,3] / regions[:,3].sum())
+        df = pd.DataFrame({'fire_id': np.arange(n_fires),
+          'lon': regions[reg,0] + rng.normal(0, 1, n_fires) * regions[reg,2],
+          'lat': regions[reg,1] + rng.normal(0, 1, n_fires) * regions[reg,2]})
+        df['size'] = rng.lognormal(0, 1.3, n_fires)
+        df['duration'] = np.clip(np.rint(df['size'] * rng.lognormal(0.2, 0.6, n_fires)), 1,
+          90).astype(int)
+        df['start_day'] = np.rint(rng.normal(regions[reg,4], 40)).astype(int) % 365
+        df['fire_type'] = np.where(rng.random(n_fires) < regions[reg,5], 'WF', 'RX')
+        # Final burned area in acres
+        df['acres'] = np.round(df['size'] * df['duration'] * 150, 1)
+        df['start_date'] = pd.Timestamp(year=self.year, month=1, day=1) + \
+          pd.to_timedelta(df['start_day'], unit='D')
+        return df
+
+    def _get_top_fires(self, frac):
+        '''
+        Get the largest fraction of fires. These are the fires that get ground reports and
+          perimeters.
+        '''
+        n = max(int(len(self.fires) * frac), 1)
+        return self.fires.sort_values('acres', ascending=False).head(n).reset_index(drop=True)
+
+    def hms_points(self):
+        '''
+        Satellite detections. Detections are spread over the fire days with the spread around
+          the fire center growing as the fire grows.
+        '''
+        rng = self.rng
+        weight = (self.fires['size'] * self.fires['duration']).values
+        f = rng.choice(len(self.fires), self.n, p=weight / weight.sum())
+        fires = self.fires.iloc[f]
+        offset = (rng.random(self.n) * fires['duration'].values).astype(int)
+        spread = 0.005 * np.sqrt(offset + 1) * np.sqrt(fires['size'].values)
+        dates = fires['start_date'].values + pd.to_timedelta(offset, unit='D').values
+        df = pd.DataFrame({'Lon': np.round(fires['lon'].values + rng.normal(0, 1, self.n) * spread, 4),
+          'Lat': np.round(fires['lat'].values + rng.normal(0, 1, self.n) * spread, 4),
+          'YearDay': pd.DatetimeIndex(dates).strftime('%Y%j'),
+          'FireType': fires['fire_type'].values})
+        return df
+
+    def ground_reports(self, frac=0.05):
+        '''
+        ICS-209 style reports for the largest fires. One report per fire day up to a week with
+          the reported area growing to the final area.
+        '''
+        rng = self.rng
+        fires = self._get_top_fires(frac)
+        n_reports = np.minimum(fires['duration'].values, 7)
+        fires = fires.loc[fires.index.repeat(n_reports)].copy()
+        report = fires.groupby('fire_id').cumcount()
+        frac_done = (report + 1) / n_reports[fires.index]
+        df = pd.DataFrame({'incident number': 'SYN-%s-' %self.year + fires['fire_id'].astype(str),
+          'incident name': 'Fire ' + fires['fire_id'].astype(str),
+          'start date': fires['start_date'].dt.strftime('%Y-%m-%d'),
+          'report_date': (fires['start_date'] + pd.to_timedelta(np.ceil(frac_done *
+            (fires['duration'] - 1)), unit='D')).dt.strftime('%Y-%m-%d'),
+          'area': np.round(fires['acres'] * frac_done, 1),
+          'incident type': fires['fire_type'],
+          'latitude': np.round(fires['lat'] + rng.normal(0, 0.01, len(fires)), 4),
+          'longitude': np.round(fires['lon'] + rng.normal(0, 0.01, len(fires)), 4)})
+        return df.reset_index(drop=True)
+
+    def perimeters(self, frac=0.01, epsg=5070):
+        '''
+        Perimeter polygons for the largest fires. An irregular polygon sized to the final area on
+          the last fire day and a mid-fire perimeter for fires of four days or more.
+        '''
+        rng = self.rng
+        fires = self._get_top_fires(frac)
+        mid = fires[fires['duration'] >= 4].copy()
+        mid['acres'] = mid['acres'] / 2
+        mid['offset'] = mid['duration'] // 2
+        fires['offset'] = fires['duration'] - 1
+        fires = pd.concat((fires, mid), ignore_index=True)
+        centers = gpd.GeoSeries(gpd.points_from_xy(fires['lon'], fires['lat']),
+          crs='EPSG:4326').to_crs(epsg=epsg)
+        # Radial noise around the circle of the fire area
+        n_verts = 24
+        radius = np.sqrt(fires['acres'].values * 4046.8564224 / np.pi)
+        angle = np.linspace(0, 2 * np.pi, n_verts, endpoint=False)
+        r = radius[:,None] * np.clip(rng.normal(1, 0.25, (len(fires), n_verts)), 0.4, None)
+        x = centers.x.values[:,None] + r * np.cos(angle)
+        y = centers.y.values[:,None] + r * np.sin(angle)
+        rings = np.stack((x, y), axis=2)
+        rings = np.concatenate((rings, rings[:,:1,:]), axis=1)
+        shapes = shapely.polygons(shapely.linearrings(rings))
+        df = gpd.GeoDataFrame({'unique_id': 'SYN-%s-' %self.year + fires['fire_id'].astype(str),
+          'INCIDENT': 'Fire ' + fires['fire_id'].astype(str),
+          'DATE_': (fires['start_date'] + pd.to_timedelta(fires['offset'], unit='D')).dt.strftime('%Y-%m-%d'),
+          'GIS_ACRES': np.round(fires['acres'], 1), 'firetype': fires['fire_type']},
+          geometry=shapes, crs='EPSG:%s' %epsg)
+        return df.to_crs(epsg=4326)
+
+    def area_grid(self, step=1.0):
+        '''
+        Acres per detection pixel on a lat/lon grid over CONUS for the HMS fire area lookup
+        '''
+        lons, lats = np.meshgrid(np.arange(-125, -66, step), np.arange(24, 50, step))
+        shapes = shapely.box(lons.ravel(), lats.ravel(), lons.ravel() + step, lats.ravel() + step)
+        return gpd.GeoDataFrame({'ACRE_PIXEL': np.round(self.rng.uniform(20, 400, len(shapes)), 1)},
+          geometry=shapes, crs='EPSG:4326')
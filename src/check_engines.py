@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+'''
+Check the graph engine against the daily engine on a stream. The graph engine links the fires
+  into the connected components of the candidate pairs. The daily engine keeps a fire that links
+  with the fires of several events on a day in the event with the lowest temporary ID and does
+  not merge those events, so a daily event can only be a piece of a graph event. The check
+  allows graph events that are split into several daily events and no other differences.
+Usage: check_engines.py stream.json [db.json]
+With PostGIS the stream is left with the events of the graph engine.
+'''
+
+import sys
+from database import get_database
+from reconcile.compare import run_engines, compare_events, count_mismatches
+
+config = sys.argv[1]
+try:
+    db_config = sys.argv[2]
+except IndexError:
+    db_config = 'config/pg.json'
+db = get_database(db_config)
+runs = run_engines(['daily','graph'], config, db)
+db.close()
+summary, diffs = compare_events(runs[0]['output'], runs[1]['output'])
+print('Events: %(events_a)s daily and %(events_b)s graph, %(matched)s with the same fires, %(split_b)s graph events split into %(pieces_a)s daily events' %summary)
+for i, row in diffs[~ diffs['status'].isin(('split_b','piece_a'))].iterrows():
+    print('\t%s: %s' %(row['status'], row['member_key']))
+if count_mismatches(summary, splits=True):
+    print('The daily and graph events differ by more than the split graph events')
+    sys.exit(1)
+print('The daily events are the graph events or pieces of them')
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+'''
+Check that incremental reconciliation gives the same events as a full run. The stream is
+  reconciled from scratch, a random share of the events is deleted so that their fires are not
+  in an event, and the stream is reconciled again incrementally. The events are matched on
+  their member fires.
+Usage: check_incremental.py stream.json [engine] [db.json]
+  eg. check_incremental.py stream.json graph config/local.json
+With PostGIS the stream is left with the events of the incremental run.
+'''
+
+import sys
+import numpy as np
+from database import get_database
+from reconcile.compare import load_engine, run_engine, get_stream_events, compare_events, \
+  count_mismatches
+
+# Share of the events deleted before the incremental run
+fraction = 0.3
+config = sys.argv[1]
+try:
+    engine = sys.argv[2]
+except IndexError:
+    engine = 'daily'
+try:
+    db_config = sys.argv[3]
+except IndexError:
+    db_config = 'config/pg.json'
+db = get_database(db_config)
+full = run_engine(engine, config, db)
+events = full['output'][0]
+rng = np.random.default_rng(0)
+drop = rng.choice(events['id'].values, int(len(events) * fraction), replace=False)
+a = load_engine(engine)(config, db)
+a._delete_events(db, tuple([int(x) for x in drop]))
+print('Deleted %s of %s events' %(len(drop), len(events)))
+a.write_mode = 'replace'
+a.incremental = True
+a.reconcile(db)
+summary, diffs = compare_events(full['output'], get_stream_events(db, a.stream_id))
+db.close()
+print('Events: %(events_a)s in the full run and %(events_b)s after the incremental run, %(matched)s with the same fires, %(only_a)s only in the full run, %(only_b)s only in the incremental run' %summary)
+for i, row in diffs.iterrows():
+    print('\t%s: %s' %(row['status'], row['member_key']))
+if count_mismatches(summary):
+    print('The incremental run differs from the full run')
+    sys.exit(1)
+print('The incremental run gives the same events as the full run')
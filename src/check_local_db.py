@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+'''
+Check the GeoParquet persistence of the local storage backend. The tables are saved and
+  reloaded and compared with the tables in memory, then a stream is reconciled on both copies
+  and the tables and sequences are compared again. The saved tables are not changed.
+Usage: check_local_db.py stream.json [local.json]
+'''
+
+import sys
+import json
+import shutil
+import tempfile
+from database import get_database
+from database.local import LocalDataBase
+from reconcile import get_reconciliation
+
+config = sys.argv[1]
+try:
+    db_config = sys.argv[2]
+except IndexError:
+    db_config = 'config/local.json'
+with open(config) as f:
+    method = json.load(f).get('reconciliation_method', 'daily')
+db = get_database(db_config)
+if not isinstance(db, LocalDataBase):
+    raise ValueError('%s is not a local storage backend config' %db_config)
+path = tempfile.mkdtemp(prefix='local_db_')
+try:
+    db.save(path)
+    copy = LocalDataBase(db_config, path)
+    diffs = db.compare(copy)
+    print('Saved and reloaded %s tables: %s differences' %(len(db.tables), len(diffs)))
+    for a in (db, copy):
+        rec = get_reconciliation(method)(config, a)
+        if rec.write_mode != 'diff' and not rec.incremental:
+            rec.purge_events(a)
+        rec.reconcile(a)
+    # The event unique IDs are random
+    diffs += db.compare(copy, ignore=('unique_id',))
+finally:
+    shutil.rmtree(path)
+for diff in diffs:
+    print('\t%s' %diff)
+if diffs:
+    print('The reloaded tables differ')
+    sys.exit(1)
+print('The reloaded tables and sequences are the same after reconciling')
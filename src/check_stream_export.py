@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+'''
+Check that the streamed BSF export writes the same files as the frame export. Both exports of a
+  stream are written as uncompressed CSV to temporary directories and compared byte for byte.
+  The streamed export needs the PostGIS backend.
+Usage: check_stream_export.py stream.json
+'''
+
+import os
+import sys
+import shutil
+import filecmp
+import tempfile
+from database import get_database
+from exports import Export
+from exports.stream import StreamExport
+
+config = sys.argv[1]
+db = get_database('config/pg.json')
+StreamExport.check_backend(db)
+paths = [tempfile.mkdtemp(prefix='export_') for export in (Export, StreamExport)]
+try:
+    for export, path in zip((Export, StreamExport), paths):
+        a = export(config, db)
+        # Only the daily CSV files are written by both exports
+        a.export_path = path
+        a.export_formats = ['csv',]
+        a.export_shapes = None
+        a.export_incremental = False
+        a.export_compression = None
+        a.export(db)
+    fns = sorted(set(os.listdir(paths[0])) | set(os.listdir(paths[1])))
+    same, differ, missing = filecmp.cmpfiles(paths[0], paths[1], fns, shallow=False)
+finally:
+    for path in paths:
+        shutil.rmtree(path)
+db.close()
+print('%s files: %s the same, %s differ, %s written by only one export' %(len(fns), len(same),
+  len(differ), len(missing)))
+for fn in differ + missing:
+    print('\t%s' %fn)
+if differ or missing:
+    sys.exit(1)
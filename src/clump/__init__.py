@@ -3,13 +3,16 @@ from multiprocessing import Pool
 from functools import partial
 import pandas as pd
 import geopandas as gpd
+import shapely
 from numpy import array_split
-from sqlalchemy import text
 from datetime import datetime
 
 class Clump():
     '''
     '''
+    # Methods recorded as steps by the run instrumentation
+    steps = ['clump','_set_area','_write_clump_data','_set_centroid','_update_raw_id']
+
     def __init__(self, config):
         self._config = config
         self._method = self._config['clump_method']
@@ -18,21 +21,26 @@ class Clump():
         except KeyError as e:
             raise ValueError('Missing radius is config file')
 
-    def _get_next_id(self, db):
-        with db.engine.connect() as conn:
-            result = conn.execute(text("SELECT nextval('clump_seq')"))
-        return result.first()[0]
-
     def _write_clump_data(self, db):
         '''
         Push the raw data to the postgres DB
         '''
         print('\nClumped into %s clumps' %len(self.clumps))
-        seq = pd.Series([self._get_next_id(db) for x in range(len(self.clumps))])
-        self.clumps['id'] = seq
+        self.clumps['id'] = db.next_ids('clump_seq', len(self.clumps))
         cols = ['id','area','end_date','shape','start_date','source_id']
         self.clumps.set_geometry('shape', inplace=True, crs='EPSG:%s' %db.srid)
-        self.clumps[cols].to_postgis(name='clump', con=db.engine, if_exists='append', index=False)
+        db.write(self.clumps[cols], 'clump')
+        self._set_centroid(db)
+
+    def _set_centroid(self, db):
+        '''
+        Store the EPSG:4326 centroid of the new clumps. Clump shapes do not change after clumping
+          so reconciliation and export use the stored centroid.
+        '''
+        centroid = shapely.centroid(self.clumps['shape'].to_crs(epsg=4326).values)
+        df = gpd.GeoDataFrame({'id': self.clumps['id'].values, 'centroid': centroid}, 
+          geometry='centroid', crs='EPSG:4326')
+        db.update(df, 'clump')
 
     def _update_raw_id(self, db, source_id):
         '''
@@ -40,10 +48,8 @@ class Clump():
         '''
         self.srcmap.rename(columns={'id': 'clump_id'}, inplace=True)
         self.srcmap.rename(columns={'rawdata_id': 'id'}, inplace=True)
-        with db.engine.connect() as conn:
-            conn.execute(text("CREATE TEMP TABLE clumplist (id INTEGER, clump_id INTEGER) ON COMMIT DROP"))
-            self.srcmap.to_sql(name='clumplist', con=conn, if_exists='replace', index=False)
-            conn.execute(text("UPDATE raw_data SET clump_id = clumplist.clump_id FROM clumplist WHERE clumplist.id = raw_data.id"))
+        db.update(self.srcmap[['id','clump_id']], 'raw_data')
+        db.analyze('clump', 'raw_data')
 
     def _set_area():
         '''
@@ -65,9 +71,7 @@ class Clump():
         Default method to clump the raw data by single day in space with a clumping radius.
         Generally used for HMS satellite.
         '''
-        with db.engine.connect() as conn:
-            df = gpd.read_postgis(text("SELECT * from raw_data WHERE source_id = '%s'" %source_id),
-              con=conn, geom_col='shape')
+        df = db.select('raw_data', where={'source_id': source_id}, geom_col='shape')
         bar = Bar('Clumping', max=len(df['start_date'].drop_duplicates())) 
         self.srcmap = pd.DataFrame()
         for day in list(df['start_date'].drop_duplicates()):
@@ -82,7 +86,8 @@ class Clump():
             if len(today) < n_proc:
                 n_proc = len(today)
             with Pool(n_proc) as pool:
-                for res in pool.map(clump_intersect, array_split(today[['shape','id']], n_proc)):
+                chunks = [today[['shape','id']].iloc[idx] for idx in array_split(range(len(today)), n_proc)]
+                for res in pool.map(clump_intersect, chunks):
                     ovr_res.append(res)
             pool.close()
             # print(day, datetime.now()) # debug
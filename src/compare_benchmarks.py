@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+'''
+Compare two benchmark runs and flag the regressions. Each run is a results file from
+  run_benchmark.py or a git commit. Commits are checked out to a temporary worktree and
+  benchmarked with the sweep config.
+Usage: compare_benchmarks.py base new [sweep.json]
+Exits with status 1 when there are regressions.
+'''
+
+import os.path
+import sys
+import json
+import tempfile
+import subprocess
+from benchmark import Benchmark, compare_results
+
+def get_results(run, sweep):
+    if os.path.exists(run):
+        with open(run) as f:
+            return json.load(f)
+    if not sweep:
+        raise ValueError('A sweep config is needed to benchmark commit %s' %run)
+    with tempfile.TemporaryDirectory() as tmp:
+        tree = os.path.join(tmp, 'tree')
+        fn = os.path.join(tmp, 'results.json')
+        subprocess.run(['git','worktree','add','--detach',tree,run], check=True)
+        try:
+            subprocess.run([sys.executable,'run_benchmark.py',os.path.abspath(sweep),fn],
+              cwd=os.path.join(tree, 'src'), check=True)
+        finally:
+            subprocess.run(['git','worktree','remove','--force',tree], check=True)
+        with open(fn) as f:
+            return json.load(f)
+
+sweep = sys.argv[3] if len(sys.argv) > 3 else ''
+base = get_results(sys.argv[1], sweep)
+new = get_results(sys.argv[2], sweep)
+if sweep:
+    a = Benchmark(sweep)
+    threshold, min_time = a.regression_threshold, a.min_time
+else:
+    threshold = new['config'].get('regression_threshold', 0.1)
+    min_time = new['config'].get('min_time', 0.5)
+regressions = compare_results(base, new, threshold, min_time)
+if regressions:
+    print('%s regressions over %s%%:' %(len(regressions), int(threshold * 100)))
+    for size, step, flags in regressions:
+        print('\t%s records %s: %s' %(size, step, ', '.join(flags)))
+    sys.exit(1)
+print('No regressions over %s%%' %int(threshold * 100))
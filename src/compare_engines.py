@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+'''
+Run two reconciliation engines on the same stream config and fires and compare the events,
+  run times and peak memory. An engine is a reconciliation method name or the path of a module
+  file with a Reconciliation class.
+Usage: compare_engines.py stream.json engine_a engine_b [differences.csv]
+  eg. compare_engines.py stream.json reconcile/__init__.old.py graph
+The module file engines (eg. __init__.old.py) use SQL directly and need the PostGIS backend.
+With PostGIS the stream is left with the events of the second engine.
+'''
+
+import sys
+from database import get_database
+from reconcile.compare import run_engines, compare_events
+
+config = sys.argv[1]
+engines = sys.argv[2:4]
+db = get_database('config/pg.json')
+runs = run_engines(engines, config, db)
+print('Run times:')
+for run in runs:
+    rec = run['step']
+    print('\t%s: %ss wall, %ss cpu, %s round trips, %s MB peak, %s MB growth' %(run['engine'],
+      rec['wall_s'], rec['cpu_s'], rec['round_trips'], rec['peak_rss_mb'], rec['rss_growth_mb']))
+summary, diffs = compare_events(runs[0]['output'], runs[1]['output'])
+print('Events: %(events_a)s and %(events_b)s, %(matched)s with the same fires, %(only_a)s only in the first, %(only_b)s only in the second' %summary)
+print('Unmatched events split into several events of the other engine: %(split_a)s of the first into %(pieces_b)s, %(split_b)s of the second into %(pieces_a)s' %summary)
+print('Matched events that differ: %(dates_differ)s in dates, %(area_differ)s in area (max %(max_area_diff).3g), %(shape_differ)s in shape (max %(max_shape_diff).3g), %(days_differ)s in event day fractions (max %(max_frac_diff).3g)' %summary)
+if len(sys.argv) > 4:
+    diffs.to_csv(sys.argv[4], index=False)
+    print('Differences: %s' %sys.argv[4])
+db.close()
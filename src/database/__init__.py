@@ -0,0 +1,525 @@
+import json
+import time
+import uuid
+import threading
+import importlib
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from sqlalchemy import create_engine, event, text
+
+class DataBase():
+    '''
+    Database interface. The default backend is PostGIS.
+    The stages use the table operations (select, write, update, delete, delete_cascade and
+      next_ids), the incremental fire and event queries (select_new_fires and
+      select_events_near) and the detect_stats aggregate so that another storage backend can
+      stand in for PostGIS.
+    The operations check out a connection from the engine pool. Within a session the stages of
+      a run share one connection and transaction.
+    The filter values are bound as parameters, with lists bound as arrays, so that the text of a
+      repeated query does not change with the values. The default psycopg2 driver interpolates
+      the values on the client. The psycopg (3) driver can be set in the DB config to bind the
+      values on the server, which prepares a query that is run prepare_threshold times on a
+      connection. measure_planning.py compares the drivers on a full reconcile.
+    Table operations can be queued on an I/O thread with submit so that the DB works while the
+      stage computes.
+    '''
+    # The DB can be opened separately by each worker process
+    multiprocess = True
+    # The DB runs SQL queries for the stages and scripts that need the server
+    sql = True
+
+    def __init__(self, config):
+        self.load_config(config)
+        self.srid = self._config['epsg']
+        self.db = self._config['dbname']
+        self._args = (self._config['pguser'], self._config['pgpass'], self._config['pgserver'],
+          self._config['dbport'], self.db)
+        # Optional attribute key: default pairs
+        atts = {'pool_size': 5, 'max_overflow': 10, 'driver': 'psycopg2', 'prepare_threshold': 5,
+          'async_io': True}
+        for att, default in atts.items():
+            try:
+                setattr(self, att, self._config[att])
+            except KeyError:
+                setattr(self, att, default)
+        # Only psycopg 3 binds the parameters on the server and can prepare the statements
+        connect_args = {'prepare_threshold': self.prepare_threshold} if self.driver == 'psycopg' else {}
+        self.engine = create_engine('postgresql+%s://%s:%s@%s:%s/%s' %((self.driver,) + self._args),
+          pool_size=self.pool_size, max_overflow=self.max_overflow, connect_args=connect_args)
+        event.listen(self.engine, 'connect', self._on_connect)
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        # Running count of the queries and writes sent to the DB and of the data read back
+        self.round_trips = 0
+        self.rows_read = 0
+        self.bytes_read = 0
+        self.rows_written = 0
+        # Connection counters
+        self.connections_opened = 0
+        self.checkouts = 0
+        self.checkout_wait_s = 0
+        self.max_checkout_wait_s = 0
+        self.queries = 0
+        self._statements = set()
+        # Connection shared by the stages in a session
+        self._conn = None
+        self._init_io()
+
+    def load_config(self, config):
+        with open(config) as f:
+            self._config = json.load(f)
+
+    def close(self):
+        '''
+        Finish the queued operations and release the connections at the end of a run
+        '''
+        self.wait()
+        if self._io is not None:
+            self._io.shutdown()
+        self.engine.dispose()
+
+    def _init_io(self):
+        # Table operations queued on the I/O thread and their run and wait times
+        self._io = None
+        self._io_ident = None
+        self._pending = []
+        self.io_submitted = 0
+        self.io_s = 0
+        self.io_wait_s = 0
+        # The counters are updated from the stage and I/O threads
+        self._lock = threading.Lock()
+        # The session connection is used by one thread at a time. The depth of the connect
+        #   blocks that a thread has open on it is kept per thread.
+        self._conn_lock = threading.RLock()
+        self._local = threading.local()
+
+    def _count(self, **counts):
+        '''
+        Add to the counters, eg. self._count(round_trips=1)
+        '''
+        with self._lock:
+            for att, n in counts.items():
+                setattr(self, att, getattr(self, att) + n)
+
+    def submit(self, fn, *args, **kwargs):
+        '''
+        Queue a table operation on the I/O thread and return a future,
+          eg. db.submit(db.write, df, 'event')
+        The queued operations run one at a time in order on the run connection so that each one
+          sees the earlier writes. A table operation called directly waits for the queue first.
+        An operation submitted while the thread has the session connection open runs right away
+          as the I/O thread cannot use the connection until the block ends.
+        '''
+        self.io_submitted += 1
+        if not self.async_io or getattr(self._local, 'depth', 0):
+            start = time.perf_counter()
+            future = Future()
+            future.set_result(self._run_io(fn, args, kwargs))
+            self.io_wait_s += time.perf_counter() - start
+            return future
+        if self._io is None:
+            self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-io')
+        future = self._io.submit(self._run_io, fn, args, kwargs)
+        self._pending.append(future)
+        return future
+
+    def _run_io(self, fn, args, kwargs):
+        self._io_ident = threading.get_ident()
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._count(io_s=time.perf_counter() - start)
+
+    def _on_io_thread(self):
+        return self._io is not None and threading.get_ident() == self._io_ident
+
+    def pending(self):
+        '''
+        Get the number of queued operations that have not finished
+        '''
+        return len([future for future in self._pending if not future.done()])
+
+    def wait(self, raise_errors=True):
+        '''
+        Wait for the queued operations. Raises the error of the first failed operation.
+        '''
+        if not self._pending or self._on_io_thread():
+            return
+        start = time.perf_counter()
+        pending, self._pending = self._pending, []
+        errors = [future.exception() for future in pending]
+        self.io_wait_s += time.perf_counter() - start
+        errors = [e for e in errors if e is not None]
+        if errors and raise_errors:
+            raise errors[0]
+
+    def io_stats(self):
+        '''
+        Get the time spent on the queued operations and the part of it that overlapped with the
+          stages computing rather than waiting on the queue
+        '''
+        overlap_s = max(self.io_s - self.io_wait_s, 0)
+        return {'submitted': self.io_submitted, 'io_s': round(self.io_s, 4),
+          'wait_s': round(self.io_wait_s, 4), 'overlap_s': round(overlap_s, 4),
+          'overlap_pct': round(100 * overlap_s / self.io_s, 1) if self.io_s else 0}
+
+    def _on_connect(self, dbapi_conn, record):
+        self._count(connections_opened=1)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        with self._lock:
+            self.queries += 1
+            self._statements.add(statement)
+
+    def connection_stats(self):
+        '''
+        Get the connections opened, the pool checkout wait and the queries per connection. The
+          distinct statements are the query texts that the server has to parse and plan.
+        '''
+        return {'pool_size': self.pool_size, 'max_overflow': self.max_overflow,
+          'connections_opened': self.connections_opened, 'checkouts': self.checkouts,
+          'checkout_wait_s': round(self.checkout_wait_s, 4),
+          'max_checkout_wait_s': round(self.max_checkout_wait_s, 4), 'queries': self.queries,
+          'queries_per_connection': round(self.queries / max(self.connections_opened, 1), 1),
+          'distinct_statements': len(self._statements)}
+
+    def require_sql(self, user):
+        '''
+        Check up front that the backend can run the SQL queries of a stage or script
+        '''
+        if not self.sql:
+            raise RuntimeError('%s requires the PostGIS backend' %user)
+
+    @contextmanager
+    def connect(self, begin=False, shared=True):
+        '''
+        Check out a connection from the pool and return it when the block ends. Within a session
+          the session connection is used.
+        begin: run the block in a transaction that is committed when the block ends
+        shared: use the session connection after the queued operations. Work that does not
+          depend on the run transaction can check out its own connection.
+        '''
+        if shared:
+            self.wait()
+        if shared and self._conn is not None:
+            # The stage thread only gets the session connection after the queue has finished
+            #   and the I/O thread only while the stage thread waits on the queue. The lock
+            #   makes sure that the connection is never used by both threads.
+            with self._conn_lock:
+                self._local.depth = getattr(self._local, 'depth', 0) + 1
+                try:
+                    yield self._conn
+                finally:
+                    self._local.depth -= 1
+            return
+        start = time.perf_counter()
+        conn = self.engine.connect()
+        wait_s = time.perf_counter() - start
+        with self._lock:
+            self.checkouts += 1
+            self.checkout_wait_s += wait_s
+            self.max_checkout_wait_s = max(self.max_checkout_wait_s, wait_s)
+        with conn:
+            if begin:
+                with conn.begin():
+                    yield conn
+            else:
+                yield conn
+
+    @contextmanager
+    def session(self):
+        '''
+        Share one connection and transaction between the stages of a run. The run is committed
+          when the block ends and rolled back on an error.
+        '''
+        if self._conn is not None:
+            yield self
+            return
+        with self.connect(begin=True) as conn:
+            self._conn = conn
+            try:
+                yield self
+                # Commit after the queued operations
+                self.wait()
+            finally:
+                self.wait(raise_errors=False)
+                self._conn = None
+
+    def read_sql(self, q, geom_col=None, params=None):
+        '''
+        Read a query into a dataframe. Returns a geodataframe when a geometry column is set.
+        '''
+        self._count(round_trips=1)
+        with self.connect() as conn:
+            if geom_col:
+                df = gpd.read_postgis(q, con=conn, geom_col=geom_col, params=params)
+            else:
+                df = pd.read_sql(q, con=conn, params=params)
+        self._count(rows_read=len(df), bytes_read=int(df.memory_usage(deep=True).sum()))
+        return df
+
+    def execute(self, q, params=None):
+        '''
+        Execute a statement in its own transaction. Returns the rows for statements that
+          return rows.
+        '''
+        self._count(round_trips=1)
+        with self.connect(begin=True) as conn:
+            result = conn.execute(q, params or {})
+            if result.returns_rows:
+                return result.fetchall()
+
+    def _sql_param(self, val):
+        '''
+        Convert a numpy or pandas value to the python type that the driver binds
+        '''
+        if isinstance(val, np.generic):
+            return val.item()
+        elif isinstance(val, pd.Timestamp):
+            return val.to_pydatetime()
+        return val
+
+    def _sql_date(self, val):
+        '''
+        Convert a config date such as 20200101 to a date parameter
+        '''
+        return pd.to_datetime(val).date()
+
+    def _where(self, where=None, exclude=None, dates=None, date_cols=('start_date','end_date')):
+        '''
+        Build the WHERE clause and the parameters for the table operations
+        where: column and value or list of values to match
+        exclude: column and list of values to leave out
+        dates: start and end date of a date range that overlaps the date range of the date columns
+        '''
+        conds = []
+        params = {}
+        for col, vals in (where or {}).items():
+            param = 'where_%s' %col
+            if np.ndim(vals) == 0:
+                conds.append('%s = :%s' %(col, param))
+                params[param] = self._sql_param(vals)
+            elif len(vals) == 0:
+                conds.append('FALSE')
+            else:
+                conds.append('%s = ANY(:%s)' %(col, param))
+                params[param] = [self._sql_param(x) for x in vals]
+        for col, vals in (exclude or {}).items():
+            if len(vals) > 0:
+                param = 'exclude_%s' %col
+                conds.append('%s <> ALL(:%s)' %(col, param))
+                params[param] = [self._sql_param(x) for x in vals]
+        if dates:
+            params['date_start'] = self._sql_date(dates[0])
+            params['date_end'] = self._sql_date(dates[1])
+        if dates and date_cols[0] == date_cols[1]:
+            # A single date column can use a btree index on the column
+            conds.append('%s BETWEEN :date_start AND :date_end' %date_cols[0])
+        elif dates:
+            # Matches the date range expression indexes
+            conds.append("daterange(%s::date, %s::date, '[]') && daterange(:date_start, :date_end, '[]')"
+              %(date_cols[0], date_cols[1]))
+            # The same overlap as bounds on the columns that a btree index can use
+            conds.append('%s < :date_end + 1 AND %s >= :date_start' %(date_cols[0], date_cols[1]))
+        if conds:
+            return ' WHERE ' + ' AND '.join(conds), params
+        return '', params
+
+    def select(self, name, cols=None, where=None, exclude=None, dates=None,
+      date_cols=('start_date','end_date'), geom_col=None):
+        '''
+        Select the columns from a table for the rows that match the filters.
+        Returns a geodataframe when a geometry column is set.
+        '''
+        q, params = self._select_sql(name, cols, where, exclude, dates, date_cols)
+        return self.read_sql(text(q), geom_col, params)
+
+    def _select_sql(self, name, cols=None, where=None, exclude=None, dates=None,
+      date_cols=('start_date','end_date')):
+        '''
+        Build the SELECT statement and the parameters for the table operations
+        '''
+        if cols:
+            cols = ', '.join(cols)
+        else:
+            cols = '*'
+        where, params = self._where(where, exclude, dates, date_cols)
+        return 'SELECT %s FROM %s' %(cols, name) + where, params
+
+    def delete(self, name, where):
+        '''
+        Delete the rows of a table that match the filter
+        '''
+        where, params = self._where(where)
+        self.execute(text('DELETE FROM %s' %name + where), params)
+
+    def delete_cascade(self, name, children, where=None, exclude=None, dates=None,
+      date_cols=('start_date','end_date'), key='id'):
+        '''
+        Delete the rows of a table that match the filters and the rows of the child tables that
+          reference them in one transaction. Returns the number of rows deleted from the table.
+        children: child table and the column that references the key column of the table
+        The keys to delete are collected in a temporary table so that each delete is a join.
+        '''
+        self._count(round_trips=1)
+        where, params = self._where(where, exclude, dates, date_cols)
+        with self.connect(begin=True) as conn:
+            conn.execute(text('CREATE TEMP TABLE delete_keys ON COMMIT DROP AS SELECT %s FROM %s \
+              WITH NO DATA' %(key, name)))
+            conn.execute(text('INSERT INTO delete_keys SELECT %s FROM %s' %(key, name) + where), params)
+            conn.execute(text('ANALYZE delete_keys'))
+            for child, col in children.items():
+                conn.execute(text('DELETE FROM %s USING delete_keys WHERE %s.%s = delete_keys.%s'
+                  %(child, child, col, key)))
+            result = conn.execute(text('DELETE FROM %s USING delete_keys WHERE %s.%s = delete_keys.%s'
+              %(name, name, key, key)))
+            # Drop the temporary table now as a session only commits at the end of the run
+            conn.execute(text('DROP TABLE delete_keys'))
+            return result.rowcount
+
+    def stream_sql(self, q, batch_size=10000, params=None):
+        '''
+        Read a query through a server-side cursor. Yields the rows in batches so that only one
+          batch is held in memory.
+        '''
+        self._count(round_trips=1)
+        with self.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(q,
+              params or {})
+            for rows in result.partitions():
+                self._count(rows_read=len(rows))
+                yield rows
+
+    def select_new_fires(self, source_ids, stream_id, dates, cols=None):
+        '''
+        Select the fires of the sources in the date range that are not yet part of an event in
+          the stream. The fires already in an event are left out with an anti-join.
+        '''
+        q, params = self._select_sql('fire', cols, where={'source_id': source_ids}, dates=dates)
+        q += ''' AND NOT EXISTS (SELECT 1 FROM event_fires ef JOIN event e ON e.id = ef.event_id
+          WHERE ef.fire_id = fire.id AND e.reconciliationstream_id = :stream)'''
+        params['stream'] = self._sql_param(stream_id)
+        geom_col = 'shape' if not cols or 'shape' in cols else None
+        return self.read_sql(text(q), geom_col, params)
+
+    def select_events_near(self, stream_id, fires):
+        '''
+        Select the IDs of the events in the stream with a member fire that is within the distance
+          of any of the fires and overlaps the fire dates. The fires are a geodataframe with the
+          shape, distance, start_date and end_date. The fires are bound as arrays and joined to
+          the member fires in the DB so that only the matching event IDs come back.
+        '''
+        q = '''SELECT DISTINCT e.id FROM event e
+        JOIN event_fires ef ON ef.event_id = e.id
+        JOIN fire x ON x.id = ef.fire_id
+        JOIN unnest(:shapes, :distances, :starts, :ends) AS f(shape, distance, start_date, end_date)
+          ON ST_DWithin(x.shape, ST_GeomFromWKB(f.shape, :srid), f.distance)
+          AND daterange(x.start_date::date, x.end_date::date, '[]') &&
+            daterange(f.start_date, f.end_date, '[]')
+        WHERE e.reconciliationstream_id = :stream'''
+        params = {'shapes': list(shapely.to_wkb(fires['shape'].values)),
+          'distances': [float(x) for x in fires['distance']],
+          'starts': [self._sql_date(x) for x in fires['start_date']],
+          'ends': [self._sql_date(x) for x in fires['end_date']],
+          'srid': int(self.srid), 'stream': self._sql_param(stream_id)}
+        return self.read_sql(text(q), params=params)
+
+    def detect_stats(self, source_ids, stream_id, dates):
+        '''
+        Get the satellite detect count and mean VIIRS FRP by event and detect date for the
+          events of a stream in one aggregate query. The detects are linked to the events
+          through their clumps and fires.
+        '''
+        q, params = self.detect_stats_sql(source_ids, stream_id, dates)
+        return self.read_sql(text(q), params=params)
+
+    def detect_stats_sql(self, source_ids, stream_id, dates):
+        '''
+        Build the detect count and mean VIIRS FRP query and the parameters for detect_stats
+        '''
+        q = '''WITH detects AS (
+          SELECT r.id, r.start_date, ef.event_id FROM raw_data r
+          JOIN clump c ON c.id = r.clump_id
+          JOIN event_fires ef ON ef.fire_id = c.fire_id
+          JOIN event e ON e.id = ef.event_id
+          WHERE r.source_id = ANY(:sources) AND e.reconciliationstream_id = :stream
+            AND r.start_date >= :start AND r.start_date < :end + 1),
+        viirs AS (
+          SELECT f.rawdata_id, NULLIF(f.attr_value, '')::double precision AS frp
+          FROM data_attribute f
+          WHERE f.name = 'FRP' AND EXISTS (SELECT 1 FROM data_attribute m
+            WHERE m.rawdata_id = f.rawdata_id AND m.name = 'Method' AND m.attr_value = 'VIIRS'))
+        SELECT n.event_id, n.start_date, n.detect_cnt, f.frp FROM
+          (SELECT event_id, start_date, COUNT(*) AS detect_cnt FROM detects
+            GROUP BY event_id, start_date) n
+        LEFT JOIN
+          (SELECT d.event_id, d.start_date, AVG(v.frp) AS frp FROM detects d
+            JOIN viirs v ON v.rawdata_id = d.id WHERE v.frp > 0
+            GROUP BY d.event_id, d.start_date) f
+        USING (event_id, start_date)'''
+        return q, {'sources': [self._sql_param(x) for x in source_ids],
+          'stream': self._sql_param(stream_id), 'start': self._sql_date(dates[0]),
+          'end': self._sql_date(dates[1])}
+
+    def analyze(self, *names):
+        '''
+        Update the planner statistics of the tables after a bulk load
+        '''
+        self.execute(text('ANALYZE %s' %', '.join(names)))
+
+    def next_ids(self, seq, n=1):
+        '''
+        Get the next n IDs from a sequence in one query
+        '''
+        if n == 0:
+            return []
+        self._count(round_trips=1)
+        q = text('SELECT nextval(CAST(:seq AS regclass)) FROM generate_series(1, :n)')
+        # Sequences are not transactional so the IDs do not wait for the queued operations
+        with self.connect(begin=True, shared=False) as conn:
+            return [int(row[0]) for row in conn.execute(q, {'seq': seq, 'n': int(n)})]
+
+    def write(self, df, name):
+        '''
+        Append a dataframe to a table. Geodataframes are written with their geometry.
+        '''
+        self._count(round_trips=1, rows_written=len(df))
+        with self.connect(begin=True) as conn:
+            if isinstance(df, gpd.GeoDataFrame):
+                df.to_postgis(name=name, con=conn, if_exists='append', index=False)
+            else:
+                df.to_sql(name=name, con=conn, if_exists='append', index=False)
+
+    def update(self, df, name, key='id'):
+        '''
+        Update the rows of a table from a dataframe matched on the key column. The dataframe is
+          written to a staging table and applied with a single UPDATE in one transaction.
+        '''
+        self._count(round_trips=1, rows_written=len(df))
+        stage = 'stage_%s' %uuid.uuid4().hex[:12]
+        cols = ', '.join(['%s = %s.%s' %(col, stage, col) for col in df.columns if col != key])
+        with self.connect(begin=True) as conn:
+            if isinstance(df, gpd.GeoDataFrame):
+                df.to_postgis(name=stage, con=conn, index=False)
+            else:
+                df.to_sql(name=stage, con=conn, index=False)
+            conn.execute(text('UPDATE %s SET %s FROM %s WHERE %s.%s = %s.%s' %(name, cols, stage,
+              name, key, stage, key)))
+            conn.execute(text('DROP TABLE %s' %stage))
+
+def get_database(config):
+    '''
+    Open the storage backend set in the DB config. Defaults to PostGIS.
+    '''
+    with open(config) as f:
+        backend = json.load(f).get('backend', 'postgis').lower()
+    if backend == 'postgis':
+        return DataBase(config)
+    else:
+        backend_module = importlib.import_module('database.%s' %backend)
+        return getattr(backend_module, '%sDataBase' %backend.capitalize())(config)
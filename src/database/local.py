@@ -0,0 +1,398 @@
+'''
+Local storage backend. Tables are held in memory as dataframes and optionally saved to and
+  loaded from a directory of (Geo)Parquet files so that a full ingest, reconcile and export run
+  can work without a database.
+'''
+import os.path
+import json
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from . import DataBase
+
+class LocalDataBase(DataBase):
+    '''
+    In-memory tables with the same table operations and ID sequences as the PostGIS backend
+    '''
+    # Each process would hold its own copy of the tables
+    multiprocess = False
+    # There is no server to run SQL queries
+    sql = False
+
+    # Table columns, geometry columns and date columns for the tables used by the stages
+    tables = {
+      'raw_data': ['id','area','end_date','shape','start_date','source_id','clump_id'],
+      'data_attribute': ['id','attr_value','name','rawdata_id'],
+      'clump': ['id','area','end_date','shape','start_date','source_id','fire_id','centroid'],
+      'fire': ['id','probability','unique_id','source_id','area','shape','fire_type','fire_name',
+        'start_date','end_date'],
+      'event': ['id','create_date','display_name','end_date','outline_shape','probability',
+        'start_date','total_area','unique_id','reconciliationstream_id','fire_type'],
+      'event_fires': ['fire_id','tmp_event','event_id'],
+      'event_day': ['id','daily_area','event_date','event_id','clump_id','location'],
+      'source': ['id','assoc_method','clump_method','geometry_type','name','probability_method',
+        'name_slug','new_data_policy','granularity','fire_name_field','latest_data',
+        'ingest_method','fire_type_method'],
+      'default_weighting': ['id','detection_rate','false_alarm_rate','growth_weight',
+        'location_weight','shape_weight','size_weight','location_uncertainty',
+        'start_date_uncertainty','end_date_uncertainty','name_weight','type_weight'],
+      'reconciliation_stream': ['id','name','reconciliation_method','name_slug','auto_reconcile']
+    }
+    geom_cols = {'raw_data': ['shape',], 'clump': ['shape','centroid'], 'fire': ['shape',],
+      'event': ['outline_shape',], 'event_day': ['location',]}
+    # Geometry columns stored in EPSG:4326 rather than the DB projection
+    latlon_cols = ('centroid','location')
+    date_cols = ('start_date','end_date','create_date','event_date','latest_data')
+    # Columns filled from a sequence when they are not written. Matches SERIAL in PostGIS.
+    serial = {'data_attribute': 'data_attribute_id_seq'}
+
+    def __init__(self, config, path=None):
+        self.load_config(config)
+        self.srid = self._config['epsg']
+        # The path can be set to open a copy of the tables saved elsewhere
+        self.db = path or self._config.get('path', '')
+        if self.db:
+            try:
+                import pyarrow
+            except ImportError:
+                raise ValueError('Saving the local storage backend tables needs the pyarrow package')
+        self.round_trips = 0
+        self.rows_read = 0
+        self.bytes_read = 0
+        self.rows_written = 0
+        self._tables = {}
+        self._seqs = {}
+        # The in-memory tables are not thread safe so queued operations run when submitted
+        self.async_io = False
+        self._init_io()
+        if self.db and os.path.exists(os.path.join(self.db, 'sequences.json')):
+            with open(os.path.join(self.db, 'sequences.json')) as f:
+                self._seqs = json.load(f)
+
+    def close(self):
+        '''
+        Save the tables and sequences when a path is set
+        '''
+        if self.db:
+            self.save(self.db)
+
+    def save(self, path):
+        '''
+        Save each table to a (Geo)Parquet file with the sequences in a JSON file
+        '''
+        os.makedirs(path, exist_ok=True)
+        for name in self.tables:
+            df = self._get_table(name)
+            geom_cols = self.geom_cols.get(name, [])
+            if geom_cols:
+                gpd.GeoDataFrame(df, geometry=geom_cols[0]).to_parquet(os.path.join(path,
+                  '%s.parquet' %name), index=False)
+            else:
+                pd.DataFrame(df).to_parquet(os.path.join(path, '%s.parquet' %name), index=False)
+        with open(os.path.join(path, 'sequences.json'), 'w') as f:
+            json.dump(self._seqs, f)
+
+    def connection_stats(self):
+        '''
+        No connections to report
+        '''
+        return {}
+
+    def io_stats(self):
+        '''
+        No operations run in the background
+        '''
+        return {}
+
+    def connect(self, begin=False, shared=True):
+        self.require_sql('Running SQL')
+
+    @contextmanager
+    def session(self):
+        '''
+        The tables are shared in memory so there is no connection to share
+        '''
+        yield self
+
+    def read_sql(self, q, geom_col=None, params=None):
+        self.require_sql('Running SQL')
+
+    def execute(self, q, params=None):
+        self.require_sql('Running SQL')
+
+    def stream_sql(self, q, batch_size=10000, params=None):
+        self.require_sql('Running SQL')
+
+    def _get_table(self, name):
+        '''
+        Get a table, loading it from the saved file or starting an empty table on first use
+        '''
+        if name not in self._tables:
+            fn = os.path.join(self.db, '%s.parquet' %name)
+            if self.db and os.path.exists(fn):
+                if name in self.geom_cols:
+                    df = gpd.read_parquet(fn)
+                else:
+                    df = pd.read_parquet(fn)
+            else:
+                df = pd.DataFrame({col: pd.Series(dtype=object) for col in self.tables[name]})
+                if name in self.geom_cols:
+                    df = gpd.GeoDataFrame(df, geometry=self.geom_cols[name][0],
+                      crs='EPSG:%s' %self.srid)
+            self._tables[name] = self._set_types(name, df)
+        return self._tables[name]
+
+    def _set_types(self, name, df):
+        '''
+        Store the dates as dates and the geometries as geometry as the PostGIS tables do
+        '''
+        for col in df.columns:
+            if col in self.date_cols and name != 'raw_data':
+                df[col] = pd.Series(pd.to_datetime(df[col]).dt.date, index=df.index, dtype=object)
+            elif col in ('start_date','end_date'):
+                df[col] = pd.to_datetime(df[col])
+        for col in self.geom_cols.get(name, []):
+            if col in df.columns and not isinstance(df[col].dtype, gpd.array.GeometryDtype):
+                df[col] = gpd.GeoSeries(df[col].astype(object).where(df[col].notna(), None), 
+                  index=df.index)
+            if col in df.columns and df[col].crs is None:
+                crs = 'EPSG:4326' if col in self.latlon_cols else 'EPSG:%s' %self.srid
+                df[col] = df[col].set_crs(crs)
+        return df
+
+    def compare(self, other, ignore=()):
+        '''
+        Compare the tables and sequences with another local DB. Returns the differences.
+        ignore: columns that are not compared, eg. the random event unique_id
+        '''
+        diffs = []
+        if self._seqs != other._seqs:
+            diffs.append('sequences: %s and %s' %(self._seqs, other._seqs))
+        for name, cols in self.tables.items():
+            a = self._get_table(name).reset_index(drop=True)
+            b = other._get_table(name).reset_index(drop=True)
+            if len(a) != len(b):
+                diffs.append('%s: %s and %s rows' %(name, len(a), len(b)))
+                continue
+            for col in cols:
+                if col in ignore:
+                    continue
+                if str(a[col].dtype) != str(b[col].dtype):
+                    diffs.append('%s.%s: %s and %s types' %(name, col, a[col].dtype, b[col].dtype))
+                    continue
+                if col in self.geom_cols.get(name, []):
+                    crs = [x.crs.to_string() if x.crs else None for x in (a[col], b[col])]
+                    if crs[0] != crs[1]:
+                        diffs.append('%s.%s: %s and %s CRS' %(name, col, crs[0], crs[1]))
+                    x = np.asarray(a[col], dtype=object)
+                    y = np.asarray(b[col], dtype=object)
+                    same = shapely.equals_exact(x, y, tolerance=0) | \
+                      (shapely.is_missing(x) & shapely.is_missing(y))
+                else:
+                    # Dates are compared with their types so a date does not match a timestamp
+                    same = ((a[col] == b[col]) & (a[col].map(type) == b[col].map(type))) | \
+                      (a[col].isna() & b[col].isna())
+                if not same.all():
+                    diffs.append('%s.%s: %s rows differ' %(name, col, (~ same).sum()))
+        return diffs
+
+    def _filter(self, df, where=None, exclude=None, dates=None, date_cols=('start_date','end_date')):
+        '''
+        Get the index of the rows that match the filters
+        '''
+        idx = pd.Series(True, index=df.index)
+        for col, vals in (where or {}).items():
+            if np.ndim(vals) == 0:
+                idx &= df[col] == vals
+            else:
+                idx &= df[col].isin(list(vals))
+        for col, vals in (exclude or {}).items():
+            idx &= ~ df[col].isin(list(vals))
+        if dates:
+            idx &= (pd.to_datetime(df[date_cols[0]]).dt.normalize() <= pd.to_datetime(dates[1])) & \
+              (pd.to_datetime(df[date_cols[1]]).dt.normalize() >= pd.to_datetime(dates[0]))
+        return idx
+
+    def select(self, name, cols=None, where=None, exclude=None, dates=None,
+      date_cols=('start_date','end_date'), geom_col=None):
+        '''
+        Select the columns from a table for the rows that match the filters.
+        Returns a geodataframe when a geometry column is set.
+        '''
+        self.round_trips += 1
+        df = self._get_table(name)
+        df = df[self._filter(df, where, exclude, dates, date_cols)]
+        if cols:
+            df = df[list(cols)]
+        if geom_col:
+            df = gpd.GeoDataFrame(df, geometry=geom_col, crs=df[geom_col].crs)
+        else:
+            df = pd.DataFrame(df)
+        df = df.reset_index(drop=True).copy()
+        self.rows_read += len(df)
+        self.bytes_read += int(df.memory_usage(deep=True).sum())
+        return df
+
+    def delete(self, name, where):
+        '''
+        Delete the rows of a table that match the filter
+        '''
+        self.round_trips += 1
+        df = self._get_table(name)
+        self._tables[name] = df[~ self._filter(df, where)].copy()
+
+    def delete_cascade(self, name, children, where=None, exclude=None, dates=None,
+      date_cols=('start_date','end_date'), key='id'):
+        '''
+        Delete the rows of a table that match the filters and the rows of the child tables that
+          reference them. Returns the number of rows deleted from the table.
+        '''
+        self.round_trips += 1
+        df = self._get_table(name)
+        idx = self._filter(df, where, exclude, dates, date_cols)
+        keys = df.loc[idx, key]
+        for child, col in children.items():
+            table = self._get_table(child)
+            self._tables[child] = table[~ table[col].isin(keys)].copy()
+        self._tables[name] = df[~ idx].copy()
+        return int(idx.sum())
+
+    def _get_stream_event_fires(self, stream_id):
+        '''
+        Get the event fire rows of the events in the stream
+        '''
+        events = self._get_table('event')
+        event_ids = events.loc[events['reconciliationstream_id'] == stream_id, 'id']
+        event_fires = self._get_table('event_fires')
+        return event_fires[event_fires['event_id'].isin(event_ids)]
+
+    def _get_stream_fire_ids(self, stream_id):
+        '''
+        Get the IDs of the fires that are part of an event in the stream
+        '''
+        return self._get_stream_event_fires(stream_id)['fire_id']
+
+    def select_new_fires(self, source_ids, stream_id, dates, cols=None):
+        '''
+        Select the fires of the sources in the date range that are not yet part of an event in
+          the stream
+        '''
+        self.round_trips += 1
+        df = self._get_table('fire')
+        idx = self._filter(df, where={'source_id': source_ids}, dates=dates)
+        df = df[idx & ~ df['id'].isin(self._get_stream_fire_ids(stream_id))]
+        if cols:
+            df = df[list(cols)]
+        if 'shape' in df.columns:
+            df = gpd.GeoDataFrame(df, geometry='shape', crs=df['shape'].crs)
+        else:
+            df = pd.DataFrame(df)
+        df = df.reset_index(drop=True).copy()
+        self.rows_read += len(df)
+        self.bytes_read += int(df.memory_usage(deep=True).sum())
+        return df
+
+    def select_events_near(self, stream_id, fires):
+        '''
+        Select the IDs of the events in the stream with a member fire that is within the distance
+          of any of the fires and overlaps the fire dates
+        '''
+        self.round_trips += 1
+        event_fires = self._get_stream_event_fires(stream_id)
+        members = self._get_table('fire')
+        dates = (min(fires['start_date']), max(fires['end_date']))
+        members = members[members['id'].isin(event_fires['fire_id']) & \
+          self._filter(members, dates=dates)].reset_index(drop=True)
+        members = gpd.GeoDataFrame(members, geometry='shape')
+        fire_idx, member_idx = members.sindex.query(fires['shape'].values, predicate='dwithin',
+          distance=fires['distance'].values)
+        # That also overlap the fire dates
+        overlap = (pd.to_datetime(members['start_date']).dt.normalize().values[member_idx] <= \
+          pd.to_datetime(fires['end_date']).values[fire_idx]) & \
+          (pd.to_datetime(members['end_date']).dt.normalize().values[member_idx] >= \
+          pd.to_datetime(fires['start_date']).values[fire_idx])
+        member_ids = members['id'].values[np.unique(member_idx[overlap])]
+        df = pd.DataFrame({'id': event_fires.loc[event_fires['fire_id'].isin(member_ids),
+          'event_id'].drop_duplicates().values})
+        self.rows_read += len(df)
+        self.bytes_read += int(df.memory_usage(deep=True).sum())
+        return df
+
+    def detect_stats(self, source_ids, stream_id, dates):
+        '''
+        Get the satellite detect count and mean VIIRS FRP by event and detect date for the
+          events of a stream
+        '''
+        self.round_trips += 1
+        raw = self._get_table('raw_data')
+        start = pd.to_datetime(dates[0])
+        end = pd.to_datetime(dates[1]) + pd.Timedelta(days=1)
+        raw = raw[raw['source_id'].isin(list(source_ids)) & (raw['start_date'] >= start) &
+          (raw['start_date'] < end)]
+        events = self._get_table('event')
+        event_ids = events.loc[events['reconciliationstream_id'] == stream_id, 'id']
+        event_fires = self._get_table('event_fires')
+        event_fires = event_fires.loc[event_fires['event_id'].isin(event_ids), ['fire_id','event_id']]
+        clumps = self._get_table('clump')[['id','fire_id']].rename(columns={'id': 'clump_id'})
+        detects = raw[['id','start_date','clump_id']].merge(clumps, on='clump_id')
+        detects = detects.merge(event_fires, on='fire_id')
+        idx = ['event_id','start_date']
+        df = detects.groupby(idx, as_index=False).agg(detect_cnt=('id', 'size'))
+        atts = self._get_table('data_attribute')
+        viirs = atts.loc[(atts['name'] == 'Method') & (atts['attr_value'] == 'VIIRS'), 'rawdata_id']
+        frp = atts.loc[(atts['name'] == 'FRP') & atts['rawdata_id'].isin(viirs), ['rawdata_id','attr_value']]
+        frp['frp'] = pd.to_numeric(frp['attr_value'].replace('', np.nan))
+        frp = detects.merge(frp[frp['frp'] > 0], left_on='id', right_on='rawdata_id')
+        df = df.merge(frp.groupby(idx, as_index=False)['frp'].mean(), on=idx, how='left')
+        self.rows_read += len(df)
+        self.bytes_read += int(df.memory_usage(deep=True).sum())
+        return df
+
+    def analyze(self, *names):
+        '''
+        No planner statistics to update
+        '''
+        pass
+
+    def next_ids(self, seq, n=1):
+        '''
+        Get the next n IDs from a sequence
+        '''
+        self.round_trips += 1
+        start = self._seqs.get(seq, 0)
+        self._seqs[seq] = start + int(n)
+        return list(range(start + 1, start + int(n) + 1))
+
+    def write(self, df, name):
+        '''
+        Append a dataframe to a table
+        '''
+        self.round_trips += 1
+        self.rows_written += len(df)
+        table = self._get_table(name)
+        df = df.copy()
+        if name in self.serial and 'id' not in df.columns:
+            df['id'] = self.next_ids(self.serial[name], len(df))
+        df = self._set_types(name, df.reindex(columns=self.tables[name]))
+        if table.empty:
+            table = df
+        else:
+            table = pd.concat((table, df), ignore_index=True)
+        if name in self.geom_cols:
+            table = gpd.GeoDataFrame(table, geometry=self.geom_cols[name][0])
+        self._tables[name] = table
+
+    def update(self, df, name, key='id'):
+        '''
+        Update the rows of a table from a dataframe matched on the key column
+        '''
+        self.round_trips += 1
+        self.rows_written += len(df)
+        table = self._get_table(name)
+        df = self._set_types(name, df.drop_duplicates(key).set_index(key))
+        idx = table[key].isin(df.index)
+        for col in df.columns:
+            table.loc[idx, col] = df.loc[table.loc[idx, key], col].values
+        self._tables[name] = table
@@ -0,0 +1,222 @@
+'''
+Versioned schema migrations. The migration scripts in sql/migrations are named
+  V<version>__<description>.sql and are recorded in the schema_version table as they are applied.
+'''
+import os.path
+import re
+import time
+import json
+import zlib
+from sqlalchemy import text
+
+MIGRATION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sql', 'migrations')
+
+class Schema():
+    '''
+    Apply the pending migrations to a PostGIS DB and check that the hot queries use the indexes
+    '''
+    # Version of the tables before the migration scripts
+    baseline = '1'
+
+    def __init__(self, db, path=MIGRATION_PATH):
+        db.require_sql('Migrating the schema')
+        self.db = db
+        self.path = path
+        self.migrations = self._get_migrations()
+
+    def _version_key(self, version):
+        return tuple([int(x) for x in version.split('.')])
+
+    def _get_migrations(self):
+        '''
+        Get the migration scripts in version order
+        '''
+        migrations = []
+        for fn in os.listdir(self.path):
+            m = re.match(r'V([0-9.]+)__(.+)\.sql$', fn)
+            if m:
+                with open(os.path.join(self.path, fn), 'rb') as f:
+                    sql = f.read()
+                # Signed 32 bit checksum to fit the checksum column
+                checksum = zlib.crc32(sql)
+                if checksum >= 2**31:
+                    checksum -= 2**32
+                migrations.append({'version': m.group(1), 'description': m.group(2).replace('_', ' '),
+                  'script': fn, 'checksum': checksum, 'sql': sql.decode('utf-8')})
+        return sorted(migrations, key=lambda x: self._version_key(x['version']))
+
+    def get_applied(self):
+        '''
+        Get the applied versions from the schema version table
+        '''
+        q = text('SELECT version, description, type, script, checksum, installed_on, state FROM schema_version')
+        df = self.db.read_sql(q)
+        return {row['version']: row for i, row in df.iterrows()}
+
+    def get_current(self, applied):
+        if applied:
+            return max(applied.keys(), key=self._version_key)
+        return None
+
+    def info(self):
+        '''
+        Print the state of each migration. Returns the pending migrations.
+        '''
+        applied = self.get_applied()
+        current = self.get_current(applied)
+        print('Current version: %s' %current)
+        pending = []
+        for mig in self.migrations:
+            row = applied.get(mig['version'])
+            if row is not None:
+                if row['type'] == 'SQL' and row['checksum'] != mig['checksum']:
+                    state = 'Applied (checksum changed)'
+                else:
+                    state = 'Applied'
+            elif current and self._version_key(mig['version']) <= self._version_key(current):
+                state = 'Below baseline'
+            else:
+                state = 'Pending'
+                pending.append(mig)
+            print('\tV%s %s: %s' %(mig['version'], mig['description'], state))
+        scripts = [mig['version'] for mig in self.migrations]
+        for version, row in applied.items():
+            if row['type'] == 'SQL' and version not in scripts:
+                print('\tV%s %s: Missing script' %(version, row['description']))
+        return pending
+
+    def _record(self, conn, version, description, mig_type, script, checksum, execution_time):
+        conn.execute(text('UPDATE schema_version SET current_version = FALSE'))
+        conn.execute(text('INSERT INTO schema_version (version, description, type, script, checksum, \
+          installed_by, execution_time, state, current_version) VALUES (:version, :description, \
+          :type, :script, :checksum, :installed_by, :execution_time, :state, TRUE)'),
+          {'version': version, 'description': description, 'type': mig_type, 'script': script,
+          'checksum': checksum, 'installed_by': self.db._config['pguser'][:30],
+          'execution_time': execution_time, 'state': 'SUCCESS'})
+
+    def migrate(self):
+        '''
+        Apply the pending migrations in version order. Each migration runs in its own
+          transaction so that a failed script leaves the DB at the last good version.
+        '''
+        if not self.get_applied():
+            # Tables set up before the schema version was recorded
+            with self.db.connect(begin=True) as conn:
+                self._record(conn, self.baseline, '<< Flyway Baseline >>', 'BASELINE',
+                  'smartfire_tables.sql', None, 0)
+        pending = self.info()
+        for mig in pending:
+            print('Migrating to V%s %s' %(mig['version'], mig['description']), flush=True)
+            start = time.perf_counter()
+            with self.db.connect(begin=True) as conn:
+                conn.exec_driver_sql(mig['sql'])
+                self._record(conn, mig['version'], mig['description'], 'SQL', mig['script'],
+                  mig['checksum'], int((time.perf_counter() - start) * 1000))
+            self.db.round_trips += 1
+        print('Applied %s migrations' %len(pending))
+        return pending
+
+    def _get_sample(self, conn):
+        '''
+        Get filter values for the hot queries from the data in the DB
+        '''
+        sample = {}
+        q = 'SELECT source_id, start_date::date, end_date::date, id, \
+          ST_AsEWKT(ST_Expand(ST_Envelope(shape), 10000)) FROM fire WHERE shape IS NOT NULL LIMIT 1'
+        row = conn.execute(text(q)).fetchone()
+        if row:
+            sample['fire'] = {'source_id': row[0], 'dates': (row[1], row[2]), 'id': row[3],
+              'box': row[4]}
+        q = 'SELECT reconciliationstream_id, start_date::date, end_date::date, id, \
+          ST_AsEWKT(ST_Expand(ST_Envelope(outline_shape), 10000)) FROM event \
+          WHERE outline_shape IS NOT NULL LIMIT 1'
+        row = conn.execute(text(q)).fetchone()
+        if row:
+            sample['event'] = {'stream_id': row[0], 'dates': (row[1], row[2]), 'id': row[3],
+              'box': row[4]}
+        q = 'SELECT rawdata_id FROM data_attribute LIMIT 1'
+        row = conn.execute(text(q)).fetchone()
+        if row:
+            sample['data_attribute'] = {'rawdata_id': row[0]}
+        return sample
+
+    def _get_queries(self, sample):
+        '''
+        The hot queries of the stages with their parameters and the indexes that they should use
+        '''
+        db = self.db
+        queries = []
+        if 'fire' in sample:
+            fire = sample['fire']
+            queries.append(('fire by source and dates', *db._select_sql('fire', ['id'],
+              where={'source_id': [fire['source_id']]}, dates=fire['dates']),
+              ['idx_fire_source_dates','idx_fire_daterange','idx_fire_by_source']))
+            queries.append(('clump by fire', *db._select_sql('clump', ['id'],
+              where={'fire_id': [fire['id']]}), ['idx_clump_by_fire']))
+            queries.append(('fire by shape', 'SELECT id FROM fire WHERE shape && ST_GeomFromEWKT(:box)',
+              {'box': fire['box']}, ['idx_fire_shape']))
+            queries.append(('clump by shape', 'SELECT id FROM clump WHERE shape && ST_GeomFromEWKT(:box)',
+              {'box': fire['box']}, ['idx_clump_shape']))
+        if 'event' in sample:
+            event = sample['event']
+            queries.append(('event by stream and dates', *db._select_sql('event', ['id'],
+              where={'reconciliationstream_id': event['stream_id']}, dates=event['dates']),
+              ['idx_event_stream_dates','idx_event_daterange','idx_event_by_stream']))
+            queries.append(('event day by event and dates', *db._select_sql('event_day', ['id'],
+              where={'event_id': [event['id']]}, dates=event['dates'],
+              date_cols=('event_date','event_date')), ['idx_event_day_event_date']))
+            queries.append(('event by shape',
+              'SELECT id FROM event WHERE outline_shape && ST_GeomFromEWKT(:box)',
+              {'box': event['box']}, ['idx_event_outline_shape']))
+        if 'data_attribute' in sample:
+            queries.append(('data attribute by raw data', *db._select_sql('data_attribute',
+              ['rawdata_id','attr_value'], where={'rawdata_id': [sample['data_attribute']['rawdata_id']],
+              'name': 'fire_id'}), ['idx_data_attribute_rawdata_name','idx_raw_data_data_attribute']))
+        return queries
+
+    def _get_plan_indexes(self, conn, q, params):
+        '''
+        Get the indexes used in the query plan
+        '''
+        plan = conn.execute(text('EXPLAIN (FORMAT JSON) ' + q), params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        indexes = []
+        nodes = [plan[0]['Plan'],]
+        while nodes:
+            node = nodes.pop()
+            if 'Index Name' in node:
+                indexes.append(node['Index Name'])
+            nodes.extend(node.get('Plans', []))
+        return indexes
+
+    def check(self):
+        '''
+        Check that the hot queries can use the indexes. A query with a small table may still be
+          planned as a sequential scan, so those are checked again with sequential scans off to
+          tell an index that is not chosen from an index that cannot be used.
+        Returns the queries that cannot use their indexes.
+        '''
+        failed = []
+        # The plan settings are rolled back when the connection closes
+        with self.db.connect() as conn:
+            sample = self._get_sample(conn)
+            queries = self._get_queries(sample)
+            if not queries:
+                print('No data to check the query plans')
+            for name, q, params, expected in queries:
+                used = self._get_plan_indexes(conn, q, params)
+                if set(used) & set(expected):
+                    state = 'uses %s' %', '.join(used)
+                else:
+                    conn.execute(text('SET LOCAL enable_seqscan = off'))
+                    forced = self._get_plan_indexes(conn, q, params)
+                    conn.execute(text('SET LOCAL enable_seqscan = on'))
+                    if set(forced) & set(expected):
+                        state = 'can use %s (not chosen at this table size)' %', '.join(forced)
+                    else:
+                        state = 'NO INDEX (expected %s)' %' or '.join(expected)
+                        failed.append(name)
+                print('\t%s: %s' %(name, state))
+        self.db.round_trips += 1
+        return failed
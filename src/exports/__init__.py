@@ -1,14 +1,35 @@
-import os.path
+import os
 import json
+import time
+import shutil
+import hashlib
+import importlib
 from datetime import timedelta, datetime
+from multiprocessing import Pool, current_process
+from numpy import ceil
 import pandas as pd
-from sqlalchemy import text
+import geopandas as gpd
+import shapely
 
 class Export():
     '''
     Export the SF2 to a text. Default to BSF style CSV
     '''
-    def __init__(self, config, db):
+    # Methods recorded as steps by the run instrumentation
+    steps = ['export','_get_event_data','_get_event_days','_get_sources','_get_detect_data',
+      '_get_partitions','_get_event_shapes','_write_parquet']
+    # Set when the export runs SQL queries and needs the PostGIS backend
+    needs_sql = False
+
+    @classmethod
+    def check_backend(cls, db):
+        '''
+        Check that the DB backend can run the export before the stages run
+        '''
+        if cls.needs_sql:
+            db.require_sql(cls.__name__)
+
+    def __init__(self, config, db=None, reconciliation=None):
         with open(config) as f:
             self._config = json.load(f)
         atts = ['name','start_date','end_date','export_path','sources']
@@ -17,62 +38,113 @@ class Export():
                 setattr(self, att, self._config[att])
             except KeyError as e:
                 raise ValueError('Missing %s in config file' %att)
-        self.stream_id = self._get_stream_id(db)
-        self._get_event_data(db)
+        # Optional attribute key: default pairs
+        atts = {'export_workers': 4, 'export_shapes': None, 'shape_tolerance': 0,
+          'export_formats': ['csv',], 'export_incremental': False}
+        for att, default in atts.items():
+            try:
+                setattr(self, att, self._config[att])
+            except KeyError:
+                setattr(self, att, default)
+        if self.export_shapes not in (None, 'geojson', 'flatgeobuf', 'geoparquet'):
+            raise ValueError('Unknown shape export format %s. Use geojson, flatgeobuf or geoparquet.'
+              %self.export_shapes)
+        for fmt in self.export_formats:
+            if fmt not in ('csv','parquet'):
+                raise ValueError('Unknown export format %s. Use csv or parquet.' %fmt)
+        if self.export_shapes == 'geoparquet' and 'parquet' not in self.export_formats:
+            raise ValueError('The geoparquet shape export needs the parquet export format')
+        if 'parquet' in self.export_formats:
+            try:
+                import pyarrow
+            except ImportError:
+                raise ValueError('The parquet export format needs the pyarrow package')
         # Add in for retrieving HMS
         self.sources = tuple([x.lower().strip() for x in self.sources])
-        self.source_ids = self._get_source_ids(db)
+        # The stream and source IDs and the events are loaded on first use
+        self.stream_id = None
+        self.source_ids = None
+        self.events = None
+        self._written = None
+        if reconciliation is not None:
+            self._take_reconciliation(reconciliation)
+
+    def _take_reconciliation(self, a):
+        '''
+        Take the stream and source IDs and the written events and event days from a
+          reconciliation of the same stream run in the same process
+        '''
+        if a.name != self.name or a.sources != self.sources:
+            return
+        self.stream_id = a.stream_id
+        self.source_ids = a.source_ids
+        if a.event_days is not None and (a.start_date, a.end_date) == (self.start_date, self.end_date):
+            idx = a.events['status'].isin(('inserted','updated'))
+            cols = ['id','display_name','start_date','end_date','total_area','fire_type']
+            self._written = (pd.DataFrame(a.events.loc[idx, cols]), pd.DataFrame(a.event_days),
+              a.complete)
+
+    def _load(self, db):
+        '''
+        Get the stream and source IDs and the events that were not taken from a reconciliation
+        '''
+        if self.stream_id is None:
+            self.stream_id = self._get_stream_id(db)
+        if self.source_ids is None:
+            self.source_ids = self._get_source_ids(db)
+        if self.events is None:
+            self._get_event_data(db)
  
     def _get_source_ids(self, db):
         '''
         Get the source IDs of the underlying sources for the stream
         '''
-        # Workaround for reconciliation streams with 1 source
-        if len(self.sources) == 1:
-            self.sourcekey = "('%s')" %self.sources[0]
-        else:
-            self.sourcekey = self.sources
-        q = 'SELECT id, name FROM source WHERE name IN %(sources)s'
-        q = text(q % {'sources': self.sourcekey})
-        with db.engine.connect() as conn:
-            df = pd.read_sql(q, con=conn)
+        df = db.select('source', ['id','name'], where={'name': self.sources})
         if len(df) < len(self.sources):
             print(df)
             raise ValueError('Missing sources. Check source names in config')
         elif len(df) > len(self.sources):
             raise ValueError('Duplicate source names in source table')
-        if len(df) == 1:
-            return "('%s')" %df['id'].values[0]
-        else:
-            return tuple(df['id'])
+        return [int(x) for x in df['id']]
 
     def _get_stream_id(self, db):
         '''
         Get the reconciliation stream ID either from the reconciliation stream table 
         '''
         name_slug = self.name.strip().lower().replace(' ','-')
-        with db.engine.connect() as conn:
-            q = text("SELECT id FROM reconciliation_stream WHERE name_slug= '%s'" %name_slug)
-            df = pd.read_sql(q, con=conn)
-            if len(df) == 1:
-                stream_id = int(df['id'].values[0])
-            else:
-                raise ValueError('Somehow there are multiple streams with the same name')
+        df = db.select('reconciliation_stream', ['id',], where={'name_slug': name_slug})
+        if len(df) == 1:
+            stream_id = int(df['id'].values[0])
+        else:
+            raise ValueError('Somehow there are multiple streams with the same name')
         return stream_id
 
     def _get_event_data(self, db):
         '''
-        Push the raw data to the postgres DB
-        '''
-        q = """SELECT id, display_name, start_date, end_date, total_area, fire_type FROM \
-          event WHERE reconciliationstream_id = %(streamid)s AND \
-          (((start_date >= '%(startdate)s') AND (start_date <= '%(enddate)s')) OR \
-          ((end_date >= '%(startdate)s') AND (end_date <= '%(enddate)s')))"""
-        q = text(q % {'streamid': self.stream_id, 'startdate': self.start_date, 
-          'enddate': self.end_date})
-        self.events = pd.read_sql(q, con=db.engine.connect())
-        self.events.start_date = pd.to_datetime(self.events.start_date)
-        self.events.end_date = pd.to_datetime(self.events.end_date)
+        Get the events of the stream that start or end in the date range
+        '''
+        cols = ['id','display_name','start_date','end_date','total_area','fire_type']
+        if self._written is None:
+            self.events = db.select('event', cols, where={'reconciliationstream_id': self.stream_id},
+              dates=(self.start_date, self.end_date))
+        else:
+            # Only read the events that the reconciliation did not write
+            events, event_days, complete = self._written
+            self.events = events[cols]
+            if not complete:
+                df = db.select('event', cols, where={'reconciliationstream_id': self.stream_id},
+                  exclude={'id': [int(x) for x in events['id']]}, dates=(self.start_date, self.end_date))
+                self.events = pd.concat((self.events, df), ignore_index=True)
+        # Same event order from memory or the DB
+        self.events = self.events.sort_values('id', kind='stable')
+        self.events.start_date = pd.to_datetime(self.events.start_date).dt.normalize()
+        self.events.end_date = pd.to_datetime(self.events.end_date).dt.normalize()
+        # Keep the events that start or end in the date range
+        start_date = pd.to_datetime(self.start_date)
+        end_date = pd.to_datetime(self.end_date)
+        idx = ((self.events.start_date >= start_date) & (self.events.start_date <= end_date)) | \
+          ((self.events.end_date >= start_date) & (self.events.end_date <= end_date))
+        self.events = self.events[idx].reset_index(drop=True)
         self.events['e_txt_id'] = 'SF11E' + self.events['id'].astype(int).astype(str).str.zfill(8)
         self.events.rename(columns={'id': 'event_id', 
           'display_name': 'event_name', 'fire_type': 'type'}, inplace=True)
@@ -83,63 +155,75 @@ class Export():
         '''
         Get the event fire xref table
         '''
-        event_ids = tuple(self.events['event_id'].drop_duplicates())
-        if len(event_ids) == 1:
-            event_ids = (event_ids[0], -9)
-        q = 'SELECT fire_id, event_id FROM event_fires WHERE event_id IN %(eventids)s'
-        df = pd.read_sql(text(q %{'eventids': event_ids}), con=db.engine.connect())
-        return df
+        event_ids = list(self.events['event_id'].drop_duplicates())
+        return db.select('event_fires', ['fire_id','event_id'], where={'event_id': event_ids})
 
     def _get_event_days(self, db):
         '''
         Get the daily event date by location
         '''
-        event_ids = tuple(self.events['event_id'].drop_duplicates())
-        if len(event_ids) == 1:
-            event_ids = (event_ids[0], -9)
-        q = """SELECT id, daily_area as area, event_date as date_time, event_id, ST_X(location) as longitude, \
-          ST_Y(location) as latitude FROM event_day WHERE event_id IN %(eventids)s AND \
-          event_date >= '%(startdate)s' AND event_date <= '%(enddate)s'"""
-        q = text(q %{'startdate': self.start_date, 'enddate': self.end_date, 
-          'eventids': event_ids})
-        df = pd.read_sql(q, con=db.engine.connect())
-        print(df.head())
+        event_ids = list(self.events['event_id'].drop_duplicates())
+        cols = ['id','daily_area','event_date','event_id','location']
+        if self._written is not None:
+            # Take the days of the written events and read the days of the other events
+            events, event_days, complete = self._written
+            df = event_days.loc[event_days['event_id'].isin(event_ids), cols]
+            df = df[(pd.to_datetime(df['event_date']) >= pd.to_datetime(self.start_date)) &
+              (pd.to_datetime(df['event_date']) <= pd.to_datetime(self.end_date))]
+            written = set(events['id'])
+            event_ids = [int(x) for x in event_ids if x not in written]
+        if self._written is None or event_ids:
+            days = db.select('event_day', cols, where={'event_id': event_ids},
+              dates=(self.start_date, self.end_date), date_cols=('event_date','event_date'),
+              geom_col='location')
+            df = days if self._written is None else pd.concat((df, days), ignore_index=True)
+        df = gpd.GeoDataFrame(df.sort_values('id', kind='stable'), geometry='location')
+        df['longitude'] = df['location'].x
+        df['latitude'] = df['location'].y
+        df = pd.DataFrame(df.drop('location', axis=1))
+        df.rename(columns={'daily_area': 'area', 'event_date': 'date_time'}, inplace=True)
         df.date_time = pd.to_datetime(df.date_time)
         df['f_txt_id'] = 'SF11C' + df['id'].astype(int).astype(str).str.zfill(8)
         return df
 
-    def _get_daily_event_shape(self, events, db):
+    def _get_event_shapes(self, db):
         '''
-        Get a geoJSON of the daily event shapes
+        Get the event outlines for the shape export. Each outline is simplified to the shape
+          tolerance in the DB projection and transformed to lat/lon once for the run. The GeoJSON
+          feature text for each event is also built once and reused on each event day.
         '''
-        # A record of 1 needs different SQL syntax
-        if len(events) == 1:
-            events_str = str(events[0])
-            wq = f'WHERE id = {events_str}'
-        else:
-            events_str = ','.join([str(s) for s in events])
-            wq = f'WHERE id IN ({events_str})'
-        q = """SELECT jsonb_build_object(\
-          'type', 'FeatureCollection','features', jsonb_agg(feature))\
-          FROM (SELECT jsonb_build_object('type', 'Feature','id', id, 'geometry',\
-          ST_AsGeoJSON(ST_Transform(outline_shape, 4326))::jsonb, 'properties', \
-          to_jsonb(row) - 'id' - 'outline_shape') AS feature\
-          FROM (SELECT * FROM event %(where_events)s) row) features"""
-        q = text(q %{'where_events': wq})
-        df = pd.read_sql(q, con=db.engine.connect())
-        return df.iloc[0]['jsonb_build_object']
+        event_ids = [int(x) for x in self.events['event_id'].drop_duplicates()]
+        df = db.select('event', ['id','outline_shape'], where={'id': event_ids}, geom_col='outline_shape')
+        if self.shape_tolerance:
+            df['outline_shape'] = df['outline_shape'].simplify(self.shape_tolerance)
+        df = df.to_crs(epsg=4326).rename(columns={'id': 'event_id'})
+        events = self.events.drop_duplicates('event_id').copy()
+        events['id'] = events['e_txt_id']
+        # Convert area from sqm to acres
+        events['total_area'] = (events['total_area'] / self.ACRES_TO_SQM).round(2)
+        for col in ('start_date','end_date'):
+            events[col] = events[col].dt.strftime('%Y-%m-%d')
+        cols = ['id','event_name','stream_name','start_date','end_date','total_area','type','sources']
+        df = df.merge(events[['event_id',] + cols], on='event_id')
+        props = df[cols].astype(object).where(df[cols].notna(), None).to_dict('records')
+        if self.export_shapes == 'geojson':
+            geoms = shapely.to_geojson(df['outline_shape'].values)
+            df['feature'] = ['{"type": "Feature", "properties": %s, "geometry": %s}' %(json.dumps(prop),
+              'null' if geom is None else geom) for prop, geom in zip(props, geoms)]
+        return df.set_index('event_id')
 
     def _get_sources(self, db):
         '''
         Get the sources used in each reconciled event as semicolon concatted list
         '''
         event_fires = self._get_event_fires(db)
-        fire_ids = tuple(event_fires['fire_id'].drop_duplicates())        
-        if len(fire_ids) == 1:
-            fire_ids = (fire_ids[0], -9)
-        q = 'SELECT fire.id as fire_id, source.name as sources FROM fire LEFT JOIN source ON \
-          source.id = fire.source_id WHERE fire.id IN %(fireids)s'
-        fire_sources = pd.read_sql(text(q %{'fireids': fire_ids}), con=db.engine.connect())
+        fire_ids = list(event_fires['fire_id'].drop_duplicates())
+        fire_sources = db.select('fire', ['id','source_id'], where={'id': fire_ids})
+        sources = db.select('source', ['id','name'], 
+          where={'id': list(fire_sources['source_id'].drop_duplicates())})
+        sources.rename(columns={'id': 'source_id', 'name': 'sources'}, inplace=True)
+        fire_sources = fire_sources.merge(sources, on='source_id', how='left')
+        fire_sources.rename(columns={'id': 'fire_id'}, inplace=True)
         event_fires = event_fires.merge(fire_sources, on='fire_id')
         event_fires.drop_duplicates(['event_id','sources'], inplace=True)
         event_fires = event_fires.groupby('event_id')['sources'].apply(lambda x: ';'.join(x))
@@ -168,107 +252,306 @@ class Export():
           'type','stream_name','detect_cnt','mean_frp']
         df.to_csv(os.path.join(self.export_path, fn), index=False, columns=cols)
 
-    def _write_shapes(self, daily_shapes, fn):
+    def _write_shapes(self, df, fn):
         '''
-        Write the GeoJSON shape files
+        Write the daily event shapes. GeoJSON is written one feature at a time. FlatGeobuf is
+          written with its spatial index.
         '''
         fn = os.path.join(self.export_path, fn)
-        with open(fn, 'w') as f:
-            json.dump(daily_shapes, f, indent=2) 
+        if self.export_shapes == 'flatgeobuf':
+            df.reset_index(drop=True).to_file(fn, driver='FlatGeobuf')
+        else:
+            with open(fn, 'w') as f:
+                f.write('{"type": "FeatureCollection", "features": [')
+                for i, feature in enumerate(df['feature']):
+                    f.write('\n' + feature if i == 0 else ',\n' + feature)
+                f.write('\n]}\n')
+
+    def _get_daily_events(self, days):
+        '''
+        Expand the events to a row for each export day that falls between the event start
+          and end dates. The rows for each day stay in the event table order.
+        '''
+        start = self.events['start_date'].dt.ceil('D').clip(lower=days[0])
+        end = self.events['end_date'].dt.floor('D').clip(upper=days[-1])
+        n_days = ((end - start).dt.days + 1).fillna(0).clip(lower=0).astype(int)
+        df = self.events.loc[self.events.index.repeat(n_days)].copy()
+        df['date_time'] = start.loc[df.index] + pd.to_timedelta(df.groupby(level=0).cumcount(),
+          unit='D')
+        return df.reset_index(drop=True).drop_duplicates(['date_time','event_id'])
+
+    def _join_days(self, days, event_days, sat):
+        '''
+        Join the event days to the daily events and detect data once for all of the days.
+          Returns the daily events and locations.
+        '''
+        daily_events = self._get_daily_events(days)
+        locs = event_days.merge(daily_events, on=['event_id','date_time'], suffixes=['','_ev'])
+        locs = locs.merge(sat, on=['event_id','date_time'], how='left')
+        return daily_events, locs
+
+    def _get_partitions(self, days, daily_events, locs, sat, shapes=None):
+        '''
+        Split the daily events and locations by day. Returns the day string, events, locations
+          and event shapes for each day.
+        '''
+        event_parts = dict(list(daily_events.groupby('date_time')))
+        loc_parts = dict(list(locs.groupby('date_time')))
+        sat_cols = [col for col in sat.columns if col not in ('event_id','date_time')]
+        parts = []
+        for day in days:
+            day_events = event_parts.get(day, daily_events.iloc[:0])
+            day_locs = loc_parts.get(day, locs.iloc[:0])
+            # Keep the detect data types for days where every location has detect data
+            for col in sat_cols:
+                if day_locs[col].dtype != sat[col].dtype and day_locs[col].notna().all():
+                    day_locs[col] = day_locs[col].astype(sat[col].dtype)
+            if shapes is None or self.export_shapes == 'geoparquet':
+                day_shapes = None
+            else:
+                day_shapes = shapes.loc[day_events['event_id']]
+            parts.append((datetime.strftime(day, '%Y%m%d'), day_events, day_locs, day_shapes))
+        return parts
+
+    def _write_day(self, part):
+        '''
+        Write the events, locations and shape files for a day. Returns the day, row counts and
+          the write time.
+        '''
+        day_str, day_events, day_locs, day_shapes = part
+        start = time.perf_counter()
+        self._write_events(day_events.copy(), 'events_%s.csv' %day_str)
+        self._write_locations(day_locs.copy(), 'fire_locations_%s.csv' %day_str)
+        if day_shapes is not None and not day_shapes.empty:
+            ext = 'fgb' if self.export_shapes == 'flatgeobuf' else 'json'
+            self._write_shapes(day_shapes, 'fire_shapes_%s.%s' %(day_str, ext))
+        return (day_str, len(day_events), len(day_locs), time.perf_counter() - start)
+
+    def _get_parquet_path(self):
+        return os.path.join(self.export_path, self.name.strip().lower().replace(' ','-'))
+
+    def _write_parquet(self, daily_events, locs, days, shapes=None):
+        '''
+        Write the events and locations for the days as one Parquet dataset for the stream with
+          a date partition key and typed columns. The event shapes are written as a GeoParquet
+          file with a row for each event since the outline does not change by day.
+        '''
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        start = time.perf_counter()
+        path = self._get_parquet_path()
+        days = pd.to_datetime(days, format='%Y%m%d')
+        events = daily_events[daily_events['date_time'].isin(days)].copy()
+        events['id'] = events['e_txt_id']
+        locs = locs[locs['date_time'].isin(days)].copy()
+        locs['id'] = locs['f_txt_id']
+        locs['event_id'] = locs['e_txt_id']
+        # Convert area from sqm to acres
+        events['total_area'] = (events['total_area'] / self.ACRES_TO_SQM).round(2)
+        locs['area'] = (locs['area'] / self.ACRES_TO_SQM).round(2)
+        locs['detect_cnt'] = locs['detect_cnt'].astype('Int64')
+        locs['mean_frp'] = locs['mean_frp'].astype(float)
+        tables = {'events': events[['date_time','id','event_name','stream_name','start_date',
+            'end_date','total_area','type','sources']],
+          'locations': locs[['date_time','id','event_id','event_name','latitude','longitude','area',
+            'type','stream_name','detect_cnt','mean_frp']]}
+        partitioning = ds.partitioning(pa.schema([('date', pa.date32())]), flavor='hive')
+        for name, df in tables.items():
+            # Clear the day partitions first so that days without rows now do not keep old rows
+            for day in days:
+                shutil.rmtree(os.path.join(path, name, 'date=%s' %day.strftime('%Y-%m-%d')),
+                  ignore_errors=True)
+            df = df.copy()
+            df.insert(0, 'date', df['date_time'].dt.date)
+            for col in ('start_date','end_date'):
+                if col in df.columns:
+                    df[col] = df[col].dt.date
+            # Dictionary encode the repeated names
+            for col in ('event_name','stream_name','type','sources'):
+                if col in df.columns:
+                    df[col] = df[col].astype('category')
+            table = pa.Table.from_pandas(df.drop(columns='date_time'), preserve_index=False)
+            ds.write_dataset(table, os.path.join(path, name), format='parquet',
+              partitioning=partitioning, basename_template='part-{i}.parquet',
+              existing_data_behavior='overwrite_or_ignore')
+        if shapes is not None:
+            shapes = shapes.reset_index(drop=True)
+            for col in ('start_date','end_date'):
+                shapes[col] = pd.to_datetime(shapes[col]).dt.date
+            shapes.to_parquet(os.path.join(path, 'shapes.parquet'), index=False)
+        print('Wrote the %s Parquet dataset with %s events and %s locations in %.2fs' %(path,
+          len(events), len(locs), time.perf_counter() - start), flush=True)
+
+    def _hash_day(self, part):
+        '''
+        Hash the rows written for a day
+        '''
+        day_str, day_events, day_locs, day_shapes = part
+        event_cols = ['e_txt_id','event_name','stream_name','start_date','end_date','total_area',
+          'sources']
+        loc_cols = ['f_txt_id','e_txt_id','event_name','latitude','longitude','date_time','area',
+          'type','stream_name','detect_cnt','mean_frp']
+        h = hashlib.sha1()
+        for df, cols in ((day_events, event_cols), (day_locs, loc_cols)):
+            h.update(str(list(df[cols].dtypes)).encode())
+            h.update(pd.util.hash_pandas_object(df[cols], index=False).values.tobytes())
+        if day_shapes is not None:
+            h.update(b''.join([x for x in shapely.to_wkb(day_shapes['outline_shape'].values)
+              if x is not None]))
+        return h.hexdigest()
+
+    def _get_day_files(self, part):
+        '''
+        Get the paths of the files written for a day
+        '''
+        day_str, day_events, day_locs, day_shapes = part
+        fns = []
+        if 'csv' in self.export_formats:
+            fns += ['events_%s.csv' %day_str, 'fire_locations_%s.csv' %day_str]
+            if day_shapes is not None and not day_shapes.empty:
+                ext = 'fgb' if self.export_shapes == 'flatgeobuf' else 'json'
+                fns.append('fire_shapes_%s.%s' %(day_str, ext))
+        fns = [os.path.join(self.export_path, fn) for fn in fns]
+        if 'parquet' in self.export_formats:
+            fns.append(os.path.join(self._get_parquet_path(), 'events'))
+        return fns
+
+    def _get_changed_days(self, parts):
+        '''
+        Compare the hash of each day to the manifest of the last export. Returns the parts
+          for the days that changed or have missing files and the new manifest.
+        '''
+        fn = os.path.join(self.export_path, 'export_manifest.json')
+        settings = {'formats': self.export_formats, 'shapes': self.export_shapes,
+          'shape_tolerance': self.shape_tolerance}
+        try:
+            with open(fn) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        if manifest.get('settings') != settings:
+            manifest = {'settings': settings, 'days': {}}
+        changed = []
+        skipped = []
+        for part in parts:
+            day_hash = self._hash_day(part)
+            if manifest['days'].get(part[0]) == day_hash and all([os.path.exists(fn) for fn in
+              self._get_day_files(part)]):
+                skipped.append(part[0])
+            else:
+                manifest['days'][part[0]] = day_hash
+                changed.append(part)
+        print('Skipped %s unchanged days: %s' %(len(skipped), self._day_ranges(skipped)))
+        return changed, manifest
+
+    def _write_manifest(self, manifest):
+        fn = os.path.join(self.export_path, 'export_manifest.json')
+        with open(fn + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(fn + '.tmp', fn)
+
+    def _day_ranges(self, days):
+        '''
+        Format a list of day strings as ranges of consecutive days
+        '''
+        ranges = []
+        for day in sorted(days):
+            date = datetime.strptime(day, '%Y%m%d')
+            if ranges and date - ranges[-1][1] == timedelta(days=1):
+                ranges[-1][1] = date
+            else:
+                ranges.append([date, date])
+        return ', '.join([x.strftime('%Y%m%d') if x == y else '%s-%s' %(x.strftime('%Y%m%d'),
+          y.strftime('%Y%m%d')) for x, y in ranges]) or 'none'
+
+    def _print_day_times(self, wall_s):
+        df = self.day_times
+        if df.empty:
+            print('No daily files written in %.2fs' %wall_s)
+            return
+        print('Exported %s days in %.2fs: %.2fs writing, %.3fs mean and %.3fs max per day'
+          %(len(df), wall_s, df['write_s'].sum(), df['write_s'].mean(), df['write_s'].max()))
+        for i, row in df.sort_values('write_s', ascending=False).head(5).iterrows():
+            print('\t%s: %s events, %s locations, %.3fs' %(row['day'], row['events'],
+              row['locations'], row['write_s']))
 
     def export(self, db):
         '''
         Default export method to BSF ready format
         '''
+        self._load(db)
         event_days = self._get_event_days(db)
         event_sources = self._get_sources(db)
         sat = self._get_detect_data(db)
-        print(self.events[self.events['event_name'] == 'Zink'])
         self.events = self.events.merge(event_sources, on='event_id', how='left')
-        print(self.events[self.events['event_id'] == '2082352'])
-        for day in list(pd.date_range(self.start_date, self.end_date)):
-            day_str = datetime.strftime(day, '%Y%m%d')
-            print('Exporting %s' %day_str)
-            event_fn = 'events_%s.csv' %day_str
-            idx = (self.events['start_date'] <= day) & (self.events['end_date'] >= day)
-            day_events = self.events[idx].drop_duplicates('event_id').copy()
-            self._write_events(day_events, event_fn)
-            day_locs = event_days[event_days['date_time'] == day].copy()
-            day_locs = day_locs.merge(day_events, on='event_id', suffixes=['','_ev'])
-            day_locs = day_locs.merge(sat, on=['event_id','date_time'], how='left')
-            loc_fn = 'fire_locations_%s.csv' %day_str
-            self._write_locations(day_locs, loc_fn)
-            '''
-            if not day_events.empty:
-                daily_shapes = self._get_daily_event_shape(list(day_events.event_id), db)
-                shp_fn = f'fire_shapes_{day_str}.json'
-                self._write_shapes(daily_shapes, shp_fn)
-            '''
+        shapes = self._get_event_shapes(db) if self.export_shapes else None
+        start = time.perf_counter()
+        days = list(pd.date_range(self.start_date, self.end_date))
+        daily_events, locs = self._join_days(days, event_days, sat)
+        parts = self._get_partitions(days, daily_events, locs, sat, shapes)
+        self.day_times = pd.DataFrame(columns=['day','events','locations','write_s'])
+        if self.export_incremental:
+            # Only write the days that changed since the last export
+            parts, manifest = self._get_changed_days(parts)
+        if 'parquet' in self.export_formats and parts:
+            # The GeoJSON and FlatGeobuf shapes are only written as daily files
+            self._write_parquet(daily_events, locs, [part[0] for part in parts],
+              shapes if self.export_shapes == 'geoparquet' else None)
+        if 'csv' in self.export_formats:
+            self._write_days(db, parts)
+        if self.export_incremental:
+            self._write_manifest(manifest)
+        self._print_day_times(time.perf_counter() - start)
 
-    def _get_rawsatdata(self, db, srcids):
+    def _write_days(self, db, parts):
         '''
-        Get the rawdata and clump ids from the raw data table for the selected sources
+        Write the daily files in the worker pool
         '''
-        if len(srcids) == 1:
-            q = f'SELECT id as rawdata_id, clump_id, start_date FROM raw_data where source_id = {srcids[0]}'
+        # A stream worker process cannot start its own pool
+        n_proc = min(self.export_workers, len(parts), os.cpu_count() or 1)
+        if current_process().daemon:
+            n_proc = 1
+        print('Exporting %s days with %s workers' %(len(parts), n_proc), flush=True)
+        if n_proc > 1:
+            # Finish the queued writes so that the workers do not fork with the I/O thread busy
+            #   on the session connection
+            db.wait()
+            with Pool(n_proc) as pool:
+                # One chunk of days per worker
+                times = pool.map(self._write_day, parts, chunksize=int(ceil(len(parts) / n_proc)))
         else:
-            q = 'SELECT id as rawdata_id, clump_id, start_date FROM raw_data where source_id IN %(sourceids)s'
-            q = text(q %{'sourceids': srcids})
-        return pd.read_sql(q, con=db.engine.connect())
-
-    def _get_viirs_frp(self, db, rdids):
-        '''
-        Get the VIIRS FRP values from the rawdata attribute table
-        '''
-        # Updated the raw data ID list only for VIIRS
-        q = """SELECT rawdata_id FROM data_attribute \
-          WHERE name = 'Method' AND attr_value = 'VIIRS' and rawdata_id IN %(rawids)s"""
-        q = text(q %{'rawids': rdids})
-        df = pd.read_sql(q, con=db.engine.connect())
-        # Get the FRP values for VIIRS
-        q = """SELECT attr_value as frp, raw_data.clump_id, rawdata_id FROM data_attribute \
-          LEFT JOIN raw_data ON data_attribute.rawdata_id = raw_data.id \
-          WHERE name = 'FRP' AND rawdata_id IN %(rawids)s"""
-        q = text(q %{'rawids': tuple(df.rawdata_id.drop_duplicates())})
-        df = pd.read_sql(q, con=db.engine.connect())
-        df.frp = df.frp.astype(float)
-        return df[df.frp > 0].copy()
+            times = [self._write_day(part) for part in parts]
+        self.day_times = pd.DataFrame(times, columns=['day','events','locations','write_s'])
 
     def _get_detect_data(self, db):
         '''
         Export HMS detect count and mean clump VIIRS FRP per daily event ID
         '''
         # Get the source IDs for the sources in this stream that have an hms clump method
-        q = """SELECT source.id as source_id FROM source WHERE source.id IN %(sourceids)s AND \
-          clump_method = 'hms'"""
-        q = text(q %{'sourceids': self.source_ids})
-        df = pd.read_sql(q, con=db.engine.connect())
-        sat_srcs = tuple(df.source_id.drop_duplicates())
+        df = db.select('source', ['id',], where={'id': self.source_ids, 'clump_method': 'hms'})
+        sat_srcs = [int(x) for x in df['id'].drop_duplicates()]
         if len(sat_srcs) == 0:
             print('No satellite sources in stream. Nothing to do.')
             sat = pd.DataFrame(columns=['event_id','detect_cnt','mean_frp','date_time'])
         else:
-            rawdata = self._get_rawsatdata(db, sat_srcs)
-            detect_cnt = rawdata.groupby(['clump_id','start_date'], as_index=False).count()
-            # Get the fire IDs for the clumps
-            q = 'SELECT id as clump_id, event_id FROM clump LEFT JOIN event_fires \
-              ON clump.fire_id = event_fires.fire_id WHERE clump.id IN %(clumps)s'
-            q = text(q %{'clumps': tuple(detect_cnt.clump_id.drop_duplicates())})
-            cf_xref = pd.read_sql(q, con=db.engine.connect())
-            # Sum up the number of detects per event_day
-            detect_cnt = detect_cnt.merge(cf_xref, on='clump_id', how='left')
-            idx = ['event_id','start_date']
-            detect_cnt = detect_cnt[idx+['rawdata_id',]].groupby(idx, as_index=False).sum()
-            # Get the mean clump VIIRS FRP for the fire
-            frp = self._get_viirs_frp(db, tuple(rawdata.rawdata_id.drop_duplicates()))
-            frp = frp.merge(rawdata[['rawdata_id','start_date']], on='rawdata_id', how='left')
-            frp = frp.merge(cf_xref, on='clump_id', how='left')
-            frp = frp[idx+['frp',]].groupby(idx, as_index=False).mean()
-            # Every fire ID with FRP should have a detect count but every detect count may not have FRP
-            sat = detect_cnt.merge(frp, on=idx, how='left')
+            # Only the counts and means by event day come back from the DB
+            sat = db.detect_stats(sat_srcs, self.stream_id, (self.start_date, self.end_date))
             sat.frp = sat.frp.round(4)
             sat.start_date = pd.to_datetime(sat.start_date)
-            colmap = {'rawdata_id': 'detect_cnt', 'frp': 'mean_frp', 'start_date': 'date_time'}
+            colmap = {'frp': 'mean_frp', 'start_date': 'date_time'}
             sat.rename(columns=colmap, inplace=True)
         return sat
 
+def get_export(method='bsf'):
+    '''
+    Get the export class for the export method set in the stream config
+    '''
+    method = method.lower().strip()
+    if method == 'bsf':
+        return Export
+    try:
+        export_module = importlib.import_module('exports.%s' %method)
+    except ImportError as e:
+        raise ImportError('Invalid export method in configuration')
+    else:
+        return getattr(export_module, '%sExport' %method.capitalize())
@@ -0,0 +1,229 @@
+'''
+Streamed BSF export. The event and location rows are read from PostGIS through a server-side
+  cursor in date order and written straight to the daily files, so the memory use stays flat
+  however long the stream is.
+'''
+import os
+import csv
+import gzip
+import time
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from . import Export
+
+def open_output(fn, compression=None):
+    '''
+    Open a text file for writing with optional gzip or zstd compression. Returns the file and
+      the file name with the compression extension.
+    '''
+    if not compression:
+        return open(fn, 'w', newline=''), fn
+    elif compression == 'gzip':
+        return gzip.open(fn + '.gz', 'wt', newline=''), fn + '.gz'
+    elif compression == 'zstd':
+        import zstandard
+        return zstandard.open(fn + '.zst', 'wt', newline=''), fn + '.zst'
+    raise ValueError('Unknown export compression %s. Use gzip or zstd.' %compression)
+
+class DailyFiles():
+    '''
+    Write rows that arrive in date order to one file per day. Days without rows get a file
+      with the header only as in the frame export.
+    '''
+    def __init__(self, path, prefix, cols, days, compression=None):
+        self.path = path
+        self.prefix = prefix
+        self.cols = cols
+        self.compression = compression
+        self._days = iter(days)
+        self.day = None
+        self.f = None
+        self.files = 0
+        self.rows = 0
+        self.bytes = 0
+
+    def _open(self, day):
+        fn = os.path.join(self.path, '%s_%s.csv' %(self.prefix, day))
+        self.f, self.fn = open_output(fn, self.compression)
+        self.writer = csv.writer(self.f, lineterminator='\n')
+        self.writer.writerow(self.cols)
+
+    def _close(self):
+        self.f.close()
+        self.f = None
+        self.files += 1
+        self.bytes += os.path.getsize(self.fn)
+
+    def _next_day(self, day):
+        '''
+        Close the current file and start the file for the day, writing the empty days between
+        '''
+        if self.f:
+            self._close()
+        for next_day in self._days:
+            self._open(next_day)
+            if next_day == day:
+                self.day = day
+                return
+            self._close()
+        raise ValueError('Row for %s is out of order or outside the export dates' %day)
+
+    def write(self, day, row):
+        if day != self.day:
+            self._next_day(day)
+        self.writer.writerow(row)
+        self.rows += 1
+
+    def close(self):
+        if self.f:
+            self._close()
+        for day in self._days:
+            self._open(day)
+            self._close()
+
+class StreamExport(Export):
+    '''
+    Export to the BSF style CSV by streaming the rows from the DB. Needs the PostGIS backend.
+    '''
+    # Methods recorded as steps by the run instrumentation
+    steps = ['export','_stream_events','_stream_locations']
+    needs_sql = True
+
+    def __init__(self, config, db=None, reconciliation=None):
+        if db is not None:
+            self.check_backend(db)
+        super().__init__(config, db, reconciliation)
+        # Optional attribute key: default pairs
+        atts = {'export_compression': None, 'export_batch_size': 10000}
+        for att, default in atts.items():
+            try:
+                setattr(self, att, self._config[att])
+            except KeyError:
+                setattr(self, att, default)
+        if self.export_compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError('zstd export compression needs the zstandard package')
+
+    def _get_event_data(self, db):
+        '''
+        The events are read with the rows in export
+        '''
+        pass
+
+    def _event_filter(self, db):
+        '''
+        Events of the stream that start or end in the export dates as in the frame export.
+          Uses the stream, start and end parameters.
+        '''
+        return '''e.reconciliationstream_id = :stream
+          AND daterange(e.start_date::date, e.end_date::date, '[]') && daterange(:start, :end, '[]')
+          AND (e.start_date::date BETWEEN :start AND :end OR e.end_date::date BETWEEN :start AND :end)'''
+
+    def _params(self, db):
+        '''
+        Parameters of the event filter
+        '''
+        return {'stream': self.stream_id, 'start': db._sql_date(self.start_date),
+          'end': db._sql_date(self.end_date)}
+
+    def _stream(self, db, q, params, files, get_row):
+        '''
+        Write the rows of a query to the daily files and report the throughput
+        '''
+        start = time.perf_counter()
+        try:
+            for rows in db.stream_sql(q, self.export_batch_size, params):
+                for row in rows:
+                    files.write(row[0].strftime('%Y%m%d'), get_row(row))
+        finally:
+            files.close()
+        wall_s = time.perf_counter() - start
+        print('Streamed %s %s rows to %s files in %.2fs: %d rows/s, %.2f MB at %.2f MB/s'
+          %(files.rows, files.prefix, files.files, wall_s, files.rows / max(wall_s, 1e-6),
+          files.bytes / 1e6, files.bytes / 1e6 / max(wall_s, 1e-6)), flush=True)
+
+    def _stream_events(self, db, days):
+        '''
+        Stream the events with a row for each day between the event start and end dates
+        '''
+        q = '''WITH events AS (
+          SELECT e.id, e.display_name, e.start_date::date AS start_date, e.end_date::date AS end_date,
+            e.total_area, (SELECT string_agg(DISTINCT s.name, ';') FROM event_fires ef
+              JOIN fire f ON f.id = ef.fire_id JOIN source s ON s.id = f.source_id
+              WHERE ef.event_id = e.id) AS sources
+          FROM event e WHERE %(filter)s)
+        SELECT d::date AS day, e.id, e.display_name, e.start_date, e.end_date, e.total_area, e.sources
+        FROM events e CROSS JOIN LATERAL generate_series(GREATEST(e.start_date, :start),
+          LEAST(e.end_date, :end), interval '1 day') d
+        ORDER BY day, e.id''' %{'filter': self._event_filter(db)}
+        cols = ['id','event_name','stream_name','start_date','end_date','total_area','sources']
+        files = DailyFiles(self.export_path, 'events', cols, days, self.export_compression)
+        get_row = lambda row: ['SF11E%s' %str(row[1]).zfill(8), self._title(row[2]), self.name,
+          row[3], row[4], self._acres(row[5], 2), row[6]]
+        self._stream(db, text(q), self._params(db), files, get_row)
+
+    def _stream_locations(self, db, days, sat_srcs):
+        '''
+        Stream the event day locations with the detect counts and mean VIIRS FRP
+        '''
+        params = self._params(db)
+        if sat_srcs:
+            # Shares the stream, start and end parameters with the event filter
+            sat, sat_params = db.detect_stats_sql(sat_srcs, self.stream_id,
+              (self.start_date, self.end_date))
+            sat = '''LEFT JOIN (%s) s ON s.event_id = ed.event_id AND s.start_date = ed.event_date''' %sat
+            # Whether every location of the day has detects. The frame export writes the counts
+            #  of a day as integers only then.
+            sat_cols = '''s.detect_cnt, s.frp,
+              bool_and(s.detect_cnt IS NOT NULL) OVER (PARTITION BY ed.event_date) AS day_detects'''
+            params.update(sat_params)
+        else:
+            sat = ''
+            sat_cols = 'NULL AS detect_cnt, NULL AS frp, FALSE AS day_detects'
+        q = '''SELECT ed.event_date AS day, ed.id, ed.event_id, e.display_name, ST_Y(ed.location),
+          ST_X(ed.location), ed.daily_area, e.fire_type, %(sat_cols)s
+        FROM event_day ed JOIN event e ON e.id = ed.event_id %(sat)s
+        WHERE %(filter)s AND ed.event_date BETWEEN :start AND :end
+          AND ed.event_date BETWEEN e.start_date::date AND e.end_date::date
+        ORDER BY ed.event_date, ed.id''' %{'sat_cols': sat_cols, 'sat': sat,
+          'filter': self._event_filter(db)}
+        cols = ['id','event_id','event_name','latitude','longitude','date_time','area',
+          'type','stream_name','detect_cnt','mean_frp']
+        files = DailyFiles(self.export_path, 'fire_locations', cols, days, self.export_compression)
+        get_row = lambda row: ['SF11C%s' %str(row[1]).zfill(8), 'SF11E%s' %str(row[2]).zfill(8),
+          self._title(row[3]), row[4], row[5], row[0], self._acres(row[6], 2), row[7], self.name,
+          self._detect_cnt(row[8], row[10]), self._frp(row[9])]
+        self._stream(db, text(q), params, files, get_row)
+
+    def _detect_cnt(self, count, day_detects):
+        # Written as a float like the frame export on days with locations without detects
+        if count is None:
+            return None
+        return int(count) if day_detects else float(count)
+
+    def _frp(self, frp):
+        # Rounded as pandas rounds the frame export. A missing or NaN mean is left empty.
+        if frp is None or np.isnan(float(frp)):
+            return None
+        return float(np.round(float(frp), 4))
+
+    def _title(self, name):
+        return None if name is None else name.title()
+
+    def _acres(self, area, digits):
+        # Convert area from sqm to acres and round as pandas rounds the frame export
+        return None if area is None else float(np.round(area / self.ACRES_TO_SQM, digits))
+
+    def export(self, db):
+        '''
+        Stream the BSF ready format
+        '''
+        self._load(db)
+        df = db.select('source', ['id',], where={'id': self.source_ids, 'clump_method': 'hms'})
+        sat_srcs = [int(x) for x in df['id'].drop_duplicates()]
+        days = [day.strftime('%Y%m%d') for day in pd.date_range(self.start_date, self.end_date)]
+        self._stream_events(db, days)
+        self._stream_locations(db, days, sat_srcs)
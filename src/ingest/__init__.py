@@ -1,12 +1,13 @@
 from math import pi
 import pandas as pd
 import geopandas as gpd
-from geoalchemy2 import Geometry
-from sqlalchemy import text
 
 class Ingest():
     '''
     '''
+    # Methods recorded as steps by the run instrumentation
+    steps = ['load','insert_raw_data']
+
     def __init__(self, config):
         self._config = config
         self._method = self._config['input']['ingest_method']
@@ -21,11 +22,6 @@ class Ingest():
         if self._data_policy not in ('append','replace'):
             raise ValueError('Data policy requires value of append or replace')
 
-    def _get_next_id(self, db):
-        with db.engine.connect() as conn:
-            result = conn.execute(text("SELECT nextval('raw_data_seq')"))
-        return int(result.first()[0])
-
     def insert_raw_data(self, db, source_id):
         '''
         Push the raw data to the postgres DB
@@ -36,13 +32,11 @@ class Ingest():
           self._src['end_date'].sort_values(ascending=False).values[0]))
         self._src['source_id'] = source_id
         self._src.rename(columns={'geometry': 'shape'}, inplace=True)
-        seq = pd.Series([self._get_next_id(db) for _ in range(len(self._src))])
-        self._src['id'] = seq
+        self._src['id'] = db.next_ids('raw_data_seq', len(self._src))
         self.srid = int(db.srid)
         self._src.set_geometry('shape', inplace=True, crs='EPSG:%s' %self.srid)
         cols = ['id','area','end_date','shape','start_date','source_id']
-        dtype = {'shape': Geometry(geometry_type='POLYGON', srid=self.srid)}
-        self._src[cols].to_postgis(name='raw_data', con=db.engine, if_exists='append', index=False)#, dtype=dtype)
+        db.write(self._src[cols], 'raw_data')
         srccols = [col for col in list(self._src.columns) if col not in cols]
         if len(srccols) > 1:
             srcatts = self._src[['id',] + srccols].copy()
@@ -51,7 +45,8 @@ class Ingest():
             srcatts.rename(columns={'id': 'rawdata_id'}, inplace=True)
             srcatts = pd.melt(srcatts, id_vars='rawdata_id', value_vars=srccols, var_name='name', 
               value_name='attr_value')
-            srcatts.to_sql(name='data_attribute', con=db.engine, if_exists='append', index=False)
+            db.write(srcatts, 'data_attribute')
+        db.analyze('raw_data', 'data_attribute')
 
 class CSVIngest(Ingest):
     def __init__(self, config):
@@ -98,7 +93,7 @@ class CSVIngest(Ingest):
             cols = list(self._src.columns)
             self._src = self._src.to_crs(shp.crs)
             self._src = gpd.sjoin(self._src, shp[['geometry',self._config['firetype']['att']]],
-              how='left', op='intersects')
+              how='left', predicate='intersects')
             self._src = self._src.to_crs(epsg=4326)
             self._src.rename(columns={self._config['firetype']['att']: 'fire_months'}, inplace=True)
             self._src = self._src[cols + ['fire_months',]].copy()
@@ -72,7 +72,7 @@ class SatIngest(CSVIngest):
             cols = list(self._src.columns)
             self._src = self._src.to_crs(shp.crs)
             self._src = gpd.sjoin(self._src, shp[['geometry',self._config['clumping']['fire_area_att']]],
-              how='left', op='intersects')
+              how='left', predicate='intersects')
             self._src = self._src.to_crs(epsg=4326)
             self._src.rename(columns={self._config['clumping']['fire_area_att']: 'area'}, inplace=True)
             self._src['area'] = self._src['area'].fillna(self.DEFAULT_ACRES)
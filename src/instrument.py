@@ -0,0 +1,184 @@
+'''
+Per-step run instrumentation for the stage classes. Records the wall and CPU time, the rows
+  read and written, the DB round trips and the peak RSS for each step and writes a JSON and CSV
+  report for the run. One named step can optionally be profiled with cProfile or pyinstrument.
+'''
+import os
+import io
+import csv
+import json
+import time
+import pstats
+import cProfile
+import resource
+from datetime import datetime
+from functools import partial
+from contextlib import contextmanager
+
+class _Step():
+    '''
+    Wrapper for a stage method that records the step when called. Pickles as the plain method so
+      that stage objects can still be sent to worker processes.
+    '''
+    def __init__(self, instrument, stage, method):
+        self.instrument = instrument
+        self.stage = stage
+        self.method = method
+
+    def __call__(self, *args, **kwargs):
+        with self.instrument.step(self.stage, self.method.__name__):
+            return self.method(*args, **kwargs)
+
+    def __reduce__(self):
+        return (partial, (self.method.__func__, self.method.__self__))
+
+class Instrument():
+    '''
+    Collect the step records for a run
+    '''
+    def __init__(self, db, name, config=None):
+        config = config or {}
+        self.db = db
+        self.name = name.strip().lower().replace(' ','_')
+        # Optional attribute key: default pairs
+        atts = {'report_path': 'reports', 'profile': '', 'profiler': 'cprofile'}
+        for att, default in atts.items():
+            try:
+                setattr(self, att, config['instrument'][att])
+            except KeyError:
+                setattr(self, att, default)
+        self.start = datetime.now()
+        self.steps = []
+        self._depth = 0
+
+    def attach(self, obj):
+        '''
+        Wrap the step methods listed in the steps attribute of a stage object
+        '''
+        stage = type(obj).__name__
+        for name in getattr(obj, 'steps', []):
+            setattr(obj, name, _Step(self, stage, getattr(obj, name)))
+        return obj
+
+    def _get_rss(self):
+        '''
+        Peak resident set size of the process so far in MB
+        '''
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def _get_counters(self):
+        return (getattr(self.db, 'round_trips', 0), getattr(self.db, 'rows_read', 0),
+          getattr(self.db, 'rows_written', 0))
+
+    @contextmanager
+    def step(self, stage, name):
+        '''
+        Record a step. Steps can be nested, the depth is kept with the record.
+        '''
+        # Records are kept in the order the steps start
+        rec = {'stage': stage, 'step': name, 'depth': self._depth}
+        self.steps.append(rec)
+        profiler = None
+        if self._is_profiled(stage, name):
+            profiler = self._start_profile()
+        counters = self._get_counters()
+        rss = self._get_rss()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        self._depth += 1
+        try:
+            yield rec
+        finally:
+            self._depth -= 1
+            rec['wall_s'] = round(time.perf_counter() - wall, 4)
+            rec['cpu_s'] = round(time.process_time() - cpu, 4)
+            end_counters = self._get_counters()
+            rec['round_trips'] = end_counters[0] - counters[0]
+            rec['rows_in'] = end_counters[1] - counters[1]
+            rec['rows_out'] = end_counters[2] - counters[2]
+            rec['peak_rss_mb'] = round(self._get_rss(), 1)
+            rec['rss_growth_mb'] = round(rec['peak_rss_mb'] - rss, 1)
+            if profiler:
+                self._stop_profile(profiler, stage, name)
+
+    def _is_profiled(self, stage, name):
+        '''
+        Check the step against the profiled step name. A stage class in the name also matches
+          its subclasses, eg. Reconciliation._link_fires matches GraphReconciliation.
+        '''
+        if not self.profile:
+            return False
+        prefix, _, step = self.profile.rpartition('.')
+        return step == name and stage.endswith(prefix)
+
+    def _start_profile(self):
+        if self.profiler == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                print('NOTE: pyinstrument is not installed, using cProfile')
+            else:
+                profiler = Profiler()
+                profiler.start()
+                return profiler
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def _stop_profile(self, profiler, stage, name):
+        '''
+        Save the profile of the named step next to the run report
+        '''
+        os.makedirs(self.report_path, exist_ok=True)
+        fn = os.path.join(self.report_path, '%s_%s.%s' %(self._get_prefix(), name.strip('_'), '%s'))
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            profiler.dump_stats(fn %'prof')
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(20)
+            print(out.getvalue())
+        else:
+            profiler.stop()
+            with open(fn %'html', 'w') as f:
+                f.write(profiler.output_html())
+            print(profiler.output_text())
+
+    def _get_prefix(self):
+        return '%s_%s' %(self.name, self.start.strftime('%Y%m%d_%H%M%S'))
+
+    def write(self):
+        '''
+        Write the step records to JSON and CSV and print a summary
+        '''
+        os.makedirs(self.report_path, exist_ok=True)
+        fn = os.path.join(self.report_path, self._get_prefix())
+        report = {'name': self.name, 'start': self.start.isoformat(),
+          'wall_s': round((datetime.now() - self.start).total_seconds(), 4),
+          'peak_rss_mb': round(self._get_rss(), 1), 'steps': self.steps}
+        connections = self.db.connection_stats() if hasattr(self.db, 'connection_stats') else {}
+        if connections:
+            report['connections'] = connections
+        io = self.db.io_stats() if hasattr(self.db, 'io_stats') else {}
+        if io:
+            report['io'] = io
+        with open('%s.json' %fn, 'w') as f:
+            json.dump(report, f, indent=2)
+        cols = ['stage','step','depth','wall_s','cpu_s','round_trips','rows_in','rows_out',
+          'peak_rss_mb','rss_growth_mb']
+        with open('%s.csv' %fn, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=cols, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(self.steps)
+        print('Run report: %s.json' %fn)
+        for rec in self.steps:
+            print('\t%s%s.%s: %ss wall, %ss cpu, %s round trips, %s rows in, %s rows out, %s MB peak'
+              %('  ' * rec['depth'], rec['stage'], rec['step'], rec['wall_s'], rec['cpu_s'],
+              rec['round_trips'], rec['rows_in'], rec['rows_out'], rec['peak_rss_mb']))
+        if connections:
+            print('\t%s connections opened, %s checkouts with %ss wait (%ss max), %s queries per connection'
+              %(connections['connections_opened'], connections['checkouts'],
+              connections['checkout_wait_s'], connections['max_checkout_wait_s'],
+              connections['queries_per_connection']))
+        if io:
+            print('\t%s queued DB operations: %ss I/O, %ss waited, %ss (%s%%) overlapped with compute'
+              %(io['submitted'], io['io_s'], io['wait_s'], io['overlap_s'], io['overlap_pct']))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+'''
+Measure the server query planning of a full reconcile of a stream with each DB driver. The
+  pg_stat_statements view is reset before each run and read after it, so the DB needs the
+  pg_stat_statements extension with pg_stat_statements.track_planning on. The stream is left
+  with the events of the last driver.
+Usage: measure_planning.py stream.json [driver ...]
+  eg. measure_planning.py stream.json psycopg2 psycopg
+'''
+
+import sys
+import json
+import time
+import tempfile
+from sqlalchemy import text
+from database import get_database
+from reconcile import get_reconciliation
+
+config = sys.argv[1]
+drivers = sys.argv[2:] or ['psycopg2','psycopg']
+with open('config/pg.json') as f:
+    db_config = json.load(f)
+with open(config) as f:
+    method = json.load(f).get('reconciliation_method', 'daily')
+# The statements of this run in this DB, leaving out the stats queries themselves
+stats_sql = text('''SELECT COUNT(*) AS statements, SUM(calls) AS calls, SUM(plans) AS plans,
+  SUM(total_plan_time) AS plan_ms, SUM(total_exec_time) AS exec_ms FROM pg_stat_statements
+  WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+    AND query NOT LIKE '%pg_stat_statements%' ''')
+results = []
+for driver in drivers:
+    with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+        json.dump(dict(db_config, driver=driver), f)
+        f.flush()
+        db = get_database(f.name)
+    db.require_sql('measure_planning.py')
+    a = get_reconciliation(method)(config, db)
+    a.write_mode = 'replace'
+    a.incremental = False
+    a.purge_events(db)
+    db.execute(text('SELECT pg_stat_statements_reset()'))
+    start = time.perf_counter()
+    with db.session():
+        a.reconcile(db)
+    wall_s = time.perf_counter() - start
+    row = db.execute(stats_sql)[0]
+    db.close()
+    results.append([driver, round(wall_s, 2)] + [x or 0 for x in row])
+print('Server statements, planning and execution for a full reconcile of %s:' %config)
+for driver, wall_s, statements, calls, plans, plan_ms, exec_ms in results:
+    print('\t%s: %ss wall, %s statements, %s calls, %s plans, %.1f ms planning (%.3f ms per call), %.1f ms executing'
+      %(driver, wall_s, statements, calls, plans, plan_ms, plan_ms / max(calls, 1), exec_ms))
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+'''
+Apply the schema migrations in sql/migrations and check the query plans
+Usage: migrate_db.py [info|migrate|check]
+'''
+import sys
+from database import get_database
+from database.schema import Schema
+
+try:
+    command = sys.argv[1]
+except IndexError:
+    command = 'info'
+db = get_database('config/pg.json')
+a = Schema(db)
+if command == 'info':
+    a.info()
+elif command == 'migrate':
+    a.migrate()
+elif command == 'check':
+    failed = a.check()
+    db.close()
+    if failed:
+        print('%s queries cannot use their indexes' %len(failed))
+        sys.exit(1)
+else:
+    raise ValueError('Unknown command %s. Use info, migrate or check.' %command)
+db.close()
@@ -1,12 +1,13 @@
 #!/usr/bin/env python3
 
 import sys
-from database import DataBase
+from database import get_database
 from reconcile import *
 from exports import *
 
 config = sys.argv[1]
-db = DataBase('config/pg.json')
+db = get_database('config/pg.json')
 a = Reconciliation(config, db)
 a.purge_events(db)
 
+db.close()
@@ -1,15 +1,23 @@
 from progress.bar import Bar
+import importlib
 import uuid
 import json
-from datetime import timedelta, date
+from datetime import timedelta, date, datetime
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from sqlalchemy import text
+import shapely
 
 class Reconciliation():
     '''
     Spatially and temporally combine the underlying fire activity sources
     '''
+    # Methods recorded as steps by the run instrumentation
+    steps = ['purge_events','reconcile','_load_fires','_link_fires','_set_event_fields',
+      '_set_event_days','_diff_events','_write_event_data','_write_event_fires','_write_event_days']
+    # Event tables and the column that references the event ID
+    event_children = {'event_fires': 'event_id', 'event_day': 'event_id'}
+
     def __init__(self, config, db):
         with open(config) as f:
             self._config = json.load(f)
@@ -19,23 +27,25 @@ class Reconciliation():
                 setattr(self, att, self._config[att])
             except KeyError as e:
                 raise ValueError('Missing %s in config file' %att)
+        # Optional attribute key: default pairs
+        atts = {'reconciliation_method': 'daily', 'write_mode': 'replace', 'incremental': False}
+        for att, default in atts.items():
+            try:
+                setattr(self, att, self._config[att])
+            except KeyError:
+                setattr(self, att, default)
+        if self.incremental and self.write_mode == 'diff':
+            raise ValueError('Incremental reconciliation cannot use the diff write mode')
         self.stream_id = self._get_stream_id(db)
         self.sources = tuple([x.lower().strip() for x in self.sources])
-        # Workaround for reconciliation streams with 1 source
-        if len(self.sources) == 1:
-            self.sourcekey = "('%s')" %self.sources[0]
-        else:
-            self.sourcekey = self.sources
         self.source_ids = self._get_source_ids(db)
         self.source_atts = self._get_source_atts(db) 
-
-    def _get_next_id(self, db, seq):
-        '''
-        Get the next event sequence ID from the DB sequence
-        '''
-        with db.engine.connect() as conn:
-            result = conn.execute(text("SELECT nextval('%s')" %seq))
-        return result.first()[0]
+        # Fires loaded once for several streams. Set by the multi-stream driver.
+        self.shared_fires = None
+        # Event days written by reconcile and whether the written events are all of the events
+        #  of the stream in the date range. Used by an export in the same process.
+        self.event_days = None
+        self.complete = False
 
     def _get_stream_id(self, db):
         '''
@@ -43,21 +53,19 @@ class Reconciliation():
           stream already exists or from the sequence
         '''
         name_slug = self.name.strip().lower().replace(' ','-')
-        with db.engine.connect() as conn:
-            q = text("SELECT id FROM reconciliation_stream WHERE name_slug= '%s'" %name_slug)
-            df = pd.read_sql(q, con=conn)
-            # If the stream does not exist in the table get a fresh stream id number and add it to
-            #   the stream table
-            if len(df) == 0:
-                stream_id = self._get_next_id(db, 'reconciliation_stream_seq')
-                row = pd.DataFrame([[stream_id, self.name, '', name_slug, 'f'],], 
-                  columns=['id','name','reconciliation_method','name_slug','auto_reconcile']) 
-                row.to_sql(name='reconciliation_stream', con=db.engine, if_exists='append', index=False)
-            # If it is there then grab the stream ID
-            elif len(df) == 1:
-                stream_id = int(df['id'].values[0])
-            else:
-                raise ValueError('Somehow there are multiple streams with the same name')
+        df = db.select('reconciliation_stream', ['id',], where={'name_slug': name_slug})
+        # If the stream does not exist in the table get a fresh stream id number and add it to
+        #   the stream table
+        if len(df) == 0:
+            stream_id = db.next_ids('reconciliation_stream_seq')[0]
+            row = pd.DataFrame([[stream_id, self.name, self.reconciliation_method, name_slug, 'f'],], 
+              columns=['id','name','reconciliation_method','name_slug','auto_reconcile']) 
+            db.write(row, 'reconciliation_stream')
+        # If it is there then grab the stream ID
+        elif len(df) == 1:
+            stream_id = int(df['id'].values[0])
+        else:
+            raise ValueError('Somehow there are multiple streams with the same name')
         return stream_id
 
     def _get_event_ids(self, db):
@@ -65,50 +73,156 @@ class Reconciliation():
         Get the event IDs from the fire event table for all existing reconciled events
           in the table for this stream for the given date range
         '''
-        q = """SELECT id FROM event WHERE reconciliationstream_id = %(streamid)s AND \
-          (daterange(start_date, end_date, '[]') && \
-          daterange('%(startdate)s', '%(enddate)s', '[]'))"""
-        q = text(q % {'streamid': self.stream_id, 'startdate': self.start_date, 
-          'enddate': self.end_date})
-        df = pd.read_sql(q, con=db.engine.connect()) 
+        df = db.select('event', ['id',], where={'reconciliationstream_id': self.stream_id}, 
+          dates=(self.start_date, self.end_date))
         return tuple(df['id']) 
 
+    def _get_touched_event_ids(self, db, fires):
+        '''
+        Get the IDs of the existing events for this stream with a member fire that could be
+          linked with any of the fires. Two fires are linked within the location and date
+          uncertainty of either fire so the largest uncertainty of the stream sources is used.
+        '''
+        if fires.empty:
+            return ()
+        atts = self.source_atts
+        # Convert the uncertainty from km->m and change to a radius as the linking does
+        distance = atts['location_uncertainty'].fillna(0).max() * 1000 / 2
+        days = int(atts[['start_date_uncertainty','end_date_uncertainty']].fillna(0).values.max())
+        start_day = self._set_fire_days(fires['start_date']) - days
+        end_day = self._set_fire_days(fires['end_date']) + days
+        fires = gpd.GeoDataFrame({'shape': fires['shape'].values,
+          'distance': np.full(len(fires), distance),
+          'start_date': pd.to_datetime(start_day, unit='D').date,
+          'end_date': pd.to_datetime(end_day, unit='D').date}, geometry='shape')
+        df = db.select_events_near(self.stream_id, fires)
+        return tuple(df['id'])
+
+    def _get_touched_fires(self, db, fires):
+        '''
+        Get the member fires of the existing events that are touched by the fires not yet in an
+          event and the event fires of the touched events. The events touched by the member fires
+          are added until no more events are touched so that the touched events can be linked
+          again from their member fires as a full run would.
+        '''
+        event_ids = ()
+        rec_fires = pd.DataFrame(columns=['event_id','id'])
+        members = fires.iloc[:0]
+        while not fires.empty:
+            touched = tuple(set(self._get_touched_event_ids(db, fires)) - set(event_ids))
+            if not touched:
+                break
+            event_ids += touched
+            df = self._get_reconciled_fire_ids(db, touched)
+            rec_fires = pd.concat((rec_fires, df), ignore_index=True)
+            fires = self._get_member_fires(db, tuple(set(df['id']) - set(members['id'])))
+            members = pd.concat((members, fires), ignore_index=True)
+        print('\tLinking %s fires of %s touched events again' %(len(members), len(event_ids)))
+        return members, rec_fires
+
+    def _get_member_fires(self, db, fire_ids):
+        '''
+        Load the member fires of existing events in the date range and add them to the fire
+          cache. Like the fires in a full run they are limited to the date range.
+        '''
+        if self.shared_fires is not None:
+            df = self.shared_fires[self.shared_fires['id'].isin(fire_ids)]
+            idx = (pd.to_datetime(df['start_date']) <= pd.to_datetime(self.end_date)) & \
+              (pd.to_datetime(df['end_date']) >= pd.to_datetime(self.start_date))
+            df = df[idx].copy()
+        else:
+            df = db.select('fire', self.fire_cols, where={'id': fire_ids},
+              dates=(self.start_date, self.end_date), geom_col='shape')
+        df = df.rename(columns={'id': 'fire_id'})
+        self.fire_cache = pd.concat((self.fire_cache, df[self.fire_atts]), ignore_index=True)
+        return df.rename(columns={'fire_id': 'id'}).drop(['fire_name','fire_type','probability'], axis=1)
+
     def _get_reconciled_fire_ids(self, db, event_ids):
         '''
         Get the fire IDs from the fire event table for all existing reconciled events
           in the table for this stream for the given date range
         '''
         if len(event_ids) > 0:
-            q = 'SELECT event_id, fire_id FROM event_fires WHERE event_id IN %(eventids)s'
-            df = pd.read_sql(text(q % {'eventids': event_ids}), con=db.engine.connect())
+            df = db.select('event_fires', ['event_id','fire_id'], where={'event_id': event_ids})
             df.rename(columns={'fire_id': 'id'}, inplace=True)
             return df 
         else:
             return pd.DataFrame() 
 
-    def _get_fires(self, db, fire_ids=()):
+    # Fire attributes held in the per-run fire cache for setting the event fields
+    fire_atts = ['fire_id','source_id','area','shape','fire_name','fire_type','probability']
+    # Fire columns loaded for linking and the fire cache
+    fire_cols = ['id','source_id','area','shape','start_date','end_date','fire_name','fire_type',
+      'probability']
+    def _get_fires(self, db, fire_ids=(), new_only=False):
         '''
         Load all of the fires associated with the source ID for the given date range
-          and that are not in the fire ID list 
-        '''
-        q = """SELECT id, source_id, area, shape, start_date, end_date FROM fire \
-          WHERE source_id IN %(sourceids)s AND \
-          (daterange(start_date, end_date, '[]') && \
-          daterange('%(startdate)s', '%(enddate)s', '[]'))"""
-        if fire_ids: 
-            q += ' AND id NOT IN %(fireids)s'
-        fire_query = text(q % {'sourceids': self.source_ids, 'startdate': self.start_date, 
-          'enddate': self.end_date, 'fireids': fire_ids})
-        df = gpd.read_postgis(fire_query, con=db.engine.connect(), geom_col='shape')
-        return df
+          and that are not in the fire ID list. Optionally only load the fires that are not yet
+          in an event for this stream. The fire attributes start the fire cache for the run.
+        '''
+        if self.shared_fires is not None:
+            return self._get_shared_fires(db, fire_ids, new_only)
+        cols = self.fire_cols
+        if new_only:
+            df = db.select_new_fires(self.source_ids, self.stream_id, 
+              (self.start_date, self.end_date), cols)
+        else:
+            df = db.select('fire', cols, where={'source_id': self.source_ids}, 
+              exclude={'id': fire_ids}, dates=(self.start_date, self.end_date), geom_col='shape')
+        # Start the fire cache for this run
+        self.fire_cache = df.rename(columns={'id': 'fire_id'})[self.fire_atts].copy()
+        return df.drop(['fire_name','fire_type','probability'], axis=1)
+
+    def _get_shared_fires(self, db, fire_ids=(), new_only=False):
+        '''
+        Select the fires for this stream from the fires shared across streams instead of
+          querying the fire table
+        '''
+        df = self.shared_fires
+        idx = df['source_id'].isin(self.source_ids) & \
+          (pd.to_datetime(df['start_date']) <= pd.to_datetime(self.end_date)) & \
+          (pd.to_datetime(df['end_date']) >= pd.to_datetime(self.start_date))
+        if fire_ids:
+            idx &= ~ df['id'].isin(fire_ids)
+        if new_only:
+            new_fires = db.select_new_fires(self.source_ids, self.stream_id, 
+              (self.start_date, self.end_date), ['id',])
+            idx &= df['id'].isin(new_fires['id'])
+        df = df[idx].copy()
+        # Start the fire cache for this run
+        self.fire_cache = df.rename(columns={'id': 'fire_id'})[self.fire_atts].copy()
+        return df.drop(['fire_name','fire_type','probability'], axis=1)
+
+    def _cache_fires(self, db, fire_ids):
+        '''
+        Load the attributes of any fires that are not already in the fire cache in one query
+        '''
+        fire_ids = tuple(set(fire_ids) - set(self.fire_cache['fire_id']))
+        if fire_ids and self.shared_fires is not None:
+            df = self.shared_fires[self.shared_fires['id'].isin(fire_ids)]
+            df = df.rename(columns={'id': 'fire_id'})
+            self.fire_cache = pd.concat((self.fire_cache, df[self.fire_atts]), ignore_index=True)
+            fire_ids = tuple(set(fire_ids) - set(df['fire_id']))
+        if fire_ids:
+            df = db.select('fire', ['id',] + self.fire_atts[1:], where={'id': fire_ids}, 
+              geom_col='shape')
+            df.rename(columns={'id': 'fire_id'}, inplace=True)
+            self.fire_cache = pd.concat((self.fire_cache, df[self.fire_atts]), ignore_index=True)
+        self.fire_cache.drop_duplicates('fire_id', inplace=True)
+
+    def _get_cached_fires(self, fire_ids, cols):
+        '''
+        Get the selected attributes for the fire IDs from the fire cache
+        '''
+        df = self.fire_cache.loc[self.fire_cache['fire_id'].isin(fire_ids), ['fire_id',] + cols]
+        return pd.DataFrame(df)
 
     def _get_reconciled_events(self, db, event_ids):
         '''
         Load all of the existing events with the given event IDs
         '''
-        q = 'SELECT id, start_date, end_date, outline_shape FROM event WHERE id IN %(eventids)s' 
-        df = gpd.read_postgis(text(q % {'eventids': event_ids}), con=db.engine.connect(), 
-          geom_col='outline_shape')
+        df = db.select('event', ['id','start_date','end_date','outline_shape'], 
+          where={'id': event_ids}, geom_col='outline_shape')
         df.rename(columns={'id': 'event_id', 'outline_shape': 'shape'}, inplace=True)
         return df
 
@@ -116,20 +230,14 @@ class Reconciliation():
         '''
         Get the source IDs of the underlying sources for the stream
         '''
-        q = 'SELECT id, name FROM source WHERE name IN %(sources)s'
-        q = text(q % {'sources': self.sourcekey})
-        with db.engine.connect() as conn:
-            df = pd.read_sql(q, con=conn)
+        df = db.select('source', ['id','name'], where={'name': self.sources})
         if len(df) < len(self.sources):
             print(df)
             raise ValueError('Missing sources. Check source names in config')
         elif len(df) > len(self.sources):
             raise ValueError('Duplicate source names in source table')
         print('Using sources for reconciliation:\n\t%s' %';'.join(list(df['name'])))
-        if len(df) == 1:
-            return "('%s')" %df['id'].values[0]
-        else:
-            return tuple(df['id'])
+        return [int(x) for x in df['id']]
 
     def _get_source_atts(self, db):
         '''
@@ -138,9 +246,7 @@ class Reconciliation():
           the attribute of the source.
         Location uncertainty is in km. Start and end date uncertainty is in days backwards or forwards. 
         '''
-        q = 'SELECT * FROM default_weighting WHERE id IN %(sourceids)s'
-        q = text(q % {'sourceids': self.source_ids})
-        df = pd.read_sql(q, con=db.engine.connect())
+        df = db.select('default_weighting', where={'id': self.source_ids})
         df.rename(columns={'id': 'source_id'}, inplace=True)
         return df
 
@@ -148,11 +254,7 @@ class Reconciliation():
         '''
         Get the fire source ids from the fire ids
         '''
-        q = 'SELECT id, source_id FROM fire WHERE id IN %(fireids)s'
-        q = text(q % {'fireids': fire_ids})
-        df = pd.read_sql(q, con=db.engine.connect())
-        df.rename(columns={'id': 'fire_id'}, inplace=True)
-        return df
+        return self._get_cached_fires(fire_ids, ['source_id',])
 
     # Mapping of the weighting attributes: {output_field: [input field, weight field], ...}
     weights = {'outline_shape': ['shape','shape_weight'], 'total_area': ['area','size_weight'], 
@@ -170,14 +272,8 @@ class Reconciliation():
         # Select only the fire IDs that have the top weight for that event
         idx = event_rep[weightcol] == event_rep['%s_top' %weightcol]
         event_rep = event_rep.loc[idx, ['tmp_event','fire_id']].copy()
-        fire_ids = tuple(event_rep['fire_id'].drop_duplicates())
-        q = 'SELECT id, %(incol)s FROM fire WHERE id IN %(fireids)s'
-        q = text(q % {'incol': incol, 'fireids': fire_ids})
-        if incol == 'shape':
-            df = gpd.read_postgis(q, con=db.engine.connect(), geom_col=incol) 
-        else:
-            df = pd.read_sql(q, con=db.engine.connect())
-        df.rename(columns={'id': 'fire_id', incol: outcol}, inplace=True)
+        df = self._get_cached_fires(event_rep['fire_id'].drop_duplicates(), [incol,])
+        df.rename(columns={incol: outcol}, inplace=True)
         df = event_rep.merge(df, on='fire_id')
         return df[['tmp_event',outcol]].copy()
 
@@ -200,8 +296,7 @@ class Reconciliation():
         Old method for setting the start and end dates for the fire
         '''
         fire_ids = tuple(self.srcmap['fire_id'])
-        q = 'SELECT id, start_date, end_date FROM fire WHERE id IN %(fireids)s'
-        df = pd.read_sql(text(q % {'fireids': fire_ids}), con=db.engine.connect())
+        df = db.select('fire', ['id','start_date','end_date'], where={'id': fire_ids})
         df.rename(columns={'id': 'fire_id'}, inplace=True)
         df = pd.merge(self.srcmap[['fire_id','tmp_event']], df, on='fire_id', how='left')
         start_dates = df[['tmp_event','start_date']].sort_values('start_date', 
@@ -232,10 +327,7 @@ class Reconciliation():
         '''
         Set the event probability from the inverse of the contributing sources
         '''
-        fire_ids = tuple(self.srcmap['fire_id'].drop_duplicates())
-        q = 'SELECT id, probability FROM fire WHERE id IN %(fireids)s'
-        df = pd.read_sql(text(q % {'fireids': fire_ids}), con=db.engine.connect())
-        df.rename(columns={'id': 'fire_id'}, inplace=True)
+        df = self._get_cached_fires(self.srcmap['fire_id'].drop_duplicates(), ['probability',])
         df['probability'] = 1 - df['probability']
         df = df.merge(self.srcmap, on='fire_id')
         df = df[['tmp_event','probability']].groupby('tmp_event', as_index=False).prod()
@@ -246,8 +338,10 @@ class Reconciliation():
         '''
         Merge in the fire attributes to build the fire table for output to postgres
         '''
+        # Load any fire attributes not already in the cache from the merged-in events
+        self._cache_fires(db, self.srcmap['fire_id'].drop_duplicates())
         # Merge in the source IDs for the fires
-        source_ids = self._get_fire_sources(db, tuple(self.srcmap['fire_id']))
+        source_ids = self._get_fire_sources(db, self.srcmap['fire_id'])
         self.srcmap = pd.merge(self.srcmap, source_ids.drop_duplicates('fire_id'), on='fire_id', 
           how='left')
         # And the reconciliation weighting for the sources
@@ -263,11 +357,12 @@ class Reconciliation():
     def _set_event_days(self, db):
         '''
         Set the area for each of the event days using the proportional area from the source type
-          with the highest growth weight. Assign the centroid of the clump polygon to the location.
+          with the highest growth weight. Assign the stored centroid of the clump to the location.
         At some point in the future it may be useful to carry forward the clump ID or shape so that 
           the polygon can directly into BlueSky. Until that point it can be referenced with the ids.
         '''
         print('Setting event days', flush=True)
+        start = datetime.now()
         top_weight = self.srcmap[['tmp_event','growth_weight']].sort_values('growth_weight',
           ascending=False).drop_duplicates('tmp_event', keep='first')
         event_rep = pd.merge(self.srcmap[['tmp_event','fire_id','growth_weight']], top_weight,
@@ -277,33 +372,27 @@ class Reconciliation():
         event_rep = event_rep.loc[idx, ['tmp_event','fire_id']].copy()
         fire_ids = tuple(event_rep['fire_id'].drop_duplicates())
         # Retrieve the clumps for the fire source with the highest growth weight in that event
-        # Get the location of the clump as the centroid.
-        q = '''SELECT id, fire_id, start_date, end_date, area, \
-          ST_CENTROID(ST_TRANSFORM(shape,4326)) as location FROM clump \
-          WHERE fire_id IN %(fireids)s'''
-        df = gpd.read_postgis(text(q % {'fireids': fire_ids}), con=db.engine.connect(), 
-          geom_col='location') 
+        # Get the location of the clump from the centroid stored when the clump was written
+        df = db.select('clump', ['id','fire_id','start_date','end_date','area','centroid'], 
+          where={'fire_id': fire_ids}, geom_col='centroid')
+        df['x'] = df['centroid'].x
+        df['y'] = df['centroid'].y
         df.drop_duplicates(['id','fire_id'], inplace=True)
-        df.start_date = pd.to_datetime(df.start_date)
-        df.end_date = pd.to_datetime(df.end_date)
         # Flatten multi-date clumps so that each day has the same area
-        mdclumps = pd.DataFrame(df[(df['start_date'] != df['end_date'])])
-        if len(mdclumps) > 0:
-            mdclumps['days'] = (mdclumps['end_date'] - mdclumps['start_date']).dt.days + 1
-            mdclumps['area'] = mdclumps['area'] / mdclumps['days']
-            mdclumps['date'] = mdclumps.apply(lambda row: pd.date_range(row.start_date, 
-              row.end_date), axis=1)
-            mdclumps = mdclumps.explode('date', ignore_index=True)
-            mdclumps['date'] = mdclumps['date'].dt.strftime('%Y-%m-%d')
-        else:
-            mdclumps['date'] = mdclumps['start_date']
+        start_day = self._set_fire_days(df['start_date'])
+        ndays = self._set_fire_days(df['end_date']) - start_day + 1
+        first_row = np.repeat(np.cumsum(ndays) - ndays, ndays)
+        days = np.repeat(start_day, ndays) + np.arange(ndays.sum()) - first_row
+        multi_day = np.repeat(ndays > 1, ndays)
+        df = pd.DataFrame({'fire_id': np.repeat(df['fire_id'].values, ndays),
+          'clump_id': np.repeat(df['id'].values, ndays),
+          'date': pd.to_datetime(days, unit='D'),
+          'area': np.repeat(df['area'].values / ndays, ndays),
+          'x': np.repeat(df['x'].values, ndays),
+          'y': np.repeat(df['y'].values, ndays)})
         # Gapfill the clump IDs
-        mdclumps['clump_id'] = ('99999' + mdclumps.index.astype(str)).astype(int)
-        df = df[df['start_date'] == df['end_date']].copy()
-        df.rename(columns={'start_date': 'date', 'id': 'clump_id'}, inplace=True)
-        # Concat all of the clumps back together
-        df = pd.concat((df, mdclumps))
-        df['date'] = pd.to_datetime(df['date'])
+        df.loc[multi_day, 'clump_id'] = np.char.add('99999', 
+          np.arange(multi_day.sum()).astype(str)).astype('int64')
         df = event_rep.merge(df, on='fire_id')
         totarea = df[['tmp_event','area']].groupby('tmp_event', as_index=False).sum()
         # Calculate the fraction of the total event area for this source type that occured on the
@@ -311,14 +400,12 @@ class Reconciliation():
         df = pd.merge(df, totarea, on='tmp_event', how='left', suffixes=['','_tot'])
         df['frac'] = df['area']/df['area_tot']
         # Aggregate fractions to a single date and location for an event
-        # Cannot aggregate over a geometry data type so set a wkb column, agg and remerge
-        df['wkt'] = df['location'].apply(lambda x: x.wkt)
-        locs = df[['wkt','location']].drop_duplicates('wkt')
-        idx = ['tmp_event','date','wkt','clump_id']
+        idx = ['tmp_event','date','clump_id','x','y']
         df = df[idx+['frac',]].groupby(idx, as_index=False).sum()
-        df = pd.merge(df, locs, on='wkt', how='left')
-        print('Records with clump ID: %s' %len(df[['tmp_event','clump_id','date','location','frac']].drop_duplicates(['tmp_event','clump_id','date','location'])))
-        print('Records without clump ID: %s' %len(df[['tmp_event','clump_id','date','location','frac']].drop_duplicates(['tmp_event','date','location'])))
+        df['location'] = gpd.points_from_xy(df['x'], df['y'], crs='EPSG:4326')
+        print('Records with clump ID: %s' %len(df.drop_duplicates(['tmp_event','clump_id','date','x','y'])))
+        print('Records without clump ID: %s' %len(df.drop_duplicates(['tmp_event','date','x','y'])))
+        print('\tSet %s event days in %s' %(len(df), datetime.now() - start), flush=True)
         return df[['tmp_event','clump_id','date','location','frac']].copy()
 
     def _write_event_data(self, db):
@@ -326,18 +413,28 @@ class Reconciliation():
         Push the raw data to the postgres DB
         '''
         print('Writing events', flush=True)
-        seq = pd.Series([self._get_next_id(db, 'event_seq') for x in range(len(self.events))])
-        self.events['id'] = seq
-        uniq_id = pd.Series([uuid.uuid1().hex for x in range(len(self.events))])
-        self.events['unique_id'] = uniq_id
+        if 'status' not in self.events.columns:
+            self.events['status'] = 'inserted'
+            self.events['id'] = -9
+            self.events['unique_id'] = ''
+        # Only the inserted events get new IDs
+        idx = self.events['status'] == 'inserted'
+        if idx.any():
+            self.events.loc[idx, 'id'] = db.next_ids('event_seq', idx.sum())
+            self.events.loc[idx, 'unique_id'] = [uuid.uuid1().hex for x in range(idx.sum())]
         self.events['reconciliationstream_id'] = self.stream_id
         self.events['create_date'] = date.today()
         self.events['display_name'] = self.events['display_name'].fillna('Unknown Fire')
         self.events = gpd.GeoDataFrame(self.events, geometry='outline_shape')
-        # Append the new events
+        # Append the new events. The writes are queued so that the event fires and days are set
+        #  while the DB writes.
         cols = ['id','create_date','display_name','end_date','outline_shape','probability',
           'start_date','total_area','unique_id','reconciliationstream_id','fire_type']
-        self.events[cols].to_postgis(name='event', con=db.engine, if_exists='append', index=False)
+        db.submit(db.write, self.events.loc[idx, cols], 'event')
+        # Update the changed events in place
+        idx = self.events['status'] == 'updated'
+        if idx.any():
+            db.submit(db.update, self.events.loc[idx, cols], 'event')
 
     def _write_event_fires(self, db):
         '''
@@ -346,27 +443,140 @@ class Reconciliation():
         '''
         # Append all of the newly reconciled events 
         cols = ['fire_id','event_id']
-        df = pd.merge(self.events[['id','tmp_event']], self.srcmap[['tmp_event','fire_id']], 
-          on='tmp_event', how='left')
+        events = self.events.loc[self.events['status'] == 'inserted', ['id','tmp_event']]
+        df = pd.merge(events, self.srcmap[['tmp_event','fire_id']], on='tmp_event', how='left')
         df.rename(columns={'id': 'event_id'}, inplace=True)
-        df[cols].to_sql(name='event_fires', con=db.engine, if_exists='append', index=False)
+        db.submit(db.write, df[cols], 'event_fires')
 
     def _write_event_days(self, db, df):
         '''
         Write the daily event date by location
         Takes the set event days output: df[['tmp_event','date','location','frac','clump_id']]
-        '''
-        events_area = self.events[['tmp_event','id','total_area']].drop_duplicates('tmp_event')
-        df = pd.merge(df, events_area, on='tmp_event', how='left')
+        Days are only written for inserted or updated events. The days of the updated events
+          are replaced.
+        '''
+        idx = self.events['status'].isin(('inserted','updated'))
+        events_area = self.events.loc[idx, ['tmp_event','id','total_area']].drop_duplicates('tmp_event')
+        updated = tuple(self.events.loc[self.events['status'] == 'updated', 'id'])
+        if updated:
+            db.submit(db.delete, 'event_day', {'event_id': updated})
+        df = pd.merge(df, events_area, on='tmp_event')
         df.rename(columns={'id': 'event_id', 'date': 'event_date'}, inplace=True)
         df['daily_area'] = df['frac'] * df['total_area']
-        seq = pd.Series([self._get_next_id(db, 'event_day_seq') for x in range(len(df))])
-        df['id'] = seq
+        df['id'] = db.next_ids('event_day_seq', len(df))
         df = gpd.GeoDataFrame(df, geometry='location')
         df['clump_id'] = df['clump_id'].fillna(-9).astype(int)
         # Append all of the newly reconciled events 
         cols = ['id','daily_area','event_date','event_id','clump_id','location']
-        df[cols].to_postgis(name='event_day', con=db.engine, if_exists='append', index=False)
+        db.submit(db.write, df[cols], 'event_day')
+        self.event_days = df[cols]
+
+    def _get_membership_keys(self, df, event_col):
+        '''
+        Build a key for each event from the sorted set of its member fire IDs
+        '''
+        df = df[[event_col,'fire_id']].drop_duplicates().sort_values([event_col,'fire_id'])
+        df['member_key'] = df['fire_id'].astype(int).astype(str)
+        return df.groupby(event_col, as_index=False)['member_key'].agg(','.join)
+
+    def _get_stored_events(self, db):
+        '''
+        Get the stored events for this stream in the date range along with their membership keys
+          and event day keys
+        '''
+        cols = ['id','unique_id','display_name','start_date','end_date','total_area',
+          'probability','fire_type','outline_shape']
+        df = db.select('event', cols, where={'reconciliationstream_id': self.stream_id}, 
+          dates=(self.start_date, self.end_date), geom_col='outline_shape')
+        df = pd.DataFrame(df)
+        event_ids = list(df['id'])
+        event_fires = db.select('event_fires', ['event_id','fire_id'], 
+          where={'event_id': event_ids})
+        df = df.merge(event_fires.rename(columns={'event_id': 'id'}), on='id')
+        keys = self._get_membership_keys(df, 'id')
+        days = db.select('event_day', ['event_id','event_date','daily_area','location'],
+          where={'event_id': event_ids}, geom_col='location')
+        days = self._get_day_keys(days.rename(columns={'event_id': 'id'}), 'id')
+        df = df.drop('fire_id', axis=1).drop_duplicates('id').merge(keys, on='id')
+        return df.merge(days, on='id', how='left')
+
+    def _get_day_keys(self, df, event_col):
+        '''
+        Build a hash for each event from its event day dates, locations and areas. The rows are
+          hashed one by one and summed so that the key does not depend on the row order.
+        The gap filled clump IDs of multi-day clumps are numbered across the run so they are
+          left out.
+        '''
+        if df.empty:
+            return pd.DataFrame(columns=[event_col,'day_key'])
+        rows = pd.DataFrame({event_col: df[event_col].values,
+          'date': pd.to_datetime(df['event_date']).dt.strftime('%Y%m%d').values,
+          'x': np.round(df['location'].x.values, 7), 'y': np.round(df['location'].y.values, 7),
+          'area': np.round(df['daily_area'].astype(float).values, 2)})
+        rows['day_key'] = pd.util.hash_pandas_object(rows[['date','x','y','area']], index=False).values
+        df = rows.groupby(event_col, as_index=False)['day_key'].sum()
+        # Held as text so that a merge with missing keys does not cast the hash to float
+        df['day_key'] = df['day_key'].astype(str)
+        return df
+
+    # Event attributes that are compared to find the changed events
+    diff_atts = ['start_date','end_date','display_name','fire_type','total_area','probability',
+      'outline_shape','day_key']
+    # Coordinate tolerance in the projected units for an unchanged event shape
+    shape_tolerance = 1e-6
+    def _diff_events(self, db, event_days):
+        '''
+        Match the newly reconciled events to the stored events for the stream on the set of member
+          fire IDs. Matched events keep their IDs and are flagged as unchanged or updated from their
+          attributes, shape and event days, unmatched events are inserted, and stored events with
+          no match are deleted.
+        '''
+        stored = self._get_stored_events(db)
+        keys = self._get_membership_keys(self.srcmap, 'tmp_event')
+        self.events['display_name'] = self.events['display_name'].fillna('Unknown Fire')
+        self.events = self.events.merge(keys, on='tmp_event', how='left')
+        # The event days as they would be written
+        days = event_days.merge(self.events[['tmp_event','total_area']], on='tmp_event')
+        days['daily_area'] = days['frac'] * days['total_area']
+        days = gpd.GeoDataFrame(days.rename(columns={'date': 'event_date'}), geometry='location')
+        self.events = self.events.merge(self._get_day_keys(days, 'tmp_event'), on='tmp_event',
+          how='left')
+        self.events = self.events.merge(stored, on='member_key', how='left', 
+          suffixes=['','_stored'])
+        self.events.drop_duplicates('tmp_event', inplace=True)
+        matched = self.events['id'].notnull()
+        changed = pd.Series(False, index=self.events.index)
+        for att in self.diff_atts:
+            new = self.events[att]
+            old = self.events['%s_stored' %att]
+            if att in ('start_date','end_date'):
+                changed |= pd.to_datetime(new) != pd.to_datetime(old)
+            elif att in ('total_area','probability'):
+                changed |= ~ np.isclose(new.astype(float), old.astype(float), rtol=1e-9)
+            elif att == 'outline_shape':
+                new = shapely.normalize(np.asarray(new, dtype=object))
+                old = shapely.normalize(np.asarray(old, dtype=object))
+                same = shapely.equals_exact(new, old, tolerance=self.shape_tolerance) | \
+                  (shapely.is_missing(new) & shapely.is_missing(old))
+                changed |= ~ same
+            elif att == 'day_key':
+                changed |= new.fillna('') != old.fillna('')
+            else:
+                changed |= new != old
+        self.events['status'] = 'inserted'
+        self.events.loc[matched, 'status'] = 'unchanged'
+        self.events.loc[matched & changed, 'status'] = 'updated'
+        self.events['id'] = self.events['id'].fillna(-9).astype(int)
+        self.events['unique_id'] = self.events['unique_id'].fillna('')
+        drop_cols = ['%s_stored' %att for att in self.diff_atts] + ['member_key','day_key']
+        self.events.drop(drop_cols, axis=1, inplace=True)
+        # Remove the stored events that no longer match a reconciled event
+        deleted = tuple(stored.loc[~ stored['id'].isin(self.events['id']), 'id'])
+        self._delete_events(db, deleted)
+        counts = self.events['status'].value_counts()
+        print('\tEvents unchanged: %s, updated: %s, inserted: %s, deleted: %s' %(
+          counts.get('unchanged', 0), counts.get('updated', 0), counts.get('inserted', 0), 
+          len(deleted)), flush=True)
 
     def purge_events(self, db, keep_events=''):
         '''
@@ -374,103 +584,108 @@ class Reconciliation():
           event IDs to keep
         '''
         print(f'Purging tables of events from stream {self.stream_id}', flush=True)
-        # Query the event IDs for the reconciliation stream in this date range
-        q = """SELECT id FROM event WHERE reconciliationstream_id = %(streamid)s AND \
-          (daterange(start_date, end_date, '[]') && \
-          daterange('%(startdate)s', '%(enddate)s', '[]'))"""
-        # optionally ignore event IDs in the list
-        if keep_events:
-            q += ' AND id NOT IN %(eventids)s'
-        q = text(q % {'streamid': self.stream_id, 'startdate': self.start_date, 
-          'enddate': self.end_date, 'eventids': keep_events})
-        df = pd.read_sql(q, con=db.engine)
-        event_ids = tuple(df['id'].drop_duplicates())
-        if event_ids:
-            # Drop the queried event IDs from the 3 event tables
-            ef = 'DELETE FROM event_fires WHERE event_id IN %(eventids)s'
-            ed = 'DELETE FROM event_day WHERE event_id IN %(eventids)s'
-            e = 'DELETE FROM event WHERE id IN %(eventids)s'
-            with db.engine.connect() as conn:
-                result = conn.execute(text(ef % {'eventids': event_ids}))
-                result = conn.execute(text(ed % {'eventids': event_ids}))
-                result = conn.execute(text(e % {'eventids': event_ids}))
+        # Delete the events for the reconciliation stream in this date range and their fires and
+        #  days in one transaction. Optionally ignore event IDs in the list.
+        n = db.delete_cascade('event', self.event_children,
+          where={'reconciliationstream_id': self.stream_id}, exclude={'id': keep_events},
+          dates=(self.start_date, self.end_date))
+        print('\tPurged %s events' %n, flush=True)
 
-    def _set_fire_dates(self, start_date, end_date):
+    def _delete_events(self, db, event_ids):
         '''
-        Generate a date range set
+        Drop the event IDs from the 3 event tables
         '''
-        return set(pd.date_range(start_date, end_date))
+        if event_ids:
+            db.delete_cascade('event', self.event_children, where={'id': event_ids})
 
-    def reconcile(self, db):
+    def _set_fire_days(self, dates):
         '''
-        Reconcile the underlying source fire data into events
+        Convert a series of dates to integer day ordinals (days since the epoch) so that
+          date range overlaps can be tested as integer interval comparisons
         '''
-        event_ids = self._get_event_ids(db)
+        return pd.to_datetime(dates).values.astype('datetime64[D]').astype('int64')
+
+    def _load_fires(self, db, existing=True):
+        '''
+        Load the unreconciled fires and the existing events in the date range into a single
+          frame along with the reconciliation uncertainty of the sources. Returns the frame and
+          the fire IDs of the existing events. Optionally ignore the existing events and load
+          all of the fires in the date range.
+        '''
+        if self.incremental:
+            # Only the existing events around the new fires are reconciled again. Their member
+            #  fires are linked again with the new fires.
+            df = self._get_fires(db, new_only=True)
+            members, rec_fires = self._get_touched_fires(db, df)
+            df = pd.concat((df, members), ignore_index=True)
+            event_ids = ()
+        elif existing:
+            event_ids = self._get_event_ids(db)
+        else:
+            event_ids = ()
         if event_ids:
             rec_fires = self._get_reconciled_fire_ids(db, event_ids)
-            fire_ids = tuple(rec_fires['id'])
-            df = self._get_fires(db, fire_ids)
+            if not self.incremental:
+                df = self._get_fires(db, tuple(rec_fires['id']))
             recon_events = self._get_reconciled_events(db, event_ids)
             # Append already reconciled events that fall within this time frame to the unreconciled fires
             df = pd.concat((df, recon_events))
         else:
-            df = self._get_fires(db)
+            if not self.incremental:
+                df = self._get_fires(db)
+                rec_fires = pd.DataFrame(columns=['event_id','id'])
             df['event_id'] = -9
-            rec_fires = pd.DataFrame(columns=['event_id','id'])
         # Bring in the relevant reconciliation parameters for the sources
         cols = ['source_id','start_date_uncertainty','end_date_uncertainty','location_uncertainty']
         df = pd.merge(df, self.source_atts[cols], on='source_id', how='left')
-        # Change the uncertainty to a timedelta with a default of 0.
+        # Set the uncertainty in days with a default of 0.
         #  The default should only be applied to existing events.
-        df['start_date_uncertainty'] = pd.to_timedelta(df['start_date_uncertainty'].fillna(0), 
-          unit='D')
-        df['end_date_uncertainty'] = pd.to_timedelta(df['end_date_uncertainty'].fillna(0), 
-          unit='D')
+        df['start_date_uncertainty'] = df['start_date_uncertainty'].fillna(0).astype(int)
+        df['end_date_uncertainty'] = df['end_date_uncertainty'].fillna(0).astype(int)
         df['location_uncertainty'] = df['location_uncertainty'].fillna(0)
-        # Set the date range without the reconciliation buffer added
-        df['date_range'] = df[['start_date','end_date']].apply(lambda row: \
-          self._set_fire_dates(*row), axis=1)
-        # Fill in dummy default values for matching and sorting
-        df['tmp_event'] = df.index
+        # Set the day interval without the reconciliation buffer added
+        df['start_day'] = self._set_fire_days(df['start_date'])
+        df['end_day'] = self._set_fire_days(df['end_date'])
+        # Fill in dummy default values for matching and sorting. The daily linking keeps the
+        #  lowest tmp_event of a fire, so the fires are numbered in ID order whatever order they
+        #  were loaded in.
+        df = df.sort_values('id', na_position='last', kind='stable').reset_index(drop=True)
+        df['tmp_event'] = df.index + 1
         df.loc[df['event_id'] > 0, 'tmp_event'] = -9
         df['event_id'] = df['event_id'].fillna(-9)
         df['id'] = df['id'].fillna(-9)
+        return df, rec_fires
+
+    def _link_fires(self, df):
+        '''
+        Default method to assign a tmp_event to every fire by iterating over each day in the
+          reconciliation date range. Existing events that are not reconciled with any new fires
+          keep a tmp_event of -9.
+        A fire that links with the fires of several events on a day joins the event with the
+          lowest tmp_event and the other events are not merged with it, unlike the connected
+          components of the graph engine.
+        '''
         # Flag to identify if a fire has already been selected to reconcile, not if it has been
         # Even if a fire isn't reconciled against another fire it becomes part of an event and
         #  doesn't need to be newly reconciled, but can still be reconciled against 
         df['reconciled'] = 0 
-        # Set the date range for the loop
-        days = list(set(list(df['start_date'].drop_duplicates()) + \
-          list(df['end_date'].drop_duplicates())))
-        days.sort()
-        print('Reconciling %s: %s to %s' %(self.name, self.start_date, self.end_date))
-        print('\tReconciling %s fires' %len(df))
+        # Set the days for the loop
+        days = list(np.unique(np.concatenate((df['start_day'].values, df['end_day'].values))))
         bar = Bar('Reconciling', max=len(days))
         # Iterate over the days in the reconcilation date range to get a mapping of fire IDs to reconcile into events
         for day in days:
-            today = df[(df['start_date'] <= day) & (df['end_date'] >= day) & \
-              (df['reconciled'] == 0)].copy()
+            idx = (df['start_day'] <= day) & (df['end_day'] >= day) & (df['reconciled'] == 0)
+            today = df[idx].copy()
             if not today.empty:
                 # Update the "reconciled" flag for the fires going through the process
-                df.loc[(df['start_date'] <= day) & (df['end_date'] >= day) & \
-                  (df['reconciled'] == 0), 'reconciled'] = 1
-                # Set the date ranges with uncertainty for each of the fire records contained
-                today['start_date'] = today[['start_date','start_date_uncertainty']].\
-                  apply(lambda row: row.start_date - row.start_date_uncertainty, axis=1) 
-                today['end_date'] = today[['end_date','end_date_uncertainty']].\
-                  apply(lambda row: row.end_date + row.end_date_uncertainty, axis=1) 
-                today['date_range'] = today[['start_date','end_date']].apply(lambda row: \
-                  self._set_fire_dates(*row), axis=1)
-                # Get the widest possible date range for this day
-                uncertain_date_range = set(pd.date_range(today.start_date.min(), 
-                  today.end_date.max()))
-                # Set an index of the data range for the record to select overlapping activity
-                # Uses an intersection of sets of date ranges
-                df['date_intersect'] = df['date_range'].apply(lambda firedays: \
-                  firedays & uncertain_date_range)
-                # Select any records that overlap the date range
-                day_match = df.loc[df['date_intersect'] != set(), 
-                  ['shape','id','date_range','tmp_event']].copy()
+                df.loc[idx, 'reconciled'] = 1
+                # Widen the day intervals with the uncertainty for each of the fire records contained
+                today['start_day'] = today['start_day'] - today['start_date_uncertainty']
+                today['end_day'] = today['end_day'] + today['end_date_uncertainty']
+                # Select any records that overlap the widest possible day interval for this day
+                overlap = (df['start_day'] <= today['end_day'].max()) & \
+                  (df['end_day'] >= today['start_day'].min())
+                day_match = df.loc[overlap, ['shape','id','start_day','end_day','tmp_event']].copy()
                 # Convert the uncertainty from km->m and change to a radius
                 today['radius'] = today['location_uncertainty'] * 1000 / 2
                 # Apply the buffer to the shapes for this day
@@ -482,9 +697,8 @@ class Reconciliation():
                 # Keep spatial intersections that also have date range intersections
                 #today = today[today['tmp_event_1'].notnull()].copy()
                 today.drop('shape', axis=1, inplace=True)
-                today['date_intersect'] = today[['date_range_1','date_range_2']].apply(lambda row: \
-                  row.date_range_1 & row.date_range_2, axis=1)
-                today = today[today['date_intersect'] != set()].copy()
+                today = today[(today['start_day_1'] <= today['end_day_2']) & \
+                  (today['end_day_1'] >= today['start_day_2'])].copy()
                 # Fill in fire IDs where there is a fire on the day with no spatial intersect
                 today.loc[today['id_2'].isnull(), 'id_2'] = \
                   today.loc[today['id_2'].isnull(), 'id_1']
@@ -504,6 +718,20 @@ class Reconciliation():
                   df.loc[df['tmp_event_today'].notnull(), 'tmp_event_today']
                 df.drop('tmp_event_today', axis=1, inplace=True)
             bar.next()
+        bar.finish()
+        return df
+
+    def reconcile(self, db):
+        '''
+        Reconcile the underlying source fire data into events
+        '''
+        start_trips = db.round_trips
+        # The diff write mode recomputes every event in the date range from the fires
+        df, rec_fires = self._load_fires(db, existing=(self.write_mode != 'diff'))
+        print('Reconciling %s: %s to %s' %(self.name, self.start_date, self.end_date))
+        print('\tReconciling %s fires' %len(df))
+        if not df.empty:
+            df = self._link_fires(df)
         # Set aside reconciled events in time range that are not reconciled in with new fires 
         idx = ((df['event_id'] > 0) & (df['tmp_event'] == -9))
         # Get a list of event IDs to not delete when updating DB tables
@@ -512,13 +740,16 @@ class Reconciliation():
         df = df.loc[(df['tmp_event'] > 0), ['event_id','id','tmp_event']].drop_duplicates()
         if df.empty:
             print('\n\tNo new events reconciled for this date range')
+            if self.write_mode == 'diff':
+                self.purge_events(db)
         else:
             print('\n\tReconciled into %s new events' %len(df['tmp_event'].drop_duplicates()))
-            # Get a list of event IDs to drop when updating fire_events table
-            drop_events = tuple(df.loc[df['event_id'].notnull(), 'event_id'].drop_duplicates())
-            if len(drop_events) == 1:
-                drop_events = (drop_events[0], -9)
-            if not rec_fires.empty:
+            # Get a list of the existing event IDs that are reconciled into new events
+            drop_events = tuple(df.loc[df['event_id'] > 0, 'event_id'].drop_duplicates().astype(int))
+            if self.incremental:
+                # The touched events are replaced by the events linked from their member fires
+                drop_events = tuple(rec_fires['event_id'].drop_duplicates().astype(int))
+            elif not rec_fires.empty:
                 df = pd.merge(df, rec_fires, on='event_id', how='left', suffixes=['','_event'])
                 # Fill in the fire IDs for the merged-in events
                 df.loc[df['id'] < 0, 'id'] = df.loc[df['id'] < 0, 'id_event']
@@ -531,12 +762,56 @@ class Reconciliation():
             event_days = self._set_event_days(db)
             # Set the event fire dates from a dataframe of tmp_event IDs and associated dates
             self._set_event_fire_dates(db, event_days[['tmp_event','date']].drop_duplicates())
-            # Remove the existing events that are reconciled into new events
-            self.purge_events(db, keep_events)
+            if self.write_mode == 'diff':
+                # Match against the stored events and only write the changes
+                self._diff_events(db, event_days)
+            elif self.incremental:
+                # Only remove the touched events
+                self._delete_events(db, drop_events)
+            else:
+                # Remove the existing events that are reconciled into new events
+                self.purge_events(db, keep_events)
             # Write the reconciled event table
             self._write_event_data(db) 
             # Write the event_id/fire_id xref table
             self._write_event_fires(db)
             # Write the daily fire event area and locations
             self._write_event_days(db, event_days)
-            bar.finish()
+            # Kept, unchanged and unreconciled events are only in the DB
+            if self.write_mode == 'diff':
+                self.complete = not (self.events['status'] == 'unchanged').any()
+            else:
+                self.complete = not self.incremental and not keep_events
+            # Update the planner statistics for the new rows
+            db.submit(db.analyze, 'event', 'event_fires', 'event_day')
+        # The queued writes finish while the next stage starts. The next table operation that is
+        #  called directly waits for them.
+        print('\tDB round trips: %s, %s queued operations writing' %(db.round_trips - start_trips,
+          db.pending()))
+
+def get_reconciliation(method='daily'):
+    '''
+    Get the reconciliation class for the reconciliation method set in the stream config
+    '''
+    method = method.lower().strip()
+    if method == 'daily':
+        return Reconciliation
+    try:
+        recon_module = importlib.import_module('reconcile.%s' %method)
+    except ImportError as e:
+        raise ImportError('Invalid reconciliation method in configuration')
+    else:
+        return getattr(recon_module, '%sReconciliation' %method.capitalize())
+
+def get_shared_fires(db, streams):
+    '''
+    Load the fires for the union of the sources and the date ranges of several reconciliation
+      streams in one query
+    '''
+    source_ids = sorted(set([x for stream in streams for x in stream.source_ids]))
+    start_date = min([pd.to_datetime(stream.start_date) for stream in streams])
+    end_date = max([pd.to_datetime(stream.end_date) for stream in streams])
+    cols = ['id','source_id','area','shape','start_date','end_date','fire_name','fire_type',
+      'probability']
+    return db.select('fire', cols, where={'source_id': source_ids}, 
+      dates=(start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d')), geom_col='shape')
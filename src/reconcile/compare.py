@@ -0,0 +1,197 @@
+'''
+Run two reconciliation engines on the same stream and fires and compare the events. Events are
+  matched on their member fires since the IDs differ between runs.
+'''
+import os.path
+import importlib.util
+from multiprocessing import get_context
+import numpy as np
+import pandas as pd
+from database import get_database
+from instrument import Instrument
+from . import get_reconciliation
+
+def load_engine(engine):
+    '''
+    Get a reconciliation class from a method name (eg. daily or graph) or from the path of a
+      module file with a Reconciliation class (eg. reconcile/__init__.old.py)
+    '''
+    if os.path.isfile(engine):
+        name = 'reconcile_%s' %os.path.basename(engine).replace('.','_')
+        spec = importlib.util.spec_from_file_location(name, engine)
+        engine_module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(engine_module)
+        return engine_module.Reconciliation
+    return get_reconciliation(engine)
+
+def get_stream_events(db, stream_id):
+    '''
+    Read back the events, member fires and event days written for a stream
+    '''
+    events = db.select('event', ['id','start_date','end_date','total_area','outline_shape'],
+      where={'reconciliationstream_id': stream_id}, geom_col='outline_shape')
+    event_ids = [int(x) for x in events['id']]
+    event_fires = db.select('event_fires', ['fire_id','event_id'], where={'event_id': event_ids})
+    event_days = db.select('event_day', ['event_id','event_date','daily_area'],
+      where={'event_id': event_ids})
+    return events, event_fires, event_days
+
+def run_engine(engine, config, db=None):
+    '''
+    Reconcile the stream from scratch with an engine. Returns the stream output with the run
+      time, round trips and memory of the reconcile step.
+    '''
+    if db is None:
+        db = get_database('config/pg.json')
+    run = Instrument(db, 'compare')
+    a = load_engine(engine)(config, db)
+    # Compare full runs
+    a.write_mode = 'replace'
+    a.incremental = False
+    a.purge_events(db)
+    with run.step(engine, 'reconcile') as rec:
+        a.reconcile(db)
+        # Include the queued writes in the run time
+        db.wait()
+    return {'engine': engine, 'step': rec, 'output': get_stream_events(db, a.stream_id)}
+
+def _run_engine(engine, config, db, conn):
+    conn.send(run_engine(engine, config, db))
+    conn.close()
+
+def run_engines(engines, config, db):
+    '''
+    Run each engine in its own process so that the peak memory is for that engine alone. With
+      the local backend each process starts from a copy of the same tables.
+    '''
+    ctx = get_context('fork')
+    # No queued DB write can be running when the engine processes fork
+    db.wait()
+    runs = []
+    for engine in engines:
+        print('Reconciling with %s' %engine, flush=True)
+        recv, send = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=_run_engine, args=(engine, config,
+          None if db.multiprocess else db, send))
+        proc.start()
+        send.close()
+        try:
+            runs.append(recv.recv())
+        except EOFError:
+            raise ValueError('Reconciliation with %s failed' %engine)
+        proc.join()
+    return runs
+
+def _get_member_keys(event_fires):
+    '''
+    Key each event on the sorted set of its member fire IDs
+    '''
+    df = event_fires[['event_id','fire_id']].drop_duplicates()
+    df['fire_id'] = df['fire_id'].astype(int)
+    df = df.sort_values(['event_id','fire_id'])
+    df['fire_id'] = df['fire_id'].astype(str)
+    df = df.groupby('event_id', as_index=False)['fire_id'].agg(','.join)
+    return df.rename(columns={'fire_id': 'member_key'})
+
+def _get_split_events(event_fires_a, event_fires_b, event_ids):
+    '''
+    Get the events of the second run in the event IDs that are split into several events of the
+      first run, which are each made up of fires of that event alone, and the IDs of the pieces
+    '''
+    df = event_fires_b.loc[event_fires_b['event_id'].isin(event_ids), ['event_id','fire_id']]
+    df = df.merge(event_fires_a[['event_id','fire_id']], on='fire_id', how='left',
+      suffixes=['_b','_a'])
+    pieces = event_fires_a[event_fires_a['event_id'].isin(df['event_id_a'])]
+    pieces = pieces.merge(event_fires_b[['event_id','fire_id']], on='fire_id', how='left',
+      suffixes=['_a','_b'])
+    # Pieces with all of their fires in one event of the second run
+    within = pieces.groupby('event_id_a')['event_id_b'].agg(['nunique','count','size'])
+    within = within[(within['nunique'] == 1) & (within['count'] == within['size'])].index
+    # Split events with all of their fires in pieces that are within them
+    split = df.groupby('event_id_b')['event_id_a'].agg(lambda x: x.notnull().all() and
+      x.isin(within).all() and x.nunique() > 1)
+    split = split[split].index
+    return split, df.loc[df['event_id_b'].isin(split), 'event_id_a'].drop_duplicates()
+
+def compare_events(output_a, output_b, area_tol=1e-6, shape_tol=1e-3, frac_tol=1e-6):
+    '''
+    Compare the events of two runs
+    area_tol: relative difference in total area
+    shape_tol: symmetric difference area of the outline shapes as a fraction of the union area
+    frac_tol: absolute difference in the share of the event area on each event day
+    Returns the summary counts and a frame of the differences by event. The unmatched events of
+      one run that are split into several events of the other run are counted as splits.
+    '''
+    events = []
+    for events_df, event_fires, event_days in (output_a, output_b):
+        df = events_df.merge(_get_member_keys(event_fires), left_on='id', right_on='event_id')
+        # Share of the event area on each day across the event day locations
+        days = event_days.groupby(['event_id','event_date'], as_index=False)['daily_area'].sum()
+        days = days.merge(df[['id','member_key','total_area']], left_on='event_id', right_on='id')
+        days['frac'] = days['daily_area'] / days['total_area'].where(days['total_area'] != 0)
+        events.append((df, days))
+    (a, days_a), (b, days_b) = events
+    df = a.drop(columns='event_id').merge(b.drop(columns='event_id'), on='member_key', how='outer',
+      suffixes=['_a','_b'], indicator=True)
+    df['status'] = df['_merge'].astype(str).map({'left_only': 'only_a', 'right_only': 'only_b',
+      'both': 'matched'})
+    unmatched = df[df['status'] != 'matched'].copy()
+    summary = {'events_a': len(a), 'events_b': len(b), 'matched': int((df['status'] == 'matched').sum()),
+      'only_a': int((df['status'] == 'only_a').sum()), 'only_b': int((df['status'] == 'only_b').sum())}
+    # Unmatched events that are split into several unmatched events of the other run
+    event_fires_a, event_fires_b = output_a[1], output_b[1]
+    split_b, pieces_a = _get_split_events(event_fires_a, event_fires_b, unmatched['id_b'].dropna())
+    split_a, pieces_b = _get_split_events(event_fires_b, event_fires_a, unmatched['id_a'].dropna())
+    unmatched.loc[unmatched['id_b'].isin(split_b), 'status'] = 'split_b'
+    unmatched.loc[unmatched['id_a'].isin(pieces_a), 'status'] = 'piece_a'
+    unmatched.loc[unmatched['id_a'].isin(split_a), 'status'] = 'split_a'
+    unmatched.loc[unmatched['id_b'].isin(pieces_b), 'status'] = 'piece_b'
+    summary.update({'split_a': len(split_a), 'pieces_b': len(pieces_b), 'split_b': len(split_b),
+      'pieces_a': len(pieces_a)})
+    df = df[df['status'] == 'matched'].copy()
+    # Dates and areas
+    df['dates_differ'] = (pd.to_datetime(df['start_date_a']) != pd.to_datetime(df['start_date_b'])) | \
+      (pd.to_datetime(df['end_date_a']) != pd.to_datetime(df['end_date_b']))
+    df['area_diff'] = (df['total_area_a'] - df['total_area_b']).abs() / \
+      df[['total_area_a','total_area_b']].abs().max(axis=1).where(lambda x: x > 0, 1)
+    # Shapes
+    shape_a = df['outline_shape_a'].values
+    shape_b = df['outline_shape_b'].values
+    union = np.array([x.union(y).area if x is not None and y is not None else 0 for x, y in
+      zip(shape_a, shape_b)])
+    sym = np.array([x.symmetric_difference(y).area if x is not None and y is not None else 0 for
+      x, y in zip(shape_a, shape_b)])
+    df['shape_diff'] = np.where(union > 0, sym / np.where(union > 0, union, 1), 0)
+    # Event day fractions
+    days = days_a[['member_key','event_date','frac']].merge(days_b[['member_key','event_date','frac']],
+      on=['member_key','event_date'], how='outer', suffixes=['_a','_b'])
+    days = days[days['member_key'].isin(df['member_key'])]
+    days['frac_diff'] = (days['frac_a'] - days['frac_b']).abs().fillna(1)
+    frac_diff = days.groupby('member_key', as_index=False)['frac_diff'].max()
+    df = df.merge(frac_diff, on='member_key', how='left')
+    df['frac_diff'] = df['frac_diff'].fillna(0)
+    summary.update({'dates_differ': int(df['dates_differ'].sum()),
+      'area_differ': int((df['area_diff'] > area_tol).sum()),
+      'shape_differ': int((df['shape_diff'] > shape_tol).sum()),
+      'days_differ': int((df['frac_diff'] > frac_tol).sum()),
+      'max_area_diff': float(df['area_diff'].max()) if len(df) else 0.0,
+      'max_shape_diff': float(df['shape_diff'].max()) if len(df) else 0.0,
+      'max_frac_diff': float(df['frac_diff'].max()) if len(df) else 0.0})
+    idx = df['dates_differ'] | (df['area_diff'] > area_tol) | (df['shape_diff'] > shape_tol) | \
+      (df['frac_diff'] > frac_tol)
+    df['status'] = 'differs'
+    cols = ['status','member_key','id_a','id_b','dates_differ','area_diff','shape_diff','frac_diff']
+    df = pd.concat((unmatched.reindex(columns=cols), df.loc[idx, cols]), ignore_index=True)
+    return summary, df
+
+def count_mismatches(summary, splits=False):
+    '''
+    Count the events of a comparison that are only in one run or that differ between the runs
+    splits: leave out the events of the second run that are split into several events of the
+      first run and their pieces
+    '''
+    n = sum([summary[key] for key in ('only_a','only_b','dates_differ','area_differ',
+      'shape_differ','days_differ')])
+    if splits:
+        n -= summary['split_b'] + summary['pieces_a']
+    return n
@@ -0,0 +1,65 @@
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from . import Reconciliation
+
+def get_candidate_pairs(df):
+    '''
+    Get the pairs of frame positions where the buffered shape of the first fire intersects
+      the shape of the second fire and the uncertainty widened day interval of the first fire
+      overlaps the day interval of the second fire
+    '''
+    # Convert the uncertainty from km->m and change to a radius
+    radius = df['location_uncertainty'].values * 1000 / 2
+    buffered = df['shape'].buffer(radius, resolution=24)
+    left, right = df.sindex.query(buffered.values, predicate='intersects')
+    start_day = df['start_day'].values
+    end_day = df['end_day'].values
+    unc_start = start_day - df['start_date_uncertainty'].values
+    unc_end = end_day + df['end_date_uncertainty'].values
+    idx = (unc_start[left] <= end_day[right]) & (unc_end[left] >= start_day[right])
+    return left[idx], right[idx]
+
+class GraphReconciliation(Reconciliation):
+    '''
+    Reconcile all of the fires in a single pass. Every fire is buffered by the location
+      uncertainty of its source once, all of the spatial candidate pairs are found with one bulk
+      spatial index query, and the events are the connected components of the candidate pairs
+      that also overlap in time.
+    Every chain of linked fires is one event. The daily engine keeps a fire that links with the
+      fires of several events on a day in the event with the lowest tmp_event and does not merge
+      those events, so it can split a graph event into several events. Each daily event is a
+      graph event or a piece of one. check_engines.py checks that this is the only difference.
+    '''
+    steps = Reconciliation.steps + ['_get_candidate_pairs',]
+
+    def __init__(self, config, db):
+        super().__init__(config, db)
+
+    def _get_candidate_pairs(self, df):
+        '''
+        Get all of the candidate pairs for the frame
+        '''
+        return get_candidate_pairs(df)
+
+    def _link_fires(self, df):
+        '''
+        Assign a tmp_event to every fire from the connected components of the candidate pairs.
+          Components with no new fires are existing events that are left as they are and
+          keep a tmp_event of -9.
+        '''
+        start = datetime.now()
+        df = df.reset_index(drop=True)
+        left, right = self._get_candidate_pairs(df)
+        graph = coo_matrix((np.ones(len(left), dtype=bool), (left, right)), 
+          shape=(len(df), len(df)))
+        n_comp, labels = connected_components(graph, directed=False)
+        df['tmp_event'] = labels + 1
+        # Leave alone any component that is made up of only existing events
+        new_fire = pd.Series(df['event_id'].values <= 0).groupby(labels).transform('any')
+        df.loc[~ new_fire.values, 'tmp_event'] = -9
+        print('\tLinked %s candidate pairs into %s components in %s' %(len(left), n_comp, 
+          datetime.now() - start))
+        return df
@@ -1,14 +1,30 @@
 #!/usr/bin/env python3
 
 import sys
-from database import DataBase
+import json
+from database import get_database
+from instrument import Instrument
 from reconcile import *
 from exports import *
 
 config = sys.argv[1]
-db = DataBase('config/pg.json')
-a = Reconciliation(config, db)
-a.purge_events(db)
-a.reconcile(db)
-a = Export(config, db)
-a.export(db)
+with open(config) as f:
+    stream = json.load(f)
+method = stream.get('reconciliation_method', 'daily')
+db = get_database('config/pg.json')
+export = get_export(stream.get('export_method', 'bsf'))
+export.check_backend(db)
+run = Instrument(db, 'reconcile_%s' %stream['name'], stream)
+# The stages share one connection and transaction
+with db.session():
+    with run.step(get_reconciliation(method).__name__, 'setup'):
+        a = run.attach(get_reconciliation(method)(config, db))
+    # The diff write mode and incremental reconciliation only change the affected events
+    if a.write_mode != 'diff' and not a.incremental:
+        a.purge_events(db)
+    a.reconcile(db)
+    with run.step(export.__name__, 'setup'):
+        a = run.attach(export(config, db, reconciliation=a))
+    a.export(db)
+run.write()
+db.close()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+'''
+Reconcile several streams in one pass. The fires for the union of the stream sources are
+  loaded once and shared with the stream workers.
+Usage: reconcile_streams.py [--workers N] stream_a.json [stream_b.json ...]
+The streams run in a pool of worker processes, by default one per CPU.
+'''
+
+import os
+import json
+import argparse
+from multiprocessing import get_context
+from database import get_database
+from instrument import Instrument
+from reconcile import *
+from exports import *
+
+def load_config(config):
+    with open(config) as f:
+        return json.load(f)
+
+def get_method(config):
+    return load_config(config).get('reconciliation_method', 'daily')
+
+def init_worker():
+    '''
+    Drop the pooled connections that the worker inherits from the parent through fork without
+      closing them, since the parent still uses them
+    '''
+    db.engine.dispose(close=False)
+
+def run_stream(i, db=None):
+    '''
+    Reconcile and export one stream using the shared fires. Each worker opens its own DB unless
+      the storage backend can only be used from one process.
+    '''
+    if db is None:
+        db = get_database('config/pg.json')
+        try:
+            return run_stream(i, db)
+        finally:
+            db.close()
+    config = configs[i]
+    start = (db.round_trips, db.rows_read, db.bytes_read)
+    stream = load_config(config)
+    method = stream.get('reconciliation_method', 'daily')
+    run = Instrument(db, 'reconcile_%s' %stream['name'], stream)
+    # The stages of the stream share one connection and transaction
+    with db.session():
+        with run.step(get_reconciliation(method).__name__, 'setup'):
+            a = run.attach(get_reconciliation(method)(config, db))
+        a.shared_fires = shared_fires
+        # The diff write mode and incremental reconciliation only change the affected events
+        if a.write_mode != 'diff' and not a.incremental:
+            a.purge_events(db)
+        a.reconcile(db)
+        export = get_export(stream.get('export_method', 'bsf'))
+        with run.step(export.__name__, 'setup'):
+            a = run.attach(export(config, db, reconciliation=a))
+        a.export(db)
+    run.write()
+    return (config, db.round_trips - start[0], db.rows_read - start[1], db.bytes_read - start[2])
+
+parser = argparse.ArgumentParser(description='Reconcile several streams in one pass')
+parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+  help='number of stream worker processes (default: the CPU count)')
+parser.add_argument('configs', nargs='+', metavar='stream.json')
+args = parser.parse_args()
+configs = args.configs
+db = get_database('config/pg.json')
+for config in configs:
+    get_export(load_config(config).get('export_method', 'bsf')).check_backend(db)
+run = Instrument(db, 'reconcile_streams')
+with run.step('Reconciliation', 'shared_fires'), db.session():
+    streams = [get_reconciliation(get_method(config))(config, db) for config in configs]
+    shared_fires = get_shared_fires(db, streams)
+print('Loaded %s shared fires for %s streams' %(len(shared_fires), len(streams)))
+round_trips = db.round_trips
+rows_read = db.rows_read
+bytes_read = db.bytes_read
+if db.multiprocess:
+    # The stream workers inherit the shared fires from the parent through fork. The queue is
+    #   finished first so that no DB write is running when the workers fork.
+    db.wait()
+    with get_context('fork').Pool(min(args.workers, len(configs)), init_worker) as pool:
+        stats = pool.map(run_stream, range(len(configs)))
+else:
+    stats = [run_stream(i, db) for i in range(len(configs))]
+print('DB reads by stream:')
+print('\tshared load: %s round trips, %s rows, %.1f MB' %(round_trips, rows_read, bytes_read/1e6))
+for config, trips, rows, size in stats:
+    print('\t%s: %s round trips, %s rows, %.1f MB' %(config, trips, rows, size/1e6))
+    round_trips += trips
+    rows_read += rows
+    bytes_read += size
+print('Total DB reads: %s round trips, %s rows, %.1f MB' %(round_trips, rows_read, bytes_read/1e6))
+run.write()
+db.close()
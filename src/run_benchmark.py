@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+'''
+Run the synthetic benchmark sweep and write the results
+Usage: run_benchmark.py sweep.json [results.json]
+'''
+
+import sys
+import json
+from benchmark import Benchmark
+
+a = Benchmark(sys.argv[1])
+results = a.run()
+if len(sys.argv) > 2:
+    fn = sys.argv[2]
+else:
+    fn = 'benchmark_%s.json' %(results['commit'] or 'results')
+with open(fn, 'w') as f:
+    json.dump(results, f, indent=2)
+print('Benchmark results: %s' %fn)
+for scen in results['scenarios']:
+    print('%s records: %ss, %s MB peak' %(scen['size'], scen['wall_s'], scen['peak_rss_mb']))
+    for rec in scen['steps']:
+        rate = ', %s records/s' %rec['records_per_s'] if rec['records_per_s'] else ''
+        print('\t%s.%s: %ss%s, %s MB peak' %(rec['stage'], rec['step'], rec['wall_s'], rate,
+          rec['peak_rss_mb']))
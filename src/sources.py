@@ -6,14 +6,12 @@ Write the input source table
 
 import sys
 import json
-from sqlalchemy import Table, Column, Integer, String, MetaData, Sequence, FLOAT, DATE, text
-
-class InsVals():
-    def __init__(self, d):
-        for k, v in d.items():
-            setattr(self, k, v)
+import pandas as pd
 
 class DataSource():
+    # Methods recorded as steps by the run instrumentation
+    steps = ['write_source_tables',]
+
     def __init__(self, config):
         self.load_config(config)
         self._set_atts()
@@ -29,12 +27,11 @@ class DataSource():
         Write the source defs. Optionally, clobber the sources that match the name_slug
         ''' 
         if clobber:
-            with db.engine.connect() as conn:
-                result = conn.execute(text("SELECT id from source WHERE name_slug = '%s'" %self.name_slug))
-                source_id = result.first()
-                if source_id:
-                    result = conn.execute(text("DELETE FROM source WHERE id=%s" %source_id[0]))
-                    result = conn.execute(text("DELETE FROM default_weighting WHERE id=%s" %source_id[0]))
+            df = db.select('source', ['id',], where={'name_slug': self.name_slug})
+            if not df.empty:
+                source_id = int(df['id'].values[0])
+                db.delete('source', {'id': source_id})
+                db.delete('default_weighting', {'id': source_id})
         self._write_source_table(db)
         self._write_default_weight_table(db)
 
@@ -70,69 +67,19 @@ class DataSource():
         '''
         Write the source data to the DB
         '''
-        metadata = MetaData()
-        sources = Table('source', metadata,
-          Column('id', Integer, Sequence('source_seq'), primary_key=True),
-          Column('name', String(100), nullable=False),
-          Column('name_slug', String(100), nullable=True),
-          Column('geometry_type', String(100), nullable=False),
-          Column('ingest_method', String(100), nullable=True),
-          Column('clump_method', String(100), nullable=False),
-          Column('assoc_method', String(100), nullable=False),
-          Column('probability_method', String(100), nullable=False),
-          Column('fire_type_method', String(100), nullable=False),
-          Column('granularity', String(100), nullable=False),
-          Column('fire_name_field', String(100), nullable=True),
-          Column('new_data_policy', String(100), nullable=False),
-          Column('latest_data', DATE, nullable=True))
-        ins = sources.insert().values(name=self.name,
-            name_slug=self.name_slug,
-            geometry_type=self.geometry_type,
-            ingest_method=self.ingest_method,
-            clump_method=self.clump_method,
-            assoc_method=self.assoc_method,
-            probability_method=self.probability_method,
-            fire_type_method=self.fire_type_method,
-            granularity=self.granularity,
-            fire_name_field=self.fire_name_field,
-            new_data_policy=self.new_data_policy)
-        with db.engine.connect() as conn:
-            result = conn.execute(ins)
-        with db.engine.connect() as conn:
-            result = conn.execute(text("SELECT id from source WHERE name_slug = '%s'" %self.name_slug))
-        self.source_id = int(result.first()[0])
+        self.source_id = db.next_ids('source_seq')[0]
+        cols = ('name','name_slug','geometry_type','ingest_method','clump_method','assoc_method',
+          'probability_method','fire_type_method','granularity','fire_name_field','new_data_policy')
+        row = dict([('id', self.source_id),] + [(col, getattr(self, col)) for col in cols])
+        db.write(pd.DataFrame([row,]), 'source')
 
     def _write_default_weight_table(self, db):
         '''
         Write the default reconciliation weighting to the table for the source
         '''
-        metadata = MetaData()
-        recon = Table('default_weighting', metadata,
-          Column('id', Integer, primary_key=True),
-          Column('detection_rate', FLOAT, nullable=False),
-          Column('false_alarm_rate', FLOAT, nullable=False),
-          Column('growth_weight', FLOAT, nullable=False),
-          Column('location_weight', FLOAT, nullable=False),
-          Column('shape_weight', FLOAT, nullable=False),
-          Column('size_weight', FLOAT, nullable=False),
-          Column('location_uncertainty', FLOAT, nullable=False),
-          Column('start_date_uncertainty', Integer, nullable=False),
-          Column('end_date_uncertainty', Integer, nullable=False),
-          Column('name_weight', FLOAT, nullable=False),
-          Column('type_weight', FLOAT, nullable=False))
-        vals = InsVals(self.config['reconciliation'])
-        ins = recon.insert().values(id=self.source_id,
-            detection_rate=vals.detection_rate,
-            false_alarm_rate=vals.false_alarm_rate,
-            growth_weight=vals.growth_weight,
-            location_weight=vals.location_weight,
-            shape_weight=vals.shape_weight,
-            size_weight=vals.size_weight,
-            location_uncertainty=vals.location_uncertainty,
-            start_date_uncertainty=vals.start_date_uncertainty,
-            end_date_uncertainty=vals.end_date_uncertainty,
-            name_weight=vals.name_weight,
-            type_weight=vals.type_weight)
-        with db.engine.connect() as conn:
-            result = conn.execute(ins)
-
+        vals = self.config['reconciliation']
+        cols = ('detection_rate','false_alarm_rate','growth_weight','location_weight',
+          'shape_weight','size_weight','location_uncertainty','start_date_uncertainty',
+          'end_date_uncertainty','name_weight','type_weight')
+        row = dict([('id', self.source_id),] + [(col, vals[col]) for col in cols])
+        db.write(pd.DataFrame([row,]), 'default_weighting')
@@ -0,0 +1,10 @@
+-- Add the stored EPSG:4326 clump centroid to an existing database and backfill it
+ALTER TABLE clump ADD COLUMN IF NOT EXISTS centroid geometry;
+
+SELECT UpdateGeometrySRID('clump','centroid',4326);
+
+UPDATE clump SET centroid = ST_CENTROID(ST_TRANSFORM(shape,4326)) WHERE centroid IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_clump_centroid ON clump USING gist (centroid);
+
+ANALYZE clump;
@@ -0,0 +1,34 @@
+-- Indexes for the hot queries. The date range expressions match the WHERE clause built by the
+--  table operations: daterange(start_date::date, end_date::date, '[]') && daterange(...)
+CREATE EXTENSION IF NOT EXISTS btree_gist;
+
+-- Spatial indexes
+CREATE INDEX IF NOT EXISTS idx_fire_shape ON fire USING gist (shape);
+
+CREATE INDEX IF NOT EXISTS idx_clump_shape ON clump USING gist (shape);
+
+CREATE INDEX IF NOT EXISTS idx_event_outline_shape ON event USING gist (outline_shape);
+
+-- Date range indexes
+CREATE INDEX IF NOT EXISTS idx_fire_daterange ON fire USING gist (daterange(start_date::date, end_date::date, '[]'));
+
+CREATE INDEX IF NOT EXISTS idx_clump_daterange ON clump USING gist (daterange(start_date::date, end_date::date, '[]'));
+
+CREATE INDEX IF NOT EXISTS idx_event_daterange ON event USING gist (daterange(start_date::date, end_date::date, '[]'));
+
+-- Composite indexes for the common filters
+CREATE INDEX IF NOT EXISTS idx_fire_source_dates ON fire USING gist (source_id, daterange(start_date::date, end_date::date, '[]'));
+
+CREATE INDEX IF NOT EXISTS idx_clump_source_dates ON clump USING gist (source_id, daterange(start_date::date, end_date::date, '[]'));
+
+CREATE INDEX IF NOT EXISTS idx_event_stream_dates ON event USING gist (reconciliationstream_id, daterange(start_date::date, end_date::date, '[]'));
+
+CREATE INDEX IF NOT EXISTS idx_event_day_event_date ON event_day USING btree (event_id, event_date);
+
+CREATE INDEX IF NOT EXISTS idx_data_attribute_rawdata_name ON data_attribute USING btree (rawdata_id, name);
+
+ANALYZE fire;
+ANALYZE clump;
+ANALYZE event;
+ANALYZE event_day;
+ANALYZE data_attribute;
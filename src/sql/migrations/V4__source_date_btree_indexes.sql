@@ -0,0 +1,13 @@
+-- Replace the GiST source and date range indexes on fire and clump. A GiST index cannot serve
+--  the source_id = ANY(...) filters of the table operations, a btree index can. The date range
+--  filters also carry end_date >= start and start_date < end + 1 bounds for the btree.
+DROP INDEX IF EXISTS idx_fire_source_dates;
+
+CREATE INDEX idx_fire_source_dates ON fire USING btree (source_id, end_date, start_date);
+
+DROP INDEX IF EXISTS idx_clump_source_dates;
+
+CREATE INDEX idx_clump_source_dates ON clump USING btree (source_id, end_date, start_date);
+
+ANALYZE fire;
+ANALYZE clump;
@@ -14,3 +14,6 @@ pguser=sf2
 host=localhost
 
 psql -U $pguser -h $host -W $dbname -f smartfire_tables.sql
+
+# Databases set up before the schema_version table was kept are brought up to date with:
+#python3 migrate_db.py migrate
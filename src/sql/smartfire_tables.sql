@@ -6,7 +6,8 @@ CREATE TABLE clump (
     shape geometry NOT NULL,
     start_date date NOT NULL,
     source_id integer NOT NULL,
-    fire_id integer
+    fire_id integer,
+    centroid geometry
 );
 
 CREATE SEQUENCE clump_seq
@@ -409,6 +410,8 @@ CREATE INDEX idx_clump_by_fire ON clump USING btree (fire_id);
 
 CREATE INDEX idx_clump_by_source ON clump USING btree (source_id);
 
+CREATE INDEX idx_clump_centroid ON clump USING gist (centroid);
+
 CREATE INDEX idx_event_attribute ON event_attribute USING btree (event_id);
 
 CREATE INDEX idx_event_by_stream ON event USING btree (reconciliationstream_id);
@@ -445,6 +448,30 @@ CREATE INDEX idx_weighting_by_stream ON reconciliation_weighting USING btree (re
 
 CREATE INDEX schema_version_current_version_index ON schema_version USING btree (current_version);
 
+CREATE EXTENSION IF NOT EXISTS btree_gist;
+
+CREATE INDEX idx_fire_shape ON fire USING gist (shape);
+
+CREATE INDEX idx_clump_shape ON clump USING gist (shape);
+
+CREATE INDEX idx_event_outline_shape ON event USING gist (outline_shape);
+
+CREATE INDEX idx_fire_daterange ON fire USING gist (daterange(start_date::date, end_date::date, '[]'));
+
+CREATE INDEX idx_clump_daterange ON clump USING gist (daterange(start_date::date, end_date::date, '[]'));
+
+CREATE INDEX idx_event_daterange ON event USING gist (daterange(start_date::date, end_date::date, '[]'));
+
+CREATE INDEX idx_fire_source_dates ON fire USING btree (source_id, end_date, start_date);
+
+CREATE INDEX idx_clump_source_dates ON clump USING btree (source_id, end_date, start_date);
+
+CREATE INDEX idx_event_stream_dates ON event USING gist (reconciliationstream_id, daterange(start_date::date, end_date::date, '[]'));
+
+CREATE INDEX idx_event_day_event_date ON event_day USING btree (event_id, event_date);
+
+CREATE INDEX idx_data_attribute_rawdata_name ON data_attribute USING btree (rawdata_id, name);
+
 ALTER TABLE ONLY fetch_attribute
     ADD CONSTRAINT fetch_attribute_reference FOREIGN KEY (fetch_id) REFERENCES scheduled_fetch(id);
 
@@ -507,6 +534,11 @@ ALTER TABLE ONLY source_attribute
 
 SELECT UpdateGeometrySRID('raw_data','shape',5070);
 SELECT UpdateGeometrySRID('clump','shape',5070);
+SELECT UpdateGeometrySRID('clump','centroid',4326);
 SELECT UpdateGeometrySRID('fire','shape',5070);
 SELECT UpdateGeometrySRID('event','outline_shape',5070);
 SELECT UpdateGeometrySRID('event_day','location',4326);
+
+-- The tables include the migrations up to this version
+INSERT INTO schema_version (version, description, type, script, installed_by, execution_time, state, current_version)
+    VALUES ('4', '<< Flyway Baseline >>', 'BASELINE', 'smartfire_tables.sql', current_user, 0, 'SUCCESS', TRUE);